@@ -0,0 +1,191 @@
+"""Zip archives for lambda deployment packages."""
+
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import io
+import os
+import stat
+import zipfile
+import zlib
+
+from humilis.config import config, as_bool
+
+
+# Lambda only accepts stored or deflated zip entries
+COMPRESSION_METHODS = {
+    'stored': zipfile.ZIP_STORED,
+    'deflated': zipfile.ZIP_DEFLATED}
+
+# The earliest timestamp that a zip entry can have
+ZIP_EPOCH = (1980, 1, 1, 0, 0, 0)
+
+# Whether entries compressed beforehand can be appended as they are
+_raw_writes = None
+
+
+def _compress(data, compress_type, compresslevel):
+    """Compresses the data of a zip entry.
+
+    :returns: A tuple with the compression method actually used (entries
+        that do not shrink are stored), the CRC and the entry payload.
+    """
+    crc = zlib.crc32(data) & 0xffffffff
+    if compress_type == zipfile.ZIP_DEFLATED:
+        if compresslevel is None:
+            compresslevel = zlib.Z_DEFAULT_COMPRESSION
+        compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+        payload = compressor.compress(data) + compressor.flush()
+        if len(payload) < len(data):
+            return zipfile.ZIP_DEFLATED, crc, payload
+    return zipfile.ZIP_STORED, crc, data
+
+
+def _write_raw(zf, zinfo, payload):
+    """Appends an already compressed entry to an open zip file.
+
+    This relies on the internals of zipfile: use it only if
+    _raw_writes_supported() is True.
+    """
+    zinfo.header_offset = zf.fp.tell()
+    zf.fp.write(zinfo.FileHeader())
+    zf.fp.write(payload)
+    zf.filelist.append(zinfo)
+    zf.NameToInfo[zinfo.filename] = zinfo
+    zf.start_dir = zf.fp.tell()
+    zf._didModify = True
+
+
+def _sample_archive(raw):
+    """A small archive, written with _write_raw or with ZipFile.writestr."""
+    fileobj = io.BytesIO()
+    with zipfile.ZipFile(fileobj, 'w') as zf:
+        for name, compress_type in sorted(COMPRESSION_METHODS.items()):
+            data = name.encode() * 100
+            zinfo = zipfile.ZipInfo(name, date_time=ZIP_EPOCH)
+            zinfo.external_attr = (stat.S_IFREG | 0o644) << 16
+            zinfo.compress_type, zinfo.CRC, payload = _compress(
+                data, compress_type, None)
+            zinfo.file_size = len(data)
+            zinfo.compress_size = len(payload)
+            if raw:
+                _write_raw(zf, zinfo, payload)
+            else:
+                zf.writestr(zinfo, data)
+    return fileobj.getvalue()
+
+
+def _raw_writes_supported():
+    """True if entries compressed beforehand can be appended as they are.
+
+    Appending them uses the internals of zipfile, so it is only done if the
+    result is byte-identical to what ZipFile.writestr produces.
+    """
+    global _raw_writes
+    if _raw_writes is None:
+        try:
+            _raw_writes = _sample_archive(True) == _sample_archive(False)
+        except Exception:
+            _raw_writes = False
+    return _raw_writes
+
+
+class ArchiveWriter:
+    """Writes a zip archive, compressing its entries in parallel.
+
+    Entries are read and compressed in a pool of threads (zlib releases the
+    GIL) and are then appended to the archive in the order they were added.
+    At most a few entries per thread are held in memory at any time. If this
+    version of zipfile does not allow appending entries that are already
+    compressed (see _raw_writes_supported), they are written with
+    ZipFile.writestr instead, which compresses them again.
+
+    Deterministic archives are byte-identical for identical entry contents:
+    entries are sorted by name, timestamps are set to 1980-01-01 and
+    permissions are normalized to 0644, or 0755 for executables.
+
+    :param path: The path of the zip file.
+    :param compression: The compression method, 'stored' or 'deflated'.
+    :param compresslevel: The zlib compression level, 0 to 9.
+    :param max_workers: The number of compression threads.
+    :param deterministic: Produce a deterministic archive.
+    """
+    def __init__(self, path, compression=None, compresslevel=None,
+                 max_workers=None, deterministic=None):
+        compression = compression or config.LAMBDA_COMPRESSION
+        if compression not in COMPRESSION_METHODS:
+            raise ValueError(
+                "Unsupported compression '{}': use one of {}".format(
+                    compression, sorted(COMPRESSION_METHODS)))
+        self.compress_type = COMPRESSION_METHODS[compression]
+        if compresslevel is None:
+            compresslevel = config.LAMBDA_COMPRESSLEVEL
+        self.compresslevel = (None if compresslevel in (None, '')
+                              else int(compresslevel))
+        self.max_workers = int(max_workers or config.MAX_PARALLEL_COMPRESSION
+                               or os.cpu_count() or 1)
+        if deterministic is None:
+            deterministic = config.LAMBDA_DETERMINISTIC_ARCHIVES
+        self.deterministic = as_bool(deterministic)
+        self.path = path
+        self._entries = []
+
+    def add(self, filepath, arcname, data=None):
+        """Adds a file to the archive.
+
+        :param filepath: The file, also used for the entry's metadata.
+        :param arcname: The name of the entry in the archive.
+        :param data: The entry contents, if not those of the file.
+        """
+        if isinstance(data, str):
+            data = data.encode()
+        self._entries.append((filepath, arcname, data))
+
+    def _prepare(self, entry):
+        """Reads and compresses an entry."""
+        filepath, arcname, data = entry
+        if self.deterministic:
+            mode = 0o755 if os.stat(filepath).st_mode & 0o111 else 0o644
+            zinfo = zipfile.ZipInfo(arcname, date_time=ZIP_EPOCH)
+            zinfo.external_attr = (stat.S_IFREG | mode) << 16
+            zinfo.create_system = 3
+        else:
+            zinfo = zipfile.ZipInfo.from_file(filepath, arcname=arcname,
+                                              strict_timestamps=False)
+        if data is None:
+            with open(filepath, 'rb') as f:
+                data = f.read()
+        zinfo.compress_type, zinfo.CRC, payload = _compress(
+            data, self.compress_type, self.compresslevel)
+        zinfo.file_size = len(data)
+        zinfo.compress_size = len(payload)
+        return zinfo, data, payload
+
+    def close(self):
+        """Compresses all the entries and writes the archive."""
+        entries = self._entries
+        if self.deterministic:
+            entries = sorted(entries, key=lambda entry: entry[1])
+        raw = _raw_writes_supported()
+
+        def write(zinfo, data, payload):
+            if raw:
+                _write_raw(zf, zinfo, payload)
+            else:
+                zf.writestr(zinfo, data, compresslevel=self.compresslevel)
+
+        window = collections.deque()
+        with zipfile.ZipFile(self.path, 'w') as zf, \
+                ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for entry in entries:
+                window.append(executor.submit(self._prepare, entry))
+                if len(window) >= 4 * self.max_workers:
+                    write(*window.popleft().result())
+            while window:
+                write(*window.popleft().result())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
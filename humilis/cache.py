@@ -0,0 +1,217 @@
+"""Local cache of build artifacts shared across humilis runs."""
+
+import contextlib
+import hashlib
+import os
+import shutil
+import stat
+import tempfile
+import time
+
+from humilis.config import config
+
+
+def _makedirs(path):
+    """Creates a directory, and its missing parents, readable only by the
+    current user."""
+    if os.path.isdir(path):
+        return
+    parent = os.path.dirname(path)
+    if parent != path:
+        _makedirs(parent)
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+
+
+def get_cache_dir(*parts):
+    """A directory within the humilis cache, created if needed.
+
+    Cache directories are created readable and writable only by the current
+    user, since some cached artifacts (e.g. compiled templates) are code.
+    """
+    path = os.path.join(os.path.expanduser(config.CACHE_DIR), *parts)
+    _makedirs(path)
+    return path
+
+
+def is_private(path):
+    """True if only the current user can write to a directory."""
+    st = os.stat(path)
+    if hasattr(os, 'getuid') and st.st_uid != os.getuid():
+        return False
+    return not st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+
+def walk_files(path, exclude_dirs=None):
+    """Produces the paths of all files under a directory, in sorted order.
+
+    :param path: The root directory.
+    :param exclude_dirs: A callable that is True for directory names that
+        should not be walked into.
+    """
+    for root, dirs, files in os.walk(path):
+        if exclude_dirs is not None:
+            dirs[:] = [d for d in dirs if not exclude_dirs(d)]
+        dirs.sort()
+        for filename in sorted(files):
+            yield os.path.join(root, filename)
+
+
+def update_digest(hasher, path, exclude_dirs=None):
+    """Adds the names and contents of a file or directory tree to a hash."""
+    if os.path.isfile(path):
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                hasher.update(chunk)
+        return
+    for filepath in walk_files(path, exclude_dirs=exclude_dirs):
+        hasher.update(os.path.relpath(filepath, path).encode())
+        hasher.update(b'\0')
+        update_digest(hasher, filepath)
+        hasher.update(b'\0')
+
+
+def new_hasher():
+    """The hash used to content-address cached artifacts."""
+    return hashlib.sha256()
+
+
+def get_file(section, name):
+    """Path to a cached file, or None if it is not in the cache."""
+    path = os.path.join(get_cache_dir(section), name)
+    if not os.path.isfile(path):
+        return None
+    # Keep track of the last time an entry was used, for pruning
+    os.utime(path, None)
+    return path
+
+
+def put_file(section, name, path):
+    """Adds a copy of a file to the cache and returns the cached path."""
+    cache_dir = get_cache_dir(section)
+    target = os.path.join(cache_dir, name)
+    fd, tmppath = tempfile.mkstemp(dir=cache_dir)
+    os.close(fd)
+    shutil.copyfile(path, tmppath)
+    # Atomic, so that concurrent runs never see a partial file
+    os.replace(tmppath, target)
+    return target
+
+
+def put_data(section, name, data):
+    """Adds a file with the given contents (bytes) to the cache."""
+    cache_dir = get_cache_dir(section)
+    fd, tmppath = tempfile.mkstemp(dir=cache_dir)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(tmppath, os.path.join(cache_dir, name))
+
+
+def get_tree(section, name):
+    """Path to a cached directory tree, or None if it is not in the cache."""
+    path = os.path.join(get_cache_dir(section), name)
+    if not os.path.isdir(path):
+        return None
+    os.utime(path, None)
+    return path
+
+
+@contextlib.contextmanager
+def put_tree(section, name):
+    """Context manager that produces a directory to be filled and cached.
+
+    The directory is added to the cache only if the block succeeds.
+    """
+    cache_dir = get_cache_dir(section)
+    tmppath = tempfile.mkdtemp(dir=cache_dir, prefix='.tmp-')
+    try:
+        yield tmppath
+        try:
+            os.rename(tmppath, os.path.join(cache_dir, name))
+        except OSError:
+            # Cached concurrently by another run: keep that one
+            pass
+    finally:
+        if os.path.isdir(tmppath):
+            shutil.rmtree(tmppath)
+
+
+def copy_tree(src, dst, replace=False):
+    """Copies a directory tree into another.
+
+    Files are copied rather than hardlinked, so that writing to a file of
+    the destination can never modify the cached tree.
+
+    :param replace: If True, top-level files and dirs in the destination
+        that also exist in the source are replaced. Otherwise files that
+        already exist in the destination are left untouched.
+    """
+    if replace:
+        for name in os.listdir(src):
+            target = os.path.join(dst, name)
+            if os.path.isdir(target) and not os.path.islink(target):
+                shutil.rmtree(target)
+            elif os.path.lexists(target):
+                os.remove(target)
+    for filepath in walk_files(src):
+        target = os.path.join(dst, os.path.relpath(filepath, src))
+        if os.path.lexists(target):
+            continue
+        targetdir = os.path.dirname(target)
+        if not os.path.isdir(targetdir):
+            os.makedirs(targetdir)
+        # Keeps the permissions: executables stay executable
+        shutil.copy(filepath, target)
+
+
+def _size(path):
+    """Size in bytes of a file or directory tree."""
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(f) for f in walk_files(path))
+
+
+def list_entries(section=None):
+    """Lists the entries in the cache.
+
+    :returns: A list of dicts with the section, name, path, size in bytes
+        and time of last use of each entry.
+    """
+    basedir = get_cache_dir()
+    sections = [section] if section else sorted(os.listdir(basedir))
+    entries = []
+    for section in sections:
+        section_dir = os.path.join(basedir, section)
+        if not os.path.isdir(section_dir):
+            continue
+        for name in sorted(os.listdir(section_dir)):
+            if name.startswith('.'):
+                continue
+            path = os.path.join(section_dir, name)
+            entries.append({'section': section, 'name': name, 'path': path,
+                            'size': _size(path),
+                            'last_used': os.path.getmtime(path)})
+    return entries
+
+
+def prune(section=None, older_than=None):
+    """Removes cache entries.
+
+    :param section: Prune only this cache section.
+    :param older_than: Prune only entries not used for this many seconds.
+
+    :returns: The list of removed entries.
+    """
+    removed = []
+    for entry in list_entries(section):
+        if older_than is not None and \
+                time.time() - entry['last_used'] < older_than:
+            continue
+        if os.path.isdir(entry['path']):
+            shutil.rmtree(entry['path'], ignore_errors=True)
+        else:
+            os.remove(entry['path'])
+        removed.append(entry)
+    return removed
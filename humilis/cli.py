@@ -1,16 +1,26 @@
 """Command line interface."""
 
 import logging
+import os
 
 import click
-import yaml
 
+from humilis import cache as humilis_cache
 from humilis.config import config
-from humilis.environment import Environment
 
 LOG_LEVELS = ["critical", "error", "warning", "info", "debug"]
 
 
+def _get_environment(environment, **kwargs):
+    """Loads an environment.
+
+    humilis.environment pulls in boto3 and the CF machinery, so it is only
+    imported by the commands that need it.
+    """
+    from humilis.environment import Environment
+    return Environment(environment, **kwargs)
+
+
 def validate_log_level(ctx, param, value):
     value = value.lower()
     if value not in LOG_LEVELS:
@@ -18,6 +28,13 @@ def validate_log_level(ctx, param, value):
     return value.upper()
 
 
+def _select_layers(env, layer_names, **kwargs):
+    """The layers selected with --layer, or None if none was selected."""
+    if not layer_names:
+        return None
+    return env.select_layers(layer_names, **kwargs)
+
+
 @click.group()
 @click.option("--log", default='info', help="Log level: {}".format(LOG_LEVELS),
               callback=validate_log_level, metavar="LEVEL")
@@ -39,11 +56,20 @@ def main(log, profile):
 @click.option("--parameters", help="Deployment parameters", default=None,
               metavar="YAML_FILE")
 @click.option("--debug/--no-debug", help="Enable debug mode", default=False)
-def create(environment, stage, output, pretend, parameters, debug):
+@click.option("--max-parallel", help="Max number of layers deployed at once",
+              default=None, type=int, metavar="N")
+@click.option("--layer", "layers", multiple=True, metavar="NAME",
+              help="Deploy only this layer (can be repeated)")
+@click.option("--with-deps/--no-with-deps", default=False,
+              help="Also deploy the layers that --layer depends on")
+def create(environment, stage, output, pretend, parameters, debug,
+           max_parallel, layers, with_deps):
     """Creates an environment."""
-    env = Environment(environment, stage=stage, parameters=parameters)
+    env = _get_environment(environment, stage=stage, parameters=parameters)
+    layers = _select_layers(env, layers, with_dependencies=with_deps)
     if not pretend:
-        env.create(output_file=output, update=False, debug=debug)
+        env.create(output_file=output, update=False, debug=debug,
+                   max_parallel=max_parallel, layers=layers)
 
 
 @main.command(name="set-secret")
@@ -55,7 +81,7 @@ def create(environment, stage, output, pretend, parameters, debug):
 @click.option("--pretend/--no-pretend", default=False)
 def set_secret(environment, key, value, stage, pretend):
     """Stores a secret in the vault."""
-    env = Environment(environment, stage=stage)
+    env = _get_environment(environment, stage=stage)
     if not pretend:
         env.set_secret(key, value)
 
@@ -68,12 +94,66 @@ def set_secret(environment, key, value, stage, pretend):
 @click.option("--pretend/--no-pretend", default=False)
 def get_secret(environment, key, stage, pretend):
     """Gets a secret from the vault."""
-    env = Environment(environment, stage=stage)
+    env = _get_environment(environment, stage=stage)
     if not pretend:
         resp = env.get_secret(key)
         print(resp)
 
 
+@main.command(name="set-secrets")
+@click.argument("environment")
+@click.argument("secrets_file", metavar="FILE")
+@click.option("--stage", help="Deployment stage, e.g. PRODUCTION, or DEV",
+              default=None, metavar="STAGE")
+@click.option("--pretend/--no-pretend", default=False)
+@click.option("--max-parallel", help="Max number of KMS calls made at once",
+              default=None, type=int, metavar="N")
+def set_secrets(environment, secrets_file, stage, pretend, max_parallel):
+    """Stores all the secrets in a YAML or JSON file in the vault."""
+    from humilis.utils import load_yaml
+    env = _get_environment(environment, stage=stage)
+    with open(secrets_file, 'r') as f:
+        secrets = load_yaml(f)
+    if not isinstance(secrets, dict):
+        raise click.BadParameter("Should contain a mapping of keys to secrets",
+                                 param_hint="FILE")
+    if not pretend:
+        env.set_secrets(secrets, max_parallel=max_parallel)
+
+
+@main.command(name="get-secrets")
+@click.argument("environment")
+@click.argument("keys", nargs=-1, metavar="[KEY]...")
+@click.option("--stage", help="Deployment stage, e.g. PRODUCTION, or DEV",
+              default=None, metavar="STAGE")
+@click.option("--output", help="Store the secrets in a YAML or JSON file",
+              default=None, metavar="FILE")
+@click.option("--pretend/--no-pretend", default=False)
+@click.option("--max-parallel", help="Max number of KMS calls made at once",
+              default=None, type=int, metavar="N")
+def get_secrets(environment, keys, stage, output, pretend, max_parallel):
+    """Gets some secrets from the vault, or all if no key is given."""
+    import json
+    import yaml
+    env = _get_environment(environment, stage=stage)
+    if pretend:
+        return
+    secrets = env.get_secrets(keys or None, max_parallel=max_parallel)
+    if output is not None and output.lower().endswith('.json'):
+        text = json.dumps(secrets, indent=4, sort_keys=True)
+    else:
+        text = yaml.safe_dump(secrets, default_flow_style=False)
+    if output is None:
+        click.echo(text)
+    else:
+        # Only the owner can read the secrets: the mode passed to os.open
+        # only applies to new files, so fix it before writing anything
+        fd = os.open(output, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.chmod(output, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+
+
 @main.command()
 @click.argument("environment")
 @click.option("--stage", help="Deployment stage, e.g. PRODUCTION, or DEV",
@@ -83,11 +163,24 @@ def get_secret(environment, key, stage, pretend):
 @click.option("--pretend/--no-pretend", default=False)
 @click.option("--parameters", help="Deployment parameters", default=None,
               metavar="YAML_FILE")
-def update(environment, stage, output, pretend, parameters):
+@click.option("--max-parallel", help="Max number of layers deployed at once",
+              default=None, type=int, metavar="N")
+@click.option("--changed-only/--no-changed-only", default=False,
+              help="Skip layers that have not changed since last deployed "
+                   "with --changed-only")
+@click.option("--layer", "layers", multiple=True, metavar="NAME",
+              help="Update only this layer (can be repeated)")
+@click.option("--with-deps/--no-with-deps", default=False,
+              help="Also update the layers that --layer depends on")
+def update(environment, stage, output, pretend, parameters, max_parallel,
+           changed_only, layers, with_deps):
     """Updates (or creates) an environment."""
-    env = Environment(environment, stage=stage, parameters=parameters)
+    env = _get_environment(environment, stage=stage, parameters=parameters)
+    layers = _select_layers(env, layers, with_dependencies=with_deps)
     if not pretend:
-        env.create(output_file=output, update=True)
+        env.create(output_file=output, update=True,
+                   max_parallel=max_parallel, changed_only=changed_only,
+                   layers=layers)
 
 
 @main.command()
@@ -97,11 +190,19 @@ def update(environment, stage, output, pretend, parameters):
 @click.option("--pretend/--no-pretend", default=False)
 @click.option("--parameters", help="Deployment parameters", default=None,
               metavar="YAML_FILE")
-def delete(environment, stage, pretend, parameters):
+@click.option("--max-parallel", help="Max number of layers deleted at once",
+              default=None, type=int, metavar="N")
+@click.option("--layer", "layers", multiple=True, metavar="NAME",
+              help="Delete only this layer (can be repeated)")
+@click.option("--with-deps/--no-with-deps", default=False,
+              help="Also delete the layers that depend on --layer")
+def delete(environment, stage, pretend, parameters, max_parallel, layers,
+           with_deps):
     """Deletes an environment that has been deployed to CF."""
-    env = Environment(environment, stage=stage, parameters=parameters)
+    env = _get_environment(environment, stage=stage, parameters=parameters)
+    layers = _select_layers(env, layers, with_dependents=with_deps)
     if not pretend:
-        env.delete()
+        env.delete(max_parallel=max_parallel, layers=layers)
 
 
 @main.command()
@@ -114,5 +215,39 @@ def configure(ask, local):
     config.boto_config.configure(ask=ask, local=local)
 
 
+@main.group()
+def cache():
+    """Inspect or prune the local build cache."""
+    pass
+
+
+@cache.command(name="list")
+@click.option("--section", help="Only this cache section, e.g. deps",
+              default=None)
+def list_cache(section):
+    """Lists the entries in the local build cache."""
+    total = 0
+    for entry in humilis_cache.list_entries(section):
+        total += entry['size']
+        click.echo("{}/{}\t{:.1f} MB".format(
+            entry['section'], entry['name'], entry['size'] / 1e6))
+    click.echo("Total: {:.1f} MB in {}".format(
+        total / 1e6, humilis_cache.get_cache_dir()))
+
+
+@cache.command()
+@click.option("--section", help="Only this cache section, e.g. deps",
+              default=None)
+@click.option("--older-than", help="Only entries not used for N days",
+              type=float, default=None, metavar="N")
+def prune(section, older_than):
+    """Removes entries from the local build cache."""
+    if older_than is not None:
+        older_than *= 24 * 3600
+    removed = humilis_cache.prune(section, older_than=older_than)
+    click.echo("Removed {} entries ({:.1f} MB)".format(
+        len(removed), sum(e['size'] for e in removed) / 1e6))
+
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,137 @@
+"""AWS clients shared across a humilis run."""
+
+import threading
+
+from boto3facade.aws import AwsFacade
+from boto3facade.s3 import S3
+from botocore.exceptions import ClientError
+
+
+_lock = threading.RLock()
+_sessions = {}
+_facade_classes = {}
+_facades = {}
+_clients = {}
+_account_ids = {}
+
+
+class _SharedSession:
+    """Makes a facade use the boto3 session shared by its AWS profile.
+
+    boto3 sessions are not thread safe, so clients and resources are created
+    from the shared session while holding the lock.
+    """
+    @property
+    def session(self):
+        key = _profile_key(self.config)
+        with _lock:
+            session = _sessions.get(key)
+            if session is None:
+                # boto3facade picks the credentials and region of the profile
+                session = super(_SharedSession, self).session
+                _sessions[key] = session
+            return session
+
+    @property
+    def client(self):
+        with _lock:
+            return super(_SharedSession, self).client
+
+    @property
+    def resource(self):
+        with _lock:
+            return super(_SharedSession, self).resource
+
+
+def _shared(facade_cls, *args):
+    """Builds a facade that uses the boto3 session shared by its profile."""
+    facade = facade_cls(*args)
+    with _lock:
+        if facade_cls not in _facade_classes:
+            _facade_classes[facade_cls] = type(
+                facade_cls.__name__, (_SharedSession, facade_cls), {})
+        # Facades that call super(self.__class__, self).__init__ can't be
+        # subclassed: they are given the subclass once they are built
+        facade.__class__ = _facade_classes[facade_cls]
+    return facade
+
+
+class _ServiceFacade(AwsFacade):
+    """A facade for any AWS service, used only to build its client."""
+    def __init__(self, service, *args, **kwargs):
+        super(_ServiceFacade, self).__init__(*args, **kwargs)
+        self.__service = service
+
+    @property
+    def service(self):
+        return self.__service
+
+
+def _profile_key(config):
+    """Identifies the AWS credentials and region of a configuration."""
+    return (config.profile.get('aws_profile'),
+            config.profile.get('aws_region'))
+
+
+def get_facade(facade_cls, config):
+    """A boto3facade object shared by all users of an AWS profile and region.
+
+    :param facade_cls: The facade class, e.g. boto3facade.s3.S3.
+    :param config: A boto3facade configuration object.
+    """
+    key = (facade_cls, _profile_key(config))
+    with _lock:
+        facade = _facades.get(key)
+        if facade is None:
+            facade = _shared(facade_cls, config)
+            _facades[key] = facade
+        return facade
+
+
+def get_client(service, config):
+    """A boto3 client shared by all users of an AWS profile and region.
+
+    :param service: The name of the AWS service, e.g. 'kms'.
+    :param config: A boto3facade configuration object.
+    """
+    key = (service, _profile_key(config))
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            client = _shared(_ServiceFacade, service, config).client
+            _clients[key] = client
+        return client
+
+
+def get_account_id(config):
+    """The ID of the AWS account, resolved once per AWS profile."""
+    key = _profile_key(config)
+    with _lock:
+        if key not in _account_ids:
+            _account_ids[key] = get_client('sts', config).get_caller_identity(
+                ).get('Account')
+        return _account_ids[key]
+
+
+def s3_object_exists(config, bucket, key):
+    """True if a key exists in a S3 bucket."""
+    try:
+        get_facade(S3, config).client.head_object(Bucket=bucket, Key=key)
+    except ClientError as error:
+        if error.response.get('Error', {}).get('Code') in {'404', 'NoSuchKey'}:
+            return False
+        raise
+    return True
+
+
+def reset():
+    """Forgets the shared sessions, facades, clients and account IDs.
+
+    They are created again, from the current configuration, when they are
+    next needed.
+    """
+    with _lock:
+        _sessions.clear()
+        _facades.clear()
+        _clients.clear()
+        _account_ids.clear()
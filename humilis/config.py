@@ -1,13 +1,14 @@
 """Humilis configuration."""
 
 import datetime
-import pkg_resources
 import os
 import logging
 from configparser import ConfigParser
 
 import boto3facade.config
 
+from humilis.plugins import EntryPointMap
+
 
 def _get_config_file():
     project_config = os.path.join(os.path.curdir, '.humilis.ini')
@@ -25,6 +26,13 @@ J2_FILTERS_GROUP = "humilis.jinja2_filters"
 LAYERS_GROUP = "humilis.layers"
 
 
+def as_bool(value):
+    """Interprets a configuration value as a boolean flag."""
+    if isinstance(value, str):
+        return value.strip().lower() in {'1', 'yes', 'true', 'on'}
+    return bool(value)
+
+
 class Config():
     """Base configuration.
 
@@ -36,6 +44,50 @@ class Config():
     LAYER_SECTIONS = ['parameters', 'mappings', 'resources', 'outputs',
                       'transform']
     LOG_LEVEL = 'info'
+    # Maximum number of layers that are deployed at the same time
+    MAX_PARALLEL_LAYERS = 4
+    # Maximum number of parameter references of a layer resolved at once
+    MAX_PARALLEL_REFERENCES = 8
+    # Seconds between polls of an in-flight stack or changeset: the delay
+    # starts at the minimum and grows by the backoff factor up to the maximum
+    WATCHER_MIN_DELAY = 0.5
+    WATCHER_MAX_DELAY = 10
+    WATCHER_BACKOFF = 1.5
+    # Seconds before the index of CF stacks is built again
+    STACK_INDEX_TTL = 60
+    # Local directory where the build state of environments is kept
+    STATE_DIR = os.path.join(os.path.expanduser('~'), '.humilis', 'state')
+    # Local directory where build artifacts are cached across runs
+    CACHE_DIR = os.path.join(os.path.expanduser('~'), '.humilis', 'cache')
+    # Reuse lambda packages that have already been built or uploaded
+    LAMBDA_PACKAGE_CACHE = True
+    # Cache compiled Jinja2 templates across runs
+    JINJA2_BYTECODE_CACHE = True
+    # Cache parsed YAML files across runs
+    YAML_PARSE_CACHE = True
+    # Reuse installed lambda dependencies across runs
+    DEPENDENCY_CACHE = True
+    # Compression of lambda packages: stored or deflated, and zlib level
+    LAMBDA_COMPRESSION = 'deflated'
+    LAMBDA_COMPRESSLEVEL = 6
+    # Build byte-identical lambda packages from identical inputs
+    LAMBDA_DETERMINISTIC_ARCHIVES = True
+    # Name lambda packages in S3 after their contents, not their inputs
+    LAMBDA_KEY_FROM_ARCHIVE = True
+    # Max number of threads rendering the templates of a lambda
+    MAX_PARALLEL_RENDERING = 8
+    # Max number of threads compressing lambda package entries
+    MAX_PARALLEL_COMPRESSION = os.cpu_count()
+    # Max number of KMS calls made at once by the bulk secrets commands
+    MAX_PARALLEL_KMS = 8
+    # Seconds before retrying throttled vault batch writes and reads: the
+    # delay starts at the minimum and doubles up to the maximum
+    VAULT_RETRY_MIN_DELAY = 0.05
+    VAULT_RETRY_MAX_DELAY = 5
+    # Max number of secrets of a keyring group fetched at once
+    MAX_PARALLEL_SECRET_FETCHES = 8
+    # Encrypt vault secrets locally with a KMS data key (needs cryptography)
+    SECRETS_ENVELOPE_ENCRYPTION = False
 
     # Coloring for the events' messages
     COLORS = {
@@ -103,26 +155,25 @@ class Config():
         self.layers = self.find_layer_paths()
         self.jinja2_filters = self.find_jinja2_filters()
 
+    def _entry_points(self, group, **kwargs):
+        """The plugins registered in an entry point group, loaded lazily."""
+        return EntryPointMap(
+            group, groups=(REFPARSERS_GROUP, J2_FILTERS_GROUP, LAYERS_GROUP),
+            cache_dir=os.path.join(os.path.expanduser(self.CACHE_DIR),
+                                   'plugins'),
+            **kwargs)
+
     def find_reference_parsers(self):
         """Registers all plugin reference parsers."""
-        reference_parsers = {}
-        for ep in pkg_resources.iter_entry_points(group=REFPARSERS_GROUP):
-            reference_parsers[ep.name] = ep.load()
-        return reference_parsers
+        return self._entry_points(REFPARSERS_GROUP)
 
     def find_jinja2_filters(self):
         """Registers all Jinja2 custom functions."""
-        funcs = {}
-        for func in pkg_resources.iter_entry_points(group=J2_FILTERS_GROUP):
-            funcs[func.name] = func.load()
-        return funcs
+        return self._entry_points(J2_FILTERS_GROUP)
 
     def find_layer_paths(self):
         """Register the paths to all available layer types."""
-        paths = {}
-        for ep in pkg_resources.iter_entry_points(group=LAYERS_GROUP):
-            paths[ep.name] = ep.load()()
-        return paths
+        return self._entry_points(LAYERS_GROUP, call=True)
 
     def from_ini_file(self, section_name):
         """Load configuration overrides from :data:`GLOBAL_CONFIG_FILE`.
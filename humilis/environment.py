@@ -1,23 +1,31 @@
 """Humilis environment."""
 
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import os
+import threading
+import time
 
-import boto3
 from boto3facade.cloudformation import Cloudformation
-from boto3facade.dynamodb import Dynamodb
-from boto3facade.kms import Kms
-import jinja2 as j2
 import json
 import yaml
 import six
 
-from humilis.config import config
+from humilis.clients import get_account_id, get_client, get_facade
+from humilis.config import config, as_bool
 from humilis.exceptions import (FileFormatError, RequiresVaultError,
-                                MissingParentLayerError, CloudformationError)
+                                MissingParentLayerError, CloudformationError,
+                                UnknownLayerError)
 from humilis.layer import Layer
+from humilis.stacks import StackIndex
+from humilis.state import BuildState
+from humilis.vault import SecretCipher
 import humilis.utils as utils
 
+# The maximum number of items of a DynamoDB BatchWriteItem/BatchGetItem call
+BATCH_WRITE_SIZE = 25
+BATCH_GET_SIZE = 100
+
 
 class Environment():
     """Manages the deployment of a collection of humilis layers."""
@@ -37,26 +45,22 @@ class Environment():
         self.stage = stage and stage.upper()
         basedir, envfile = os.path.split(yml_path)
         self.basedir = os.path.abspath(basedir)
-        self._j2_env = j2.Environment(
-            loader=j2.FileSystemLoader(self.basedir))
-        # Add custom functions and filters
-        utils.update_jinja2_env(self._j2_env)
+        self._j2_env = utils.get_jinja2_env(self.basedir)
 
         parameters = self._preprocess_parameters(parameters)
-        with open(yml_path, 'r') as f:
-            if os.path.splitext(yml_path)[1] == ".j2":
-                template = self._j2_env.get_template(envfile)
-                meta = yaml.load(template.render(
-                    stage=stage,    # Backwards compatibility
-                    __context={
-                        'stage': stage,
-                        'aws': {
-                            'account_id': boto3.client('sts').get_caller_identity().get('Account')}
-                        },
-                    __env=os.environ,
-                    **parameters), Loader=yaml.FullLoader)
-            else:
-                meta = yaml.load(f, Loader=yaml.FullLoader)
+        if os.path.splitext(yml_path)[1] == ".j2":
+            template = self._j2_env.get_template(envfile)
+            meta = utils.load_yaml(template.render(
+                stage=stage,    # Backwards compatibility
+                __context={
+                    'stage': stage,
+                    'aws': {
+                        'account_id': get_account_id(config.boto_config)}
+                    },
+                __env=os.environ,
+                **parameters))
+        else:
+            meta = utils.load_yaml_file(yml_path)
 
         self.name = list(meta.keys())[0]
         self.meta = meta.get(self.name)
@@ -65,12 +69,16 @@ class Environment():
             raise FileFormatError(yml_path, "Error getting environment name ",
                                   logger=self.logger)
 
-        self.cf = Cloudformation(config.boto_config)
+        self.cf = get_facade(Cloudformation, config.boto_config)
+        self.stack_index = StackIndex(self.cf)
         self.sns_topic_arn = self.meta.get('sns-topic-arn', [])
         self.tags = self.meta.get('tags', {})
         self.tags['humilis:environment'] = self.name
 
-        self.layers = []
+        # Layers are only loaded when they are first used
+        self._layer_params = {}
+        self._layers = {}
+        self._layers_lock = threading.Lock()
         for layer in self.meta.get('layers', []):
             layer_name = layer.get('layer', None)
             if layer_name is None:
@@ -83,16 +91,16 @@ class Environment():
                 continue
 
             # Get the layer params provided in the environment spec
-            layer_params = {k: v for k, v in layer.items() if k != 'layer'}
-            layer_obj = Layer(self, layer_name, **layer_params)
-            self.layers.append(layer_obj)
+            self._layer_params[layer_name] = {
+                k: v for k, v in layer.items() if k != 'layer'}
 
-        self.vault_layer = self.get_layer(vault_layer or 'secrets-vault')
+        self._vault_layer_name = vault_layer or 'secrets-vault'
+        self._kms_key_id = None
+        self._secrets_cipher = None
         self.__secrets_table_name = "{}-{}-secrets".format(self.name,
                                                            self.stage)
         self.__keychain_namespace = "{}:{}".format(self.name,
                                                    self.stage.lower())
-        self.__dynamodb = None
 
     def _preprocess_parameters(self, parameters):
         """Apply default values to unspecified stage parameters."""
@@ -103,12 +111,11 @@ class Environment():
             if os.path.splitext(parameters)[1] == ".j2":
                 _, pfile = os.path.split(parameters)
                 template = self._j2_env.get_template(pfile)
-                parameters = yaml.load(template.render(
+                parameters = utils.load_yaml(template.render(
                     __context={'stage': self.stage},
-                    __env=os.environ), Loader=yaml.FullLoader)
+                    __env=os.environ))
             else:
-                with open(parameters, "r") as f:
-                    parameters = yaml.load(f.read(), Loader=yaml.FullLoader)
+                parameters = utils.load_yaml_file(parameters)
         if self.stage in parameters or "_default" in parameters:
             stage_params = parameters.get("_default", {})
             stage_params.update(parameters.get(self.stage, {}))
@@ -116,12 +123,40 @@ class Environment():
             stage_params = parameters
         return stage_params
 
+    @property
+    def layer_names(self):
+        """The names of the layers, in the order they are defined."""
+        return list(self._layer_params)
+
+    @property
+    def layers(self):
+        """All the environment layers, in the order they are defined."""
+        return [self._get_layer(name) for name in self._layer_params]
+
+    def _get_layer(self, layer_name):
+        """Gets a layer by name, loading it the first time."""
+        with self._layers_lock:
+            layer = self._layers.get(layer_name)
+            if layer is None:
+                layer = Layer(self, layer_name,
+                              **self._layer_params[layer_name])
+                self._layers[layer_name] = layer
+            return layer
+
+    @property
+    def vault_layer(self):
+        """The layer that holds the environment secrets, if any."""
+        return self.get_layer(self._vault_layer_name)
+
     @property
     def outputs(self):
         """Outputs produced by each environment layer."""
+        return self._outputs(self.layers)
+
+    def _outputs(self, layers):
+        """Outputs produced by some of the environment layers."""
         outputs = {}
-        self.cf.flush_cache()
-        for layer in self.layers:
+        for layer in layers:
             try:
                 ly = layer.outputs
             except CloudformationError:
@@ -152,15 +187,29 @@ class Environment():
         """The ID of the KMS Key associated to the environment vault."""
         if not self.vault_layer:
             raise RequiresVaultError("Requires a secrets-vault layer")
-        if self.vault_layer:
-            return self.outputs[self.vault_layer.name]['KmsKeyId']
+        if self._kms_key_id is None:
+            outputs = self.vault_layer.outputs
+            if outputs is None:
+                raise RequiresVaultError("secrets-vault layer is not deployed",
+                                         logger=self.logger)
+            self._kms_key_id = outputs['KmsKeyId']
+        return self._kms_key_id
 
     @property
     def dynamodb(self):
         """Connection to AWS DynamoDB."""
-        if self.__dynamodb is None:
-            self.__dynamodb = Dynamodb(config.boto_config)
-        return self.__dynamodb
+        # Only the secrets commands use DynamoDB
+        from boto3facade.dynamodb import Dynamodb
+        return get_facade(Dynamodb, config.boto_config)
+
+    @property
+    def secrets_cipher(self):
+        """Encrypts and decrypts the items in the secrets table."""
+        if self._secrets_cipher is None:
+            self._secrets_cipher = SecretCipher(
+                get_client('kms', config.boto_config),
+                envelope=as_bool(config.SECRETS_ENVELOPE_ENCRYPTION))
+        return self._secrets_cipher
 
     def set_secret(self, key, plaintext):
         """Sets and environment secret."""
@@ -169,12 +218,10 @@ class Environment():
             self.logger.error(msg)
             raise RequiresVaultError(msg)
         else:
-            client = Kms(config.boto_config).client
-            encrypted = client.encrypt(KeyId=self.kms_key_id,
-                                       Plaintext=plaintext)['CiphertextBlob']
+            item = self.secrets_cipher.encrypt(key, plaintext,
+                                               self.kms_key_id)
             resp = self.dynamodb.client.put_item(
-                TableName=self.__secrets_table_name,
-                Item={'id': {'S': key}, 'value': {'B': encrypted}})
+                TableName=self.__secrets_table_name, Item=item)
             return resp
 
     def get_secret(self, key):
@@ -184,15 +231,12 @@ class Environment():
             self.logger.error(msg)
             raise RequiresVaultError(msg)
         else:
-            client = Dynamodb(config.boto_config).client
-            encrypted = client.get_item(
+            client = self.dynamodb.client
+            item = client.get_item(
                 TableName=self.__secrets_table_name,
-                Key={'id': {'S': key}})['Item']['value']['B']
-
-            # Decrypt using KMS (assuming the secret value is a string)
-            client = boto3.client('kms')
-            plaintext = client.decrypt(CiphertextBlob=encrypted)['Plaintext']
-            return plaintext.decode()
+                Key={'id': {'S': key}})['Item']
+            # Assuming the secret value is a string
+            return self.secrets_cipher.decrypt(item)
 
     def delete_secret(self, key):
         """Deletes a secret."""
@@ -201,23 +245,169 @@ class Environment():
             self.logger.error(msg)
             raise RequiresVaultError(msg)
         else:
-            client = Dynamodb(config.boto_config).client
+            client = self.dynamodb.client
             resp = client.delete_item(
                 TableName=self.__secrets_table_name,
                 Key={'id': {'S': key}})['Item']['value']['B']
 
             return resp
 
-    def create(self, output_file=None, update=False, debug=False):
-        """Creates or updates an environment."""
-        for layer in self.layers:
-            layer.create(update=update, debug=debug)
-        self.logger.info({"outputs": self.outputs})
+    def _check_vault(self):
+        """Raises RequiresVaultError if the environment has no vault."""
+        if not self.vault_layer:
+            msg = "No secrets-vault layer in this environment"
+            self.logger.error(msg)
+            raise RequiresVaultError(msg)
+
+    def set_secrets(self, secrets, max_parallel=None):
+        """Sets many environment secrets at once.
+
+        The secrets are encrypted concurrently (or locally, with envelope
+        encryption) and stored in batches.
+
+        :param secrets: A dict with the plaintext of each secret, by key.
+        :param max_parallel: The max number of concurrent KMS calls.
+        """
+        self._check_vault()
+        items = self.secrets_cipher.encrypt_all(
+            secrets, self.kms_key_id, max_parallel=max_parallel)
+        requests = [{'PutRequest': {'Item': item}} for item in items]
+        for batch in utils.chunks(requests, BATCH_WRITE_SIZE):
+            self._batch_write(batch)
+        self.logger.info("Stored {} secrets in '{}'".format(
+            len(items), self.__secrets_table_name))
+
+    def get_secrets(self, keys=None, max_parallel=None):
+        """Retrieves many secrets at once.
+
+        The secrets are read in batches and decrypted concurrently.
+
+        :param keys: The keys of the secrets. If None, all the secrets.
+        :param max_parallel: The max number of concurrent KMS calls.
+
+        :returns: A dict with the plaintext of each secret, by key. Keys that
+            are not in the vault are left out.
+        """
+        self._check_vault()
+        if keys is None:
+            items = self._scan_secrets()
+        else:
+            items = []
+            keys = sorted(set(keys))
+            for batch in utils.chunks(keys, BATCH_GET_SIZE):
+                items.extend(self._batch_get(batch))
+            missing = set(keys) - {item['id']['S'] for item in items}
+            if missing:
+                self.logger.warning("Secrets not found: {}".format(
+                    sorted(missing)))
+
+        plaintexts = self.secrets_cipher.decrypt_all(
+            items, max_parallel=max_parallel)
+        return {item['id']['S']: plaintext
+                for item, plaintext in zip(items, plaintexts)}
+
+    def _scan_secrets(self):
+        """All the items in the secrets table."""
+        paginator = self.dynamodb.client.get_paginator('scan')
+        items = []
+        for page in paginator.paginate(TableName=self.__secrets_table_name):
+            items.extend(page['Items'])
+        return items
+
+    def _batch_write(self, requests):
+        """Runs a BatchWriteItem call until all items are processed."""
+        client = self.dynamodb.client
+        table = self.__secrets_table_name
+        delay = float(config.VAULT_RETRY_MIN_DELAY)
+        while requests:
+            resp = client.batch_write_item(RequestItems={table: requests})
+            requests = resp.get('UnprocessedItems', {}).get(table)
+            if requests:
+                # Throttled: back off before retrying what is left
+                time.sleep(delay)
+                delay = min(delay * 2, float(config.VAULT_RETRY_MAX_DELAY))
+
+    def _batch_get(self, keys):
+        """Runs a BatchGetItem call until all keys are processed."""
+        client = self.dynamodb.client
+        table = self.__secrets_table_name
+        request = {'Keys': [{'id': {'S': key}} for key in keys],
+                   'ConsistentRead': True}
+        items = []
+        delay = float(config.VAULT_RETRY_MIN_DELAY)
+        while request:
+            resp = client.batch_get_item(RequestItems={table: request})
+            items.extend(resp.get('Responses', {}).get(table, []))
+            request = resp.get('UnprocessedKeys', {}).get(table)
+            if request:
+                time.sleep(delay)
+                delay = min(delay * 2, float(config.VAULT_RETRY_MAX_DELAY))
+        return items
+
+    def create(self, output_file=None, update=False, debug=False,
+               max_parallel=None, changed_only=False, layers=None):
+        """Creates or updates an environment.
+
+        Layers that do not depend on each other are deployed in parallel.
+
+        :param changed_only: Skip layers whose inputs, and the outputs of the
+            layers they depend on, have not changed since they were last
+            deployed from this machine with changed_only. Only then is the
+            build state of the layers computed and recorded.
+        :param layers: Deploy only these layers (see select_layers).
+        """
+        if layers is None:
+            layers = self.layers
+        state = BuildState.for_environment(self) if changed_only else None
+        for wave in self.deployment_waves(layers):
+            try:
+                self._run_wave(
+                    wave, lambda layer: self._create_layer(
+                        layer, state, update, debug),
+                    max_parallel=max_parallel)
+            finally:
+                if state is not None:
+                    state.save()
+        self.logger.info({"outputs": self._outputs(layers)})
         if output_file is not None:
-            self.write_outputs(output_file)
+            self.write_outputs(output_file, layers=layers)
+
+    def _create_layer(self, layer, state, update, debug):
+        """Creates or updates a layer.
+
+        :param state: The build state of the environment. If given, the layer
+            is skipped if it has not changed since it was last deployed, and
+            its build state is recorded. If None, it is always deployed.
+        """
+        if state is None:
+            return layer.create(update=update, debug=debug)
+        layer_state = {'inputs': layer.input_digest(),
+                       'upstream': layer.upstream_digest()}
+        if layer_state['inputs'] is not None and layer.ok:
+            recorded = state.get(layer.name) or {}
+            if recorded == dict(layer_state, stack=layer.stack_version):
+                self.logger.info(
+                    "Layer '{}' has not changed: skipping".format(layer.name))
+                return layer.outputs
+
+        # Layers already in CF are deployed from their inputs only on update
+        deployed = update or not layer.in_cf
+        state.set(layer.name, None)
+        outputs = layer.create(update=update, debug=debug)
+        if deployed and layer_state['inputs'] is not None:
+            layer_state['stack'] = layer.stack_version
+            state.set(layer.name, layer_state)
+        return outputs
+
+    def write_outputs(self, output_file=None, layers=None):
+        """Writes layer outputs to a YAML or JSON file.
 
-    def write_outputs(self, output_file=None):
-        """Writes layer outputs to a YAML or JSON file."""
+        :param layers: Write only the outputs of these layers. By default,
+            those of all the layers.
+        """
+        if layers is None:
+            layers = self.layers
+        outputs = self._outputs(layers)
         if output_file is None:
             output_file = "{environment}-{stage}.outputs.yaml"
 
@@ -227,35 +417,137 @@ class Environment():
         _, ext = os.path.splitext(output_file)
         with open(output_file, "w") as f:
             if ext.lower() == ".yaml":
-                f.write(yaml.dump(self.outputs, indent=4,
+                f.write(yaml.dump(outputs, indent=4,
                                   default_flow_style=False))
             else:
-                f.write(json.dumps(self.outputs, indent=4))
+                f.write(json.dumps(outputs, indent=4))
 
     def get_layer(self, layer_name):
         """Gets a layer by name"""
-        sel_layer = [layer for layer in self.layers
-                     if layer.cf_name == layer_name or
-                     layer.name == layer_name]
-        if len(sel_layer) > 0:
-            return sel_layer[0]
-
-    def delete(self):
-        """Deletes the complete environment from CF."""
-        for layer in reversed(self.layers):
-            if layer.termination_protection:
-                self.logger.warning(
-                    "Layer '%s' has termination protection set: "
-                    "will not be deleted", layer.name)
-            else:
-                layer.delete()
+        for name in self._layer_params:
+            if layer_name == name or layer_name == utils.get_cf_name(
+                    self.name, name, stage=self.stage):
+                return self._get_layer(name)
+
+    def select_layers(self, layer_names, with_dependencies=False,
+                      with_dependents=False):
+        """Selects a subset of the layers, loading only what is needed.
+
+        :param layer_names: The names of the layers to select.
+        :param with_dependencies: Also select the layers these depend on,
+            recursively.
+        :param with_dependents: Also select the layers that depend on these,
+            recursively. This requires loading all the layers.
+
+        :returns: The selected layers, in the order they are defined.
+        """
+        unknown = [name for name in layer_names
+                   if name not in self._layer_params]
+        if unknown:
+            msg = "No layer(s) {} in environment '{}'".format(
+                ", ".join(unknown), self.name)
+            raise UnknownLayerError(msg, logger=self.logger)
+
+        selected = set(layer_names)
+        if with_dependencies:
+            selected = self._closure(
+                selected, lambda name: self._get_layer(name).depends_on)
+        if with_dependents:
+            dependents = self._dependents(self.layers)
+            selected = self._closure(selected, lambda name: dependents[name])
+        return [self._get_layer(name) for name in self._layer_params
+                if name in selected]
+
+    def _closure(self, names, related):
+        """Adds recursively to a set of layer names their related layers."""
+        names = set(names)
+        pending = list(names)
+        while pending:
+            for name in related(pending.pop()):
+                if name in self._layer_params and name not in names:
+                    names.add(name)
+                    pending.append(name)
+        return names
+
+    @staticmethod
+    def _dependents(layers):
+        """The names of the layers that depend on each layer."""
+        dependents = {layer.name: [] for layer in layers}
+        for layer in layers:
+            for name in layer.depends_on:
+                if name in dependents and name != layer.name:
+                    dependents[name].append(layer.name)
+        return dependents
+
+    def deployment_waves(self, layers=None):
+        """Groups the layers in waves that can be deployed in parallel.
+
+        Layers that don't depend on each other keep the order they have in
+        the environment file.
+
+        :param layers: Group only these layers. Dependencies on layers that
+            are not among them are ignored.
+        """
+        if layers is None:
+            layers = self.layers
+        dependencies = {layer.name: layer.depends_on for layer in layers}
+        layers = {layer.name: layer for layer in layers}
+        return [[layers[name] for name in wave] for wave in
+                utils.dependency_waves(list(layers), dependencies)]
+
+    def _run_wave(self, layers, func, max_parallel=None):
+        """Runs func on a wave of layers that don't depend on each other."""
+        if len(layers) < 2:
+            return [func(layer) for layer in layers]
+        max_parallel = int(max_parallel or config.MAX_PARALLEL_LAYERS)
+        self.logger.info("Processing layers {} in parallel".format(
+            [layer.name for layer in layers]))
+        with ThreadPoolExecutor(max_workers=max_parallel) as executor:
+            futures = [executor.submit(func, layer) for layer in layers]
+        for layer, future in zip(layers, futures):
+            if future.exception() is not None:
+                self.logger.error("Error processing layer '{}'".format(
+                    layer.name))
+                raise future.exception()
+        return [future.result() for future in futures]
+
+    def delete(self, max_parallel=None, layers=None):
+        """Deletes the complete environment from CF.
+
+        A layer is deleted only after all the layers that depend on it have
+        been deleted. Layers that don't depend on each other are deleted in
+        parallel.
+
+        :param layers: Delete only these layers (see select_layers).
+        """
+        if layers is None:
+            layers = self.layers
+        dependents = self._dependents(layers)
+        layers = {layer.name: layer for layer in layers}
+        protected = set()
+        for wave in utils.dependency_waves(list(reversed(list(layers))),
+                                           dependents):
+            to_delete = []
+            for name in wave:
+                if layers[name].termination_protection:
+                    self.logger.warning(
+                        "Layer '%s' has termination protection set: "
+                        "will not be deleted", name)
+                    protected.add(name)
+                elif protected.intersection(dependents[name]):
+                    self.logger.warning(
+                        "Layer '%s' is required by a layer with termination "
+                        "protection: will not be deleted", name)
+                    protected.add(name)
+                else:
+                    to_delete.append(layers[name])
+            self._run_wave(to_delete, lambda layer: layer.delete(wait=True),
+                           max_parallel=max_parallel)
 
     @property
     def in_cf(self):
         """Returns true if the environment has been deployed to CF."""
-        return self.name in {
-            utils.unroll_tags(stk['Tags']).get('humilis:environment')
-            for stk in self.cf.stacks}
+        return len(self.stack_index.environment_stacks(self.name)) > 0
 
     def __repr__(self):
         return str(self)
@@ -0,0 +1,68 @@
+"""Incremental reading of CF stack events."""
+
+from botocore.exceptions import ClientError
+
+
+def stack_events(client, stack_name, since=None):
+    """Produces the events of a stack that happened after a given event.
+
+    Events are paged newest first, and paging stops as soon as the event with
+    id ``since`` is found, so that only new events are retrieved from AWS.
+
+    :param client: A boto3 CF client.
+    :param stack_name: The name of the CF stack.
+    :param since: The id of the last event already seen, if any.
+
+    :returns: A generator of event dicts, oldest first.
+    """
+    new_events = []
+    kwargs = {'StackName': stack_name}
+    while True:
+        try:
+            resp = client.describe_stack_events(**kwargs)
+        except ClientError as error:
+            msg = error.response.get('Error', {}).get('Message', '')
+            if msg.find('does not exist') > -1:
+                break
+            raise
+        for event in resp.get('StackEvents', []):
+            if event['EventId'] == since:
+                kwargs.pop('NextToken', None)
+                break
+            new_events.append(event)
+        else:
+            kwargs['NextToken'] = resp.get('NextToken')
+        if not kwargs.get('NextToken'):
+            break
+
+    for event in reversed(new_events):
+        yield event
+
+
+class EventStream:
+    """Reads the events of a stack incrementally.
+
+    Only the id of the last event that has been read is kept.
+    """
+    def __init__(self, client, stack_name, since=None):
+        self.client = client
+        self.stack_name = stack_name
+        self.since = since
+
+    def skip_history(self):
+        """Moves the cursor to the most recent event of the stack."""
+        try:
+            resp = self.client.describe_stack_events(
+                StackName=self.stack_name)
+        except ClientError:
+            return
+        events = resp.get('StackEvents', [])
+        if events:
+            self.since = events[0]['EventId']
+
+    def __iter__(self):
+        """Produces the events that happened since the last read."""
+        for event in stack_events(self.client, self.stack_name,
+                                  since=self.since):
+            self.since = event['EventId']
+            yield event
@@ -14,11 +14,31 @@ class MissingParentLayerError(LoggedException):
     pass
 
 
+class UnknownLayerError(LoggedException):
+    """A layer that is not part of the environment has been requested."""
+    pass
+
+
 class MissingPluginError(LoggedException):
     """A plug-in needs to be installed."""
     pass
 
 
+class MissingDependencyError(LoggedException):
+    """An optional dependency needs to be installed."""
+    pass
+
+
+class VaultError(LoggedException):
+    """A secret in the environment vault cannot be encrypted or decrypted."""
+    pass
+
+
+class CyclicDependencyError(LoggedException):
+    """The layers of an environment depend on each other in a cycle."""
+    pass
+
+
 class TakesTooLongError(LoggedException):
     """It has taken too long for AWS to do something"""
     pass
@@ -1,17 +1,22 @@
 """Humilis Layer."""
 
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
 import itertools
 import os
 import os.path
 import re
 import logging
-import time
-import uuid
+import humilis
+from humilis import cache
+from humilis.clients import get_account_id, get_facade, s3_object_exists
 from humilis.config import config
+from humilis.events import EventStream
+from humilis.stacks import StackIndex
 from humilis.utils import DirTreeBackedObject, get_cf_name
+from humilis.watcher import get_watcher
 from humilis.exceptions import (ReferenceError, CloudformationError,
                                 MissingPluginError)
-import boto3
 from boto3facade.s3 import S3
 from boto3facade.ec2 import Ec2
 from boto3facade.cloudformation import Cloudformation
@@ -21,6 +26,15 @@ import yaml
 import datetime
 from uuid import uuid4
 
+# The largest template that CF accepts in a TemplateBody, in bytes
+TEMPLATE_BODY_MAX_SIZE = 51200
+
+
+def _comparable_tags(tags):
+    """The tags of a stack that have to match for an update to be a no-op."""
+    return {k: str(v) for k, v in tags.items()
+            if k != 'humilis:created' and v is not None}
+
 
 def _is_legacy_reference(value):
     """True if a parameter value is a reference using legacy syntax."""
@@ -34,6 +48,83 @@ def _is_reference(value):
         list(value.keys())[0][0] == '$'
 
 
+def _iter_references(value):
+    """Produces the parser name and parameters of the references in a value."""
+    if isinstance(value, list):
+        for v in value:
+            yield from _iter_references(v)
+    elif _is_reference(value):
+        parsername, parameters = list(value.items())[0]
+        yield parsername[1:], parameters
+    elif _is_legacy_reference(value):
+        yield value['ref']['parser'], value['ref'].get('parameters', {})
+    elif isinstance(value, dict):
+        for v in value.values():
+            yield from _iter_references(v)
+
+
+def _is_hidden_dir(dirname):
+    """True for directories that are not part of a layer's inputs."""
+    return dirname.startswith('__') or dirname.startswith('.')
+
+
+# Jinja2 blocks, and the environment variables that templates read in them
+_JINJA2_BLOCK_RE = re.compile(r'\{\{.*?\}\}|\{%.*?%\}', re.DOTALL)
+_ENV_NAME_RE = re.compile(r'\b(?:_os_env|__env|env)\b')
+_ENV_VAR_RE = re.compile(
+    r'\b(?:_os_env|__env|env)\b\s*(?:'
+    r'\.get\(\s*[\'"]([^\'"]+)[\'"]|'
+    r'\[\s*[\'"]([^\'"]+)[\'"]\s*\]|'
+    r'\.(\w+)\b(?!\s*\())')
+
+
+def _env_var_names(paths):
+    """The environment variables read by the templates under some paths.
+
+    :returns: A set of variable names, or None if a template reads
+        environment variables in a way that can't be analysed, e.g.
+        ``env[name]``.
+    """
+    names = set()
+    for path in paths:
+        if os.path.isfile(path):
+            filepaths = [path]
+        else:
+            filepaths = cache.walk_files(path, exclude_dirs=_is_hidden_dir)
+        for filepath in filepaths:
+            try:
+                with open(filepath, 'r') as f:
+                    text = f.read()
+            except (OSError, UnicodeDecodeError):
+                # Binary files are not templates
+                continue
+            for block in _JINJA2_BLOCK_RE.findall(text):
+                found = _ENV_VAR_RE.findall(block)
+                if len(found) != len(_ENV_NAME_RE.findall(block)):
+                    return None
+                names.update(''.join(groups) for groups in found)
+    return names
+
+
+def _has_reference(value):
+    """True if a parameter value is or contains a reference."""
+    if isinstance(value, list):
+        return any(_has_reference(v) for v in value)
+    elif _is_reference(value) or _is_legacy_reference(value):
+        return True
+    elif isinstance(value, dict):
+        return any(_has_reference(v) for v in value.values())
+    return False
+
+
+# Reference parsers that refer to another layer
+LAYER_PARSERS = {'layer', 'layer_resource', 'layer_output', 'output'}
+
+# Reference parsers that resolve to the same value as long as the local files
+# and the layers they refer to don't change
+STABLE_PARSERS = LAYER_PARSERS | {'file', 'lambda', 'j2_template'}
+
+
 class Layer:
     """A layer of infrastructure that translates into a single CF stack"""
     def __init__(self, __env, __name, layer_type=None, logger=None,
@@ -42,9 +133,11 @@ class Layer:
         self.environment = __env
         if not humilis_profile:
             self.cf = self.environment.cf
+            self.stack_index = self.environment.stack_index
         else:
             config.boto_config.activate_profile(humilis_profile)
-            self.cf = Cloudformation(config.boto_config)
+            self.cf = get_facade(Cloudformation, config.boto_config)
+            self.stack_index = StackIndex(self.cf)
         if logger is None:
             self.logger = logging.getLogger(__name__)
             # To prevent warnings
@@ -55,7 +148,6 @@ class Layer:
         self.env_name = self.environment.name
         self.env_stage = self.environment.stage
         self.env_basedir = self.environment.basedir
-        self.depends_on = []
         self.section = {}
         self.type = layer_type
         self.s3_prefix = "{base}{env}/{stage}/{layer}/".format(
@@ -116,8 +208,14 @@ class Layer:
         for pname, pvalue in user_params.items():
             if pname in self.yaml_params:
                 self.yaml_params[pname]['value'] = pvalue
-        self.__ec2 = None
-        self.__s3 = None
+
+        # The layers in the same environment that this layer refers to
+        self.depends_on = list(self.meta.get('dependencies') or [])
+        values = [v.get('value') for v in self.yaml_params.values()] + \
+            list(user_params.values())
+        for name in self._referenced_layers(values):
+            if name not in self.depends_on:
+                self.depends_on.append(name)
 
     @property
     def termination_protection(self):
@@ -165,7 +263,7 @@ class Layer:
                 'basedir': self.basedir
             },
             'aws': {
-                'account_id': boto3.client('sts').get_caller_identity().get('Account')
+                'account_id': get_account_id(config.boto_config)
             }
         }
 
@@ -176,42 +274,38 @@ class Layer:
     @property
     def in_cf(self):
         """Returns true if the layer has been already deployed to CF."""
-        return self.cf_name in {stk['StackName'] for stk in self.cf.stacks}
+        return self.stack_index.get(self.cf_name) is not None
 
     @property
     def ec2(self):
         """Connection to AWS EC2 service."""
-        if self.__ec2 is None:
-            self.__ec2 = Ec2(config.boto_config)
-        return self.__ec2
+        return get_facade(Ec2, config.boto_config)
 
     @property
     def s3(self):
         """Connection to AWS S3."""
-        if self.__s3 is None:
-            self.__s3 = S3(config.boto_config)
-        return self.__s3
+        return get_facade(S3, config.boto_config)
 
     @property
     def ok(self):
         """Layer is fully deployed in CF and ready for use"""
-        return self.cf.stack_ok(self.cf_name)
+        stack = self.stack_index.get(self.cf_name)
+        return stack is not None and stack['status'] in {
+            'UPDATE_COMPLETE', 'CREATE_COMPLETE', 'UPDATE_ROLLBACK_COMPLETE'}
 
     @property
     def outputs(self):
         """Layer CF outputs."""
-        ly = self.cf.stack_outputs.get(self.cf_name)
-        if ly:
-            ly = {o['OutputKey']: o['OutputValue'] for o in ly}
-        return ly
+        stack = self.stack_index.get(self.cf_name)
+        if stack and stack['outputs']:
+            return dict(stack['outputs'])
 
     @property
     def resources(self):
         """Layer CF resources."""
-        ly = self.cf.get_stack_resources(self.cf_name)
-        if ly:
-            ly = {o.logical_id: o.physical_resource_id for o in ly}
-        return ly
+        resources = self.stack_index.resources(self.cf_name)
+        if resources:
+            return dict(resources)
 
     def compile(self):
         """Loads all files associated to a layer."""
@@ -246,16 +340,52 @@ class Layer:
         """Populates parameters in a layer by resolving references."""
         if len(self.yaml_params) < 1:
             return
-        for pname, param in sorted(self.yaml_params.items(),
-                                   key=lambda t: t[1].get('priority', '1')):
-            self.params[pname] = {}
-            self.params[pname]['description'] = param.get('description', None)
-            try:
-                self.params[pname]['value'] = self._parse_param_value(
-                    param['value'])
-            except:
-                self.logger.error("Error parsing layer '{}'".format(self.name))
-                raise
+        params = sorted(self.yaml_params.items(),
+                        key=lambda t: t[1].get('priority', '1'))
+        for _, group in itertools.groupby(
+                params, key=lambda t: t[1].get('priority', '1')):
+            group = list(group)
+            # Plain values are set first so that they are available to the
+            # references of the same priority, as when parsing was serial
+            literals = [(pname, param) for pname, param in group
+                        if not _has_reference(param.get('value'))]
+            references = [(pname, param) for pname, param in group
+                          if _has_reference(param.get('value'))]
+            for pname, param in literals:
+                self._set_param(pname, param, param.get('value'))
+            values = self._parse_param_values(references)
+            for pname, param in references:
+                self._set_param(pname, param, values[pname])
+
+    def _set_param(self, pname, param, value):
+        """Sets the value of a layer parameter."""
+        self.params[pname] = {}
+        self.params[pname]['description'] = param.get('description', None)
+        self.params[pname]['value'] = value
+
+    def _parse_param_values(self, params):
+        """Parses concurrently the values of params with the same priority."""
+        if len(params) < 2:
+            return {pname: self._parse_param(pname, param)
+                    for pname, param in params}
+        max_workers = int(config.MAX_PARALLEL_REFERENCES)
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        try:
+            futures = [(pname, executor.submit(self._parse_param, pname,
+                                               param))
+                       for pname, param in params]
+            return {pname: future.result() for pname, future in futures}
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def _parse_param(self, pname, param):
+        """Parses the value of a layer parameter."""
+        try:
+            return self._parse_param_value(param['value'])
+        except Exception:
+            self.logger.error("Error parsing parameter '{}' of layer "
+                              "'{}'".format(pname, self.name))
+            raise
 
     def print_params(self):
         """Prints the params used during layer creation."""
@@ -284,21 +414,148 @@ class Layer:
         else:
             return pval
 
+    def _referenced_layers(self, pval):
+        """Names of the layers of this environment a param value refers to."""
+        return [parameters['layer_name'] for parsername, parameters
+                in _iter_references(pval)
+                if self._is_local_layer_reference(parsername, parameters)
+                and parameters.get('layer_name')]
+
+    def _is_local_layer_reference(self, parsername, parameters):
+        """True for references to a layer of this environment and stage."""
+        return parsername in LAYER_PARSERS and \
+            isinstance(parameters, dict) and \
+            parameters.get('environment_name', self.env_name) == \
+            self.env_name and \
+            (parameters.get('stage') or self.env_stage).upper() == \
+            self.env_stage
+
+    def input_digest(self):
+        """A digest of everything the layer is built from.
+
+        That is the layer files, any other local file its references point
+        to, its parameters, tags and notification topics, the stage and the
+        environment variables that its templates read. The outputs of the
+        layers it depends on are not included (see upstream_digest).
+
+        :returns: The hex digest, or None if the layer uses references that
+            may resolve to different values even if none of its inputs
+            changes (e.g. AWS API calls, secrets or other environments), or
+            if its templates read environment variables in ways that can't
+            be analysed.
+        """
+        hasher = cache.new_hasher()
+        hasher.update(json.dumps({
+            'humilis': humilis.__version__,
+            'stage': self.env_stage,
+            'type': self.type,
+            'description': self.environment.meta.get('description'),
+            'tags': _comparable_tags(self.tags),
+            'notification_arns': self.sns_topic_arn,
+            'parameters': self.yaml_params,
+            'user_parameters': self.user_params}, sort_keys=True,
+            default=str).encode())
+        cache.update_digest(hasher, self.basedir, exclude_dirs=_is_hidden_dir)
+        sources = [self.basedir]
+        values = [v.get('value') for v in self.yaml_params.values()] + \
+            list(self.user_params.values())
+        for parsername, parameters in _iter_references(values):
+            if parsername not in STABLE_PARSERS or \
+                    (parsername in LAYER_PARSERS and
+                     not self._is_local_layer_reference(parsername,
+                                                        parameters)):
+                return None
+            if not isinstance(parameters, dict):
+                continue
+            paths = []
+            if parameters.get('path'):
+                paths.append(os.path.join(self.basedir, parameters['path']))
+            for dep in parameters.get('dependencies') or []:
+                paths.append(os.path.join(self.env_basedir, dep))
+            for path in paths:
+                if os.path.exists(path):
+                    hasher.update(path.encode() + b'\0')
+                    cache.update_digest(hasher, path,
+                                        exclude_dirs=_is_hidden_dir)
+                    sources.append(path)
+
+        # Templates are rendered with the environment variables
+        env_var_names = _env_var_names(sources)
+        if env_var_names is None:
+            return None
+        hasher.update(json.dumps({name: os.environ.get(name)
+                                  for name in env_var_names},
+                                 sort_keys=True).encode())
+        return hasher.hexdigest()
+
+    def upstream_digest(self):
+        """A digest of the outputs and resources of the layers it uses."""
+        upstream = {}
+        for name in sorted(self.depends_on):
+            stack_name = get_cf_name(self.env_name, name,
+                                     stage=self.env_stage)
+            stack = self.stack_index.get(stack_name)
+            upstream[name] = stack and {
+                'outputs': stack['outputs'],
+                'resources': self.stack_index.resources(stack_name)}
+        hasher = cache.new_hasher()
+        hasher.update(json.dumps(upstream, sort_keys=True).encode())
+        return hasher.hexdigest()
+
+    @property
+    def stack_version(self):
+        """Identifies the deployed version of the layer stack, if any."""
+        stack = self.stack_index.get(self.cf_name)
+        return stack and stack['updated']
+
     def _resolve_ref(self, parsername, parameters):
         """Resolves references."""
         parser = config.reference_parsers.get(parsername)
         if not parser:
             msg = "Invalid reference parser '{}' in layer '{}'".format(
                 parsername, self.cf_name)
-            raise ReferenceError(ref, msg, logger=self.logger)
+            raise ReferenceError(parsername, msg, logger=self.logger)
         result = parser(self, config.boto_config, **parameters)
         return result
 
-    def delete(self):
-        """Deletes a stack in CF."""
+    def delete(self, wait=False):
+        """Deletes a stack in CF.
+
+        :param wait: If True, wait until the stack has been deleted.
+        """
+        if not self.in_cf:
+            msg = "Stack {} is not in CF: skipping".format(self.cf_name)
+            self.logger.info(msg)
+            return
         msg = "Deleting stack {} from CF".format(self.cf_name)
         self.logger.info(msg)
-        self.cf.delete_stack(self.cf_name)
+        status = self.stack_index.get(self.cf_name)['status']
+        events = self.event_stream()
+        self.cf.client.delete_stack(StackName=self.cf_name)
+        self.stack_index.invalidate(self.cf_name)
+        if wait:
+            self.wait_for_deletion(events=events, initial_status=status)
+
+    def wait_for_deletion(self, events=None, initial_status=None):
+        """Wait until the layer stack has been deleted from CF.
+
+        :param initial_status: The status of the stack before it was deleted.
+            Until CF reports a DELETE_* status, or the stack is gone, it is
+            taken as the deletion not having started yet.
+        """
+        if initial_status is not None and \
+                initial_status.startswith('DELETE_'):
+            # Deleting again a stack whose deletion failed
+            initial_status = None
+        status, _ = self.watch_events(progress_status={'DELETE_IN_PROGRESS'},
+                                      events=events, missing_ok=True,
+                                      initial_status=initial_status)
+        if status not in {None, 'DELETE_COMPLETE'}:
+            msg = "Unable to delete layer '{}': status is {}".format(
+                self.name, status)
+            raise CloudformationError(msg, logger=self.logger)
+        self.stack_index.invalidate(self.cf_name)
+        self.logger.info("Stack {} has been deleted".format(self.cf_name))
 
     def create(self, update=False, debug=False):
         """Deploys a layer as a CF stack."""
@@ -324,6 +581,8 @@ class Layer:
         elif update:
             cf_template = self.compile()
             try:
+                if self.is_deployed(cf_template):
+                    raise NoUpdatesError("Nothing to update")
                 self.create_with_changeset(cf_template, update)
             except NoUpdatesError:
                 msg = "Nothing to update on stack '{}'".format(self.cf_name)
@@ -347,15 +606,52 @@ class Layer:
 
         return self.outputs
 
-    def _upload_cf_template(self, cf_template):
-        """Upload CF template to S3."""
+    def is_deployed(self, cf_template):
+        """True if the layer stack is already deployed as it would be now.
+
+        Compares the CF template with the original template of the stack,
+        and the stack tags (but for the creation timestamp) and notification
+        topics with those of the stack in CF, so that an update that would
+        produce an empty changeset can be skipped.
+        """
+        if not self.ok:
+            return False
+        stack = self.stack_index.get(self.cf_name)
+        if _comparable_tags(stack['tags']) != _comparable_tags(self.tags):
+            return False
+        if sorted(stack['notification_arns']) != \
+                sorted(self.sns_topic_arn or []):
+            return False
+        deployed = self.cf.client.get_template(
+            StackName=self.cf_name,
+            TemplateStage='Original')['TemplateBody']
+        if isinstance(deployed, str):
+            try:
+                deployed = json.loads(deployed)
+            except ValueError:
+                # A YAML template: not deployed by this version of humilis
+                return False
+        # Round trip through JSON, as the template is sent to CF
+        return json.loads(json.dumps(deployed)) == \
+            json.loads(json.dumps(cf_template))
+
+    def _template_source(self, cf_template):
+        """The CreateChangeSet arguments that pass the CF template.
+
+        Small templates are passed inline. Larger ones are uploaded to S3
+        under a hash of their contents, unless they are already there.
+        """
+        body = json.dumps(cf_template, separators=(',', ':'), sort_keys=True)
+        if len(body.encode()) <= TEMPLATE_BODY_MAX_SIZE:
+            return {'TemplateBody': body}
         bucket = config.boto_config.profile.get('bucket')
-        key = "{}{}-{}.json".format(
-            self.s3_prefix, round(time.time()), str(uuid.uuid4()))
-        cf_template = json.dumps(cf_template).encode()
-        S3().resource.Bucket(bucket).put_object(Key=key, Body=cf_template)
-        return "https://s3-{}.amazonaws.com/{}/{}".format(
-            config.boto_config.profile['aws_region'], bucket, key)
+        key = "{}{}.json".format(
+            self.s3_prefix, hashlib.sha256(body.encode()).hexdigest())
+        if not s3_object_exists(config.boto_config, bucket, key):
+            self.s3.client.put_object(Bucket=bucket, Key=key,
+                                      Body=body.encode())
+        return {'TemplateURL': "https://s3-{}.amazonaws.com/{}/{}".format(
+            config.boto_config.profile['aws_region'], bucket, key)}
 
     def create_with_changeset(self, cf_template, update=False):
         """Use a changeset to create a stack."""
@@ -363,26 +659,25 @@ class Layer:
         if update:
             changeset_type = "UPDATE"
         changeset_name = self.cf_name + str(uuid4())
-        template_url = self._upload_cf_template(cf_template)
+        template = self._template_source(cf_template)
+        events = self.event_stream()
         self.cf.client.create_change_set(
             StackName=self.cf_name,
-            TemplateURL=template_url,
             Capabilities=["CAPABILITY_IAM", "CAPABILITY_NAMED_IAM"],
             NotificationARNs=self.sns_topic_arn,
             Tags=[{"Key": k, "Value": v} for k, v in self.tags.items()],
             ChangeSetName=changeset_name,
-            ChangeSetType=changeset_type)
-        self.wait_for_status_change()
-        self.wait_changeset_creation(changeset_name)
-        if update:
-            changeset = self.cf.client.describe_change_set(
-                ChangeSetName=changeset_name,
-                StackName=self.cf_name)
-            if not changeset["Changes"]:
-                raise NoUpdatesError("Nothing to update")
+            ChangeSetType=changeset_type,
+            **template)
+        changeset = self.wait_changeset_creation(changeset_name)
+        if update and not changeset["Changes"]:
+            raise NoUpdatesError("Nothing to update")
         self.cf.client.execute_change_set(ChangeSetName=changeset_name,
                                           StackName=self.cf_name)
-        self.wait_for_status_change()
+        try:
+            self.wait_for_status_change(events=events)
+        finally:
+            self.stack_index.invalidate(self.cf_name)
 
     @staticmethod
     def _is_bad_status(status):
@@ -392,72 +687,81 @@ class Layer:
                                   "REVIEW_IN_PROGRESS",
                                   "UPDATE_ROLLBACK_COMPLETE"}
 
-    def _print_events(self, already_seen=None):
-        """Prints the events reported by AWS."""
-        if already_seen is None:
-            already_seen = set()
+    def event_stream(self, history=False):
+        """A stream of the events of the layer CF stack.
 
-        events = self.cf.get_stack_events(self.cf_name)
-        new_events = [ev for ev in events if ev.id not in already_seen]
+        Iterating over the stream produces the events that happened since the
+        previous iteration, oldest first.
+
+        :param history: If False, skip the events that already happened.
+        """
+        events = EventStream(self.cf.client, self.cf_name)
+        if not history:
+            events.skip_history()
+        return events
+
+    def _print_events(self, events):
+        """Prints the new events in an event stream."""
         cm = config.EVENT_STATUS_COLOR_MAP
-        for event in new_events:
+        for event in events:
             self.logger.info(
-                "{color}{status}\033[0m {restype} {logid} "
+                "[{layer}] {color}{status}\033[0m {restype} {logid} "
                 "{reason}".format(
-                    color=cm.get(event.resource_status, ''),
-                    status=event.resource_status,
-                    restype=event.resource_type,
-                    logid=event.logical_resource_id,
-                    reason=event.resource_status_reason or "",
+                    layer=self.name,
+                    color=cm.get(event['ResourceStatus'], ''),
+                    status=event['ResourceStatus'],
+                    restype=event['ResourceType'],
+                    logid=event['LogicalResourceId'],
+                    reason=event.get('ResourceStatusReason') or "",
                 ))
-            already_seen.add(event.id)
+        return events
 
-        return already_seen
-
-    def wait_for_status_change(self):
+    def wait_for_status_change(self, events=None):
         """Wait for the status deployment state to change."""
-        status, seen_events = self.watch_events()
+        status, _ = self.watch_events(events=events)
         if self._is_bad_status(status):
-            # One retry, also to flush all events
-            status, seen_events = self.watch_events(already_seen=seen_events)
-            if self._is_bad_status(status):
-                # One retry
-                msg = "Unable to deploy layer '{}': status is {}".format(
-                    self.name, status)
-                raise CloudformationError(msg, logger=self.logger)
+            msg = "Unable to deploy layer '{}': status is {}".format(
+                self.name, status)
+            raise CloudformationError(msg, logger=self.logger)
         return status
 
     def watch_events(self,
-                     progress_status={'CREATE_IN_PROGRESS',
+                     progress_status={'REVIEW_IN_PROGRESS',
+                                      'CREATE_IN_PROGRESS',
                                       'UPDATE_IN_PROGRESS',
                                       'UPDATE_COMPLETE_CLEANUP_IN_PROGRESS'},
-                     already_seen=None):
-        """Watches CF events during stack creation."""
-        stack_status = self.cf.get_stack_status(self.cf_name)
-        if already_seen is None:
-            already_seen = set()
-        while (stack_status is None) or (stack_status in progress_status):
-            already_seen = self._print_events(already_seen)
-            time.sleep(5)
-            stack_status = self.cf.get_stack_status(self.cf_name)
-
-        return stack_status, already_seen
+                     events=None, missing_ok=False, initial_status=None):
+        """Watches CF events until the stack leaves the progress status."""
+        if events is None:
+            events = self.event_stream()
+        status = get_watcher().watch_stack(
+            self.cf, self.cf_name, progress_status,
+            on_poll=lambda status: self._print_events(events),
+            missing_ok=missing_ok, initial_status=initial_status).result()
+        # Flush the events produced since the last poll
+        events = self._print_events(events)
+        return status, events
 
     def wait_changeset_creation(self, changeset_name,
                                 progress_status={"CREATE_PENDING",
                                                  "CREATE_IN_PROGRESS"}):
-        """Wait for a changeset to be in the right status to be executed."""
-        status = self.cf.client.describe_change_set(
-            ChangeSetName=changeset_name, StackName=self.cf_name)["Status"]
-        while (status is None) or (status in progress_status):
-            status = self.cf.client.describe_change_set(
-                ChangeSetName=changeset_name, StackName=self.cf_name)["Status"]
-            time.sleep(5)
+        """Wait for a changeset to be in the right status to be executed.
+
+        :returns: The changeset description.
+        """
+        changeset = get_watcher().watch_changeset(
+            self.cf, self.cf_name, changeset_name,
+            progress_status=progress_status).result()
+        status = changeset["Status"]
         if status != "CREATE_COMPLETE":
-            msg = "Unable to deploy layer '{}': changeset status is {}".format(
-                self.name, status)
+            reason = changeset.get("StatusReason") or ""
+            if reason.find("didn't contain changes") > -1 or \
+                    reason.find("No updates") > -1:
+                raise NoUpdatesError(reason)
+            msg = ("Unable to deploy layer '{}': changeset status is {} "
+                   "({})").format(self.name, status, reason)
             raise CloudformationError(msg, logger=self.logger)
-        return status
+        return changeset
 
     def __repr__(self):
         return str(self)
@@ -0,0 +1,125 @@
+"""Discovery of the plugins that extend humilis."""
+
+import collections.abc
+import hashlib
+import importlib.metadata
+import json
+import os
+import sys
+import tempfile
+import threading
+
+
+_lock = threading.Lock()
+_indexes = {}
+
+
+def _distributions_fingerprint():
+    """Changes whenever a distribution is installed, upgraded or removed."""
+    hasher = hashlib.sha256(sys.version.encode())
+    for path in sys.path:
+        try:
+            entries = sorted(os.scandir(path or '.'), key=lambda e: e.name)
+        except OSError:
+            continue
+        hasher.update(os.path.abspath(path or '.').encode() + b'\0')
+        for entry in entries:
+            if entry.name.endswith(('.dist-info', '.egg-info', '.egg-link',
+                                    '.pth')):
+                hasher.update("{}\0{}\0".format(
+                    entry.name, entry.stat().st_mtime_ns).encode())
+    return hasher.hexdigest()
+
+
+def _scan_entry_points(groups):
+    """The entry points of some groups, as {group: {name: value}}."""
+    all_entry_points = importlib.metadata.entry_points()
+    index = {}
+    for group in groups:
+        if hasattr(all_entry_points, 'select'):
+            entry_points = all_entry_points.select(group=group)
+        else:
+            # Python < 3.10
+            entry_points = all_entry_points.get(group, [])
+        index[group] = {ep.name: ep.value for ep in entry_points}
+    return index
+
+
+def entry_point_index(groups, cache_dir=None):
+    """The entry points of some groups, as {group: {name: value}}.
+
+    Scanning the metadata of every installed distribution is slow, so the
+    index is kept on disk, under a fingerprint of the installed
+    distributions, and it is only rebuilt when they change.
+
+    :param groups: The entry point groups to index.
+    :param cache_dir: Where to keep the index. If None it is not persisted.
+    """
+    groups = tuple(sorted(groups))
+    key = (groups, cache_dir)
+    with _lock:
+        if key in _indexes:
+            return _indexes[key]
+        index = None
+        if cache_dir:
+            path = os.path.join(cache_dir, "entry-points-{}.json".format(
+                _distributions_fingerprint()))
+            try:
+                with open(path, 'r') as f:
+                    index = json.load(f)
+            except (OSError, ValueError):
+                pass
+        if index is None or set(index) != set(groups):
+            index = _scan_entry_points(groups)
+            if cache_dir:
+                try:
+                    os.makedirs(cache_dir, exist_ok=True)
+                    fd, tmppath = tempfile.mkstemp(dir=cache_dir)
+                    with os.fdopen(fd, 'w') as f:
+                        json.dump(index, f)
+                    os.replace(tmppath, path)
+                except OSError:
+                    # The index is only an optimization
+                    pass
+        _indexes[key] = index
+        return index
+
+
+class EntryPointMap(collections.abc.Mapping):
+    """The entry points of a group, by name, loaded on first access.
+
+    :param group: The entry point group.
+    :param groups: All the groups to index at once with this one.
+    :param cache_dir: Where the entry point index is kept.
+    :param call: If True, the value of an entry point is the result of
+        calling the object it points to.
+    """
+    def __init__(self, group, groups=(), cache_dir=None, call=False):
+        self.group = group
+        self.groups = set(groups) | {group}
+        self.cache_dir = cache_dir
+        self.call = call
+        self._loaded = {}
+        self._lock = threading.Lock()
+
+    @property
+    def _entry_points(self):
+        return entry_point_index(self.groups, self.cache_dir)[self.group]
+
+    def __getitem__(self, name):
+        with self._lock:
+            if name not in self._loaded:
+                value = self._entry_points[name]
+                obj = importlib.metadata.EntryPoint(
+                    name=name, value=value, group=self.group).load()
+                self._loaded[name] = obj() if self.call else obj
+            return self._loaded[name]
+
+    def __contains__(self, name):
+        return name in self._entry_points
+
+    def __iter__(self):
+        return iter(self._entry_points)
+
+    def __len__(self):
+        return len(self._entry_points)
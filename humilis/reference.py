@@ -1,24 +1,32 @@
 """Built-in reference parsers."""
 
+from concurrent.futures import ThreadPoolExecutor
 import contextlib
 import os
 import importlib
 import shutil
-import subprocess
 import sys
+import sysconfig
 import tempfile
 import uuid
-from zipfile import ZipFile
-
-import boto3facade
-from boto3facade.s3 import S3
-from boto3facade.cloudformation import Cloudformation
-import jinja2
-from s3keyring.s3 import S3Keyring
 
+from humilis import cache, secrets
+import humilis.config
+from humilis.config import as_bool
 from humilis.exceptions import ReferenceError, InvalidLambdaDependencyError
 import humilis.utils as utils
 
+# Only this many bytes at the start of a file are searched for the jinja2
+# preprocessor marker
+TEMPLATE_HEADER_SIZE = 4096
+
+# Files that are never Jinja2 templates
+BINARY_EXTENSIONS = {'.pyc', '.pyo', '.so', '.pyd', '.zip', '.gz', '.whl',
+                     '.jar', '.png', '.jpg', '.gif', '.pdf'}
+
+# Bump to invalidate cached lambda packages when the package format changes
+PACKAGE_FORMAT = 4
+
 
 def _get_s3path(layer, config, full_path):
     """Returns the S3 target (bucket, key) for a local file."""
@@ -39,6 +47,9 @@ def _get_s3path(layer, config, full_path):
 def secret(layer, config, service=None, key=None, group=None, kms_key_id=None):
     """Retrieves a secret stored in a S3 keyring.
 
+    The secrets of a group are fetched together and memoized for the rest of
+    the run (in memory only).
+
     :param service: An alias of group, for backwards compatibility
     :param key: The key used to identify the secret within the server
     :param group: The name of the group of secrets
@@ -50,15 +61,13 @@ def secret(layer, config, service=None, key=None, group=None, kms_key_id=None):
         group = service
 
     s3keyring_config = os.path.join(layer.env_basedir, ".s3keyring.ini")
-    if os.path.isfile(s3keyring_config):
-        kr = S3Keyring(config_file=s3keyring_config)
-    else:
-        kr = S3Keyring()
+    if not os.path.isfile(s3keyring_config):
+        s3keyring_config = None
 
-    secret = kr.get_password(group, key)
     if kms_key_id:
-        return boto3.client('kms').encrypt(KeyId=kms_key_id, Plaintext=secret)
-    return secret
+        return secrets.resolver.get_encrypted(config, s3keyring_config, group,
+                                              key, kms_key_id)
+    return secrets.resolver.get(s3keyring_config, group, key)
 
 
 def file(layer, config, path=None):
@@ -72,39 +81,237 @@ def file(layer, config, path=None):
     """
     full_path = os.path.join(layer.basedir, path)
     s3bucket, s3key = _get_s3path(layer, config, full_path)
-    s3 = S3(config)
+    _upload(layer, config, full_path, s3bucket, s3key)
+    return _s3_reference(layer, s3bucket, s3key)
+
+
+def _upload(layer, config, full_path, s3bucket, s3key):
+    """Uploads a local file to S3."""
+    from boto3facade.s3 import S3
+    from humilis.clients import get_facade
+    s3 = get_facade(S3, config)
     s3.cp(full_path, s3bucket, s3key)
     layer.logger.info("{} -> {}/{}".format(full_path, s3bucket, s3key))
+
+
+def _s3_reference(layer, s3bucket, s3key):
+    """The value that a reference to an object in S3 evaluates to."""
     if layer.type == "sam":
         return os.path.join("s3://", s3bucket, s3key)
     else:
         return {'s3bucket': s3bucket, 's3key': s3key}
 
 
-def lambda_ref(layer, config, path=None, dependencies=None, **params):
+def lambda_ref(layer, config, path=None, dependencies=None,
+               compression=None, compresslevel=None, **params):
     """Prepares a lambda deployment package and uploads it to S3.
 
     :param layer: The Layer object for the layer declaring the reference.
     :param config: An object holding humilis configuration options.
     :param path: Path to the file, relative to the location of meta.yaml.
     :param dependencies: A list of Python dependencies.
+    :param compression: The zip compression method: stored or deflated.
+    :param compresslevel: The zlib compression level, from 0 to 9.
 
     :returns: S3 path where the deployment package has been uploaded.
     """
     fpath = os.path.abspath(os.path.join(layer.basedir, path))
     logger = layer.logger
+    basename = os.path.basename(fpath)
+    if not os.path.isdir(fpath):
+        basename, ext = os.path.splitext(basename)
+        if ext == '.zip':
+            return file(layer, config, fpath)
+
+    from humilis.archive import COMPRESSION_METHODS
+
+    defaults = humilis.config.config
+    archive_options = {
+        'compression': compression or defaults.LAMBDA_COMPRESSION,
+        'compresslevel': int(compresslevel if compresslevel is not None
+                             else defaults.LAMBDA_COMPRESSLEVEL),
+        'deterministic': as_bool(defaults.LAMBDA_DETERMINISTIC_ARCHIVES)}
+    if archive_options['compression'] not in COMPRESSION_METHODS:
+        msg = "Unsupported compression '{}': use one of {}".format(
+            archive_options['compression'], sorted(COMPRESSION_METHODS))
+        raise ReferenceError("lambda '{}'".format(path), msg,
+                             logger=logger)
+
+    # Packages are named after the hash of their contents, so that unchanged
+    # packages don't need to be built or uploaded again
+    template_params = layer.loader_params
+    template_params.update(params)
+    rendered = _render_sources(fpath, template_params)
+    digest = _package_digest(fpath, layer, dependencies, rendered,
+                             archive_options)
+    zip_name = "{}-{}.zip".format(basename, digest)
+    use_cache = as_bool(defaults.LAMBDA_PACKAGE_CACHE)
+    key_from_archive = as_bool(defaults.LAMBDA_KEY_FROM_ARCHIVE)
+    if use_cache and not key_from_archive:
+        from humilis.clients import s3_object_exists
+        s3bucket, s3key = _get_s3path(layer, config, zip_name)
+        if s3_object_exists(config, s3bucket, s3key):
+            logger.info("Package for '{}' already in {}/{}".format(
+                fpath, s3bucket, s3key))
+            return _s3_reference(layer, s3bucket, s3key)
+
+    cached = use_cache and cache.get_file('lambda', zip_name)
+    if cached:
+        logger.info("Using cached package for '{}'".format(fpath))
+        return _publish_package(layer, config, cached, basename, digest)
+
     if os.path.isdir(fpath):
-        with _deploy_package(fpath, layer, logger, dependencies, params) as fpath:
-            s3path = file(layer, config, fpath)
+        package = _deploy_package(fpath, layer, logger, dependencies,
+                                  rendered, archive_options)
     else:
-        path_no_ext, ext = os.path.splitext(fpath)
-        if ext == '.zip':
-            s3path = file(layer, config, fpath)
+        package = _simple_deploy_package(fpath, layer, logger, rendered,
+                                         archive_options)
+    with package as zipfile:
+        if use_cache:
+            cache.put_file('lambda', zip_name, zipfile)
+        return _publish_package(layer, config, zipfile, basename, digest)
+
+
+def _publish_package(layer, config, zipfile, basename, digest):
+    """Uploads a lambda deployment package to S3.
+
+    :param digest: The digest of the package inputs, used in the S3 key
+        unless keys are derived from the package contents. In that case the
+        upload is skipped if the package is already in S3.
+    """
+    key_from_archive = as_bool(humilis.config.config.LAMBDA_KEY_FROM_ARCHIVE)
+    if key_from_archive:
+        hasher = cache.new_hasher()
+        cache.update_digest(hasher, zipfile)
+        digest = hasher.hexdigest()
+    s3bucket, s3key = _get_s3path(layer, config,
+                                  "{}-{}.zip".format(basename, digest))
+    from humilis.clients import s3_object_exists
+    if key_from_archive and s3_object_exists(config, s3bucket, s3key):
+        layer.logger.info("Package {} already in {}/{}".format(
+            zipfile, s3bucket, s3key))
+    else:
+        _upload(layer, config, zipfile, s3bucket, s3key)
+    return _s3_reference(layer, s3bucket, s3key)
+
+
+def _is_excluded_dir(dirname):
+    """True for directories that are not included in lambda packages."""
+    return dirname.startswith('__') or dirname.startswith('.')
+
+
+def _package_digest(path, layer, dependencies, rendered, archive_options):
+    """A hash of everything that goes into a lambda deployment package.
+
+    Templated files are hashed after rendering them, local dependencies are
+    hashed by contents and any other dependency by its specification.
+    """
+    hasher = cache.new_hasher()
+    hasher.update("{}\0{}\0{}\0{}\0{}\0{}\0".format(
+        PACKAGE_FORMAT, sys.version_info[:2], sysconfig.get_platform(),
+        archive_options['compression'], archive_options['compresslevel'],
+        archive_options['deterministic']).encode())
+    for arcname, filepath in _source_files(path):
+        hasher.update(arcname.encode() + b'\0')
+        if arcname in rendered:
+            hasher.update(rendered[arcname].encode())
         else:
-            with _simple_deploy_package(fpath, layer, logger, params) as fpath:
-                s3path = file(layer, config, fpath)
+            cache.update_digest(hasher, filepath)
+        hasher.update(b'\0')
+
+    for dep in dependencies or []:
+        hasher.update(dep.encode() + b'\0')
+        deppath = os.path.abspath(os.path.join(layer.env_basedir, dep))
+        if os.path.exists(deppath):
+            cache.update_digest(hasher, deppath,
+                                exclude_dirs=_is_excluded_dir)
+            hasher.update(b'\0')
+    return hasher.hexdigest()
+
+
+def _run_pip(args, path):
+    """Runs pip install with the given args and target directory."""
+    import subprocess
+    subprocess.check_call([sys.executable, '-m', 'pip', 'install'] + args +
+                          ['-t', path])
+
+
+def _pip_install(args, path, key=None):
+    """Runs pip install with the given args and the given target path.
+
+    :param args: The pip install arguments, other than the target.
+    :param path: The target directory.
+    :param key: Identifies what is installed, for installs that can be
+        reused across runs from the dependency cache. None if the result of
+        the install cannot be reused.
+    """
+    # Bytecode embeds timestamps: Lambda compiles what it needs anyway
+    args = args + ['--no-compile']
+    use_cache = as_bool(humilis.config.config.DEPENDENCY_CACHE)
+    if key is None or not use_cache:
+        _run_pip(args, path)
+        return
+
+    hasher = cache.new_hasher()
+    hasher.update("{}\0{}\0{}\0{}\0".format(
+        PACKAGE_FORMAT, sys.implementation.name, sys.version_info[:2],
+        sysconfig.get_platform()).encode())
+    hasher.update(key)
+    name = hasher.hexdigest()
+    cached = cache.get_tree('deps', name)
+    if cached is None:
+        with cache.put_tree('deps', name) as tmppath:
+            _run_pip(args, tmppath)
+        cached = cache.get_tree('deps', name)
+    # Like pip, replace what is already installed only when upgrading
+    cache.copy_tree(cached, path, replace='--upgrade' in args)
+
+
+def _tree_key(*paths):
+    """A dependency cache key for the contents of local files or dirs."""
+    hasher = cache.new_hasher()
+    for path in paths:
+        cache.update_digest(hasher, path, exclude_dirs=_is_excluded_dir)
+        hasher.update(b'\0')
+    return hasher.digest()
+
+
+def _is_pinned(requirement):
+    """True if a requirement always installs the same release from an index.
+
+    Requirements installed from VCS, URLs or local paths, and those that
+    don't pin an exact version, may install different code over time.
+    """
+    requirement = requirement.split(';')[0].strip()
+    if '://' in requirement or '@' in requirement or \
+            requirement.startswith(('.', '/', '~')) or \
+            requirement.endswith(('.whl', '.zip', '.tar.gz')):
+        return False
+    return '==' in requirement and '*' not in requirement
 
-    return s3path
+
+def _requirements_key(path):
+    """A dependency cache key for a requirements file.
+
+    :returns: None if the requirements file can't be cached: it installs
+        unpinned requirements, or requirements from VCS, URLs, local paths
+        or other requirements files.
+    """
+    with open(path, 'r') as f:
+        lines = f.read().replace('\\\n', ' ').splitlines()
+    for line in lines:
+        line = line.split(' #')[0].strip()
+        if not line or line.startswith('#'):
+            continue
+        if line.startswith('-'):
+            # Options: those that install other things can't be cached
+            if line.startswith(('-e', '--editable', '-r', '--requirement',
+                                '-c', '--constraint')):
+                return None
+            continue
+        if not _is_pinned(line.split(' --')[0]):
+            return None
+    return b'-r\0' + _tree_key(path)
 
 
 def _install_dependencies(layer, path, dependencies):
@@ -119,137 +326,219 @@ def _install_dependencies(layer, path, dependencies):
                 shutil.copyfile(deppath, targetpath)
             elif ext == ".txt":
                 # A requirements file
-                subprocess.check_call([sys.executable, '-m', 'pip',
-                                       'install', '-r', deppath, '-t', path])
+                _pip_install(['-r', deppath], path,
+                             key=_requirements_key(deppath))
             else:
                 raise InvalidLambdaDependencyError(dep)
         elif os.path.isdir(deppath):
             if os.path.isfile(os.path.join(deppath, "setup.py")):
-                # A local pip installable
-                subprocess.check_call([sys.executable, '-m', 'pip',
-                                       'install', deppath, '-t', path])
+                # A local pip installable: its requirements may not be
+                # pinned, so it is never cached
+                _pip_install([deppath], path)
             else:
                 # A self-contained Python package
                 shutil.copytree(deppath, targetpath)
         else:
             if dep.find("git+") >= 0:
-                # A git repo
-                subprocess.check_call([sys.executable, '-m', 'pip',
-                                       'install', '-e', dep, '-t', path])
+                # A git repo: the ref may move, so it is never cached
+                _pip_install(['-e', dep], path)
             elif dep.find(":") < 0:
-                # A Pypi package
-                subprocess.check_call([sys.executable, '-m', 'pip',
-                                       'install', dep, '-t', path, '--upgrade'])
+                # A Pypi package: only pinned releases are cached
+                _pip_install([dep, '--upgrade'], path,
+                             key=b'pypi\0' + dep.encode()
+                             if _is_pinned(dep) else None)
             else:
                 # A private index package
                 index = ":".join(dep.split(":")[:-1])
-                subprocess.check_call([
-                    sys.executable, '-m', 'pip',
-                    'install', '-i', index, dep, '-t', path, '--upgrade'])
+                _pip_install(['-i', index, dep, '--upgrade'], path,
+                             key=b'index\0' + dep.encode()
+                             if _is_pinned(dep.split(":")[-1]) else None)
+
+
+def _source_files(path):
+    """Produces the archive name and path of each file of a lambda's source.
+
+    Directories named __* or .* are skipped.
+    """
+    if not os.path.isdir(path):
+        yield os.path.basename(path), path
+        return
+    for filepath in cache.walk_files(path, exclude_dirs=_is_excluded_dir):
+        yield os.path.relpath(filepath, path), filepath
+
+
+def _render_sources(path, params):
+    """Renders, in parallel, the Jinja2 templates among a lambda's sources.
+
+    :returns: The rendered templates, by archive name.
+    """
+    def render(source):
+        arcname, filepath = source
+        if _is_jinja2_template(filepath):
+            return arcname, _render_template(filepath, params)
+        return arcname, None
+
+    sources = list(_source_files(path))
+    if len(sources) < 2:
+        results = [render(source) for source in sources]
+    else:
+        max_workers = int(humilis.config.config.MAX_PARALLEL_RENDERING)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(render, sources))
+    return {arcname: text for arcname, text in results if text is not None}
+
+
+def _write_source(archive, path, rendered):
+    """Adds a lambda's source files to an archive.
+
+    :param rendered: The rendered Jinja2 templates, by archive name.
+
+    :returns: The set of archive names that have been written.
+    """
+    written = set()
+    for arcname, filepath in _source_files(path):
+        if arcname in rendered:
+            archive.add(filepath, arcname, data=rendered[arcname])
+        else:
+            archive.add(filepath, arcname)
+        written.add(arcname)
+    return written
+
+
+def _render_tree(path, targetpath, rendered):
+    """Writes a rendered copy of a lambda's source tree, for pip to install."""
+    for arcname, filepath in _source_files(path):
+        target = os.path.join(targetpath, arcname)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if arcname in rendered:
+            with open(target, 'w') as f:
+                f.write(rendered[arcname])
+            shutil.copymode(filepath, target)
+        else:
+            shutil.copy2(filepath, target)
+
+
+def _is_direct_url(arcname):
+    """True for the pip metadata that records where a dist was installed from.
+
+    For local dependencies that is a temporary path, which would make
+    packages differ from build to build.
+    """
+    return arcname.endswith('.dist-info/direct_url.json')
+
+
+def _is_dist_record(arcname):
+    """True for the list of installed files of a dist."""
+    return arcname.endswith('.dist-info/RECORD')
+
+
+def _strip_direct_url(path):
+    """The contents of a dist RECORD file, without its direct_url.json."""
+    with open(path, 'rb') as f:
+        return b''.join(line for line in f
+                        if not line.split(b',')[0].endswith(
+                            b'.dist-info/direct_url.json'))
 
 
 @contextlib.contextmanager
-def _deploy_package(path, layer, logger, dependencies, params):
-    """Creates a deployment package for multi-file lambda with deps."""
-    with utils.move_aside(path) as tmppath:
-        # removes __* and .* dirs
-        _cleanup_dir(tmppath)
-        # render Jinja2 templated files
-        template_params = layer.loader_params
-        template_params.update(params)
-        _preprocess_dir(tmppath, template_params)
-        setup_file = os.path.join(tmppath, 'setup.py')
-        if os.path.isfile(setup_file):
-            # Install all depedendencies in the same dir
-            subprocess.check_call([sys.executable, '-m', 'pip',
-                                   'install', tmppath, '-t', tmppath])
-        requirements_file = os.path.join(tmppath, 'requirements.txt')
+def _deploy_package(path, layer, logger, dependencies, rendered,
+                    archive_options):
+    """Creates a deployment package for multi-file lambda with deps.
+
+    The source tree is read only once, when it is written to the archive.
+    Dependencies are installed in a separate directory, and files from the
+    source tree take precedence over dependency files with the same name.
+    """
+    from humilis.archive import ArchiveWriter
+
+    logger.info("Creating deployment package for '{}'".format(path))
+    tmpdir = tempfile.mkdtemp()
+    try:
+        depsdir = os.path.join(tmpdir, 'deps')
+        os.makedirs(depsdir)
+        if os.path.isfile(os.path.join(path, 'setup.py')):
+            # pip can only install the rendered source tree from disk. Its
+            # requirements may not be pinned, so it is never cached
+            srcdir = os.path.join(tmpdir, 'src')
+            _render_tree(path, srcdir, rendered)
+            _pip_install([srcdir], depsdir)
+        requirements_file = os.path.join(path, 'requirements.txt')
         if os.path.isfile(requirements_file):
-            subprocess.check_call([
-                sys.executable, '-m', 'pip',
-                'install', '-r', requirements_file, '-t', tmppath])
+            if 'requirements.txt' in rendered:
+                requirements_file = os.path.join(tmpdir, 'requirements.txt')
+                with open(requirements_file, 'w') as f:
+                    f.write(rendered['requirements.txt'])
+            _pip_install(['-r', requirements_file], depsdir,
+                         key=_requirements_key(requirements_file))
 
         if dependencies:
-            _install_dependencies(layer, tmppath, dependencies)
+            _install_dependencies(layer, depsdir, dependencies)
 
-        suffix = str(uuid.uuid4())
-        tmpdir = tempfile.mkdtemp()
         basename = os.path.basename(path)
-        zipfile = os.path.join(tmpdir, "{}{}{}".format(basename, suffix,
-                                                       '.zip'))
-        with ZipFile(zipfile, 'w') as myzip:
-            utils.zipdir(tmppath, myzip)
+        zipfile = os.path.join(tmpdir, "{}{}".format(basename, '.zip'))
+        with ArchiveWriter(zipfile, **archive_options) as archive:
+            written = _write_source(archive, path, rendered)
+            for filepath in cache.walk_files(depsdir):
+                arcname = os.path.relpath(filepath, depsdir)
+                if arcname in written or _is_direct_url(arcname):
+                    continue
+                if _is_dist_record(arcname):
+                    archive.add(filepath, arcname,
+                                data=_strip_direct_url(filepath))
+                else:
+                    archive.add(filepath, arcname)
         yield zipfile
+    finally:
         shutil.rmtree(tmpdir)
 
 
-def _cleanup_dir(path):
-    """Removes __* and .* dirs."""
-    to_remove = []
-    for root, dirs, files in os.walk(path):
-        for dirpath in dirs:
-            if dirpath.startswith('__') or dirpath.startswith('.'):
-                to_remove.append(os.path.join(root, dirpath))
-    for dirpath in to_remove:
-        shutil.rmtree(dirpath, ignore_errors=True)
-
-
 @contextlib.contextmanager
-def _simple_deploy_package(path, layer, logger, params):
+def _simple_deploy_package(path, layer, logger, rendered,
+                           archive_options):
     """Creates a deployment package for a one-file no-deps lambda."""
+    from humilis.archive import ArchiveWriter
+
     logger.info("Creating deployment package for '{}'".format(path))
-    with utils.move_aside(path) as tmppath:
-        template_params = layer.loader_params
-        template_params.update(params)
-        _preprocess_file(tmppath, template_params)
-        path_no_ext, ext = os.path.splitext(tmppath)
-        basename = os.path.basename(path_no_ext)
-        gc = _git_head()
-        suffix = ('-' + gc, '')[gc is None]
-        tmpdir = tempfile.mkdtemp()
-        zipfile = os.path.join(tmpdir,
-                               "{}{}{}".format(basename, suffix, '.zip'))
-        with ZipFile(zipfile, 'w') as myzip:
-            myzip.write(tmppath, arcname=basename + ext)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        basename = os.path.splitext(os.path.basename(path))[0]
+        zipfile = os.path.join(tmpdir, "{}{}".format(basename, '.zip'))
+        with ArchiveWriter(zipfile, **archive_options) as archive:
+            _write_source(archive, path, rendered)
         yield zipfile
+    finally:
         shutil.rmtree(tmpdir)
 
 
 def _is_jinja2_template(path):
-    """Returns true if a file contains a jinja2 template."""
+    """Returns true if a file contains a jinja2 template.
+
+    Templates are marked with a '# preprocessor:jinja2' comment line, which
+    must be within the first TEMPLATE_HEADER_SIZE bytes of the file. Binary
+    files and installed packages are never templates.
+    """
     _, ext = os.path.splitext(path)
-    if ext in {'.pyc'}:
+    if ext in BINARY_EXTENSIONS:
+        return False
+    parts = path.split(os.sep)
+    if 'site-packages' in parts or any(
+            part.endswith(('.dist-info', '.egg-info')) for part in parts):
         return False
 
-    result = False
-    with open(path, 'r') as f:
-        for line in f:
-            if line.startswith('#') and line.find('preprocessor:jinja2'):
-                result = True
-                break
-    return result
+    with open(path, 'rb') as f:
+        header = f.read(TEMPLATE_HEADER_SIZE)
+    if b'\0' in header:
+        return False
+    return any(line.lstrip().startswith(b'#') and
+               b'preprocessor:jinja2' in line
+               for line in header.splitlines())
 
 
-def _preprocess_file(path, params):
-    """Render in place a jinja2 template."""
-    if not _is_jinja2_template(path):
-        return
+def _render_template(path, params):
+    """Renders a jinja2 template file."""
     basedir, filename = os.path.split(path)
-    env = jinja2.Environment(
-        loader=jinja2.FileSystemLoader(basedir))
-    # Add custom functions and filters
-    utils.update_jinja2_env(env)
-    result = env.get_template(filename).render(params)
-    with open(path, 'w') as f:
-        f.write(result)
-
-
-def _preprocess_dir(path, params):
-    """Preprocesses all files in a directory using Jinja2."""
-    for root, dirs, files in os.walk(path):
-        for file in files:
-            filepath = os.path.join(root, file)
-            _preprocess_file(filepath, params)
+    env = utils.get_jinja2_env(basedir)
+    return env.get_template(filename).render(params)
 
 
 def layer(layer, config, layer_name=None, resource_name=None,
@@ -314,17 +603,17 @@ def _get_stack_resource(layer, config, stack_name, resource_name):
 
     :returns: The physical ID of the resource.
     """
-    cf = Cloudformation(config)
-    resource = cf.get_stack_resource(stack_name, resource_name)
+    resources = layer.stack_index.resources(stack_name)
+    if resources is None:
+        msg = "Cannot find stack '{}' in CloudFormation".format(stack_name)
+        raise ReferenceError(resource_name, msg, logger=layer.logger)
 
-    if len(resource) < 1:
-        all_stack_resources = [x.logical_resource_id for x
-                               in cf.get_stack_resources(stack_name)]
+    if resource_name not in resources:
         msg = "{} does not exist in stack {} (with resources {}).".format(
-            resource_name, stack_name, all_stack_resources)
+            resource_name, stack_name, list(resources))
         raise ReferenceError(resource_name, msg, logger=layer.logger)
 
-    return resource[0].physical_resource_id
+    return resources[resource_name]
 
 
 def output(layer, config, layer_name=None, output_name=None,
@@ -343,24 +632,20 @@ def output(layer, config, layer_name=None, output_name=None,
         stage = layer.env_stage
 
     stack_name = utils.get_cf_name(environment_name, layer_name, stage=stage)
-    cf = Cloudformation(config)
-    try:
-        output = cf.get_stack_output(stack_name, output_name)
-    except AttributeError:
+    stack = layer.stack_index.get(stack_name)
+    if stack is None:
         msg = "No output '{}' in CF stack '{}'".format(output_name, stack_name)
         ref = "output/{}/{}/{}/{}".format(environment_name, layer_name, stage,
                                           output_name)
         raise ReferenceError(ref, msg)
-    if len(output) < 1:
-        all_stack_outputs = [x['OutputKey'] for x
-                             in cf.stack_outputs[stack_name]]
+    if output_name not in stack['outputs']:
         msg = ("{} output does not exist for stack {} "
                "(with outputs {}).").format(output_name,
                                             stack_name,
-                                            all_stack_outputs)
+                                            list(stack['outputs']))
         ref = "output ({}/{})".format(layer_name, output_name)
         raise ReferenceError(ref, msg, logger=layer.logger)
-    return output[0]
+    return stack['outputs'][output_name]
 
 
 def boto3(layer, config, service=None, call=None, output_attribute=None,
@@ -377,16 +662,21 @@ def boto3(layer, config, service=None, call=None, output_attribute=None,
     :returns: The call response, or its corresp. attribute or key.
     """
     facade_name = service.title()
-    if not hasattr(boto3facade, service):
+    try:
+        # Facade modules are imported only when a reference uses them
+        module = importlib.import_module("boto3facade.{}".format(service))
+    except ImportError:
+        module = None
+    if not hasattr(module, facade_name):
         ref = "boto3facade.{}.{}.{}: {}".format(service, facade_name,
                                                 call['method'],
                                                 call['parameters'])
         msg = "Service {} not supported".format(service)
         raise ReferenceError(ref, msg, logger=layer.logger)
 
-    module = importlib.import_module("boto3facade.{}".format(service))
+    from humilis.clients import get_facade
     facade_cls = getattr(module, facade_name)
-    facade = facade_cls(config)
+    facade = get_facade(facade_cls, config)
     method = getattr(facade, call['method'])
     args = call.get('args', [])
     kwargs = call.get('kwargs', {})
@@ -436,8 +726,7 @@ def j2_template(layer, config, path=None, s3_upload=False, params=None):
 
     _, ext = os.path.splitext(basefile)
     _, filename = os.path.split(path)
-    env = jinja2.Environment(
-        loader=jinja2.FileSystemLoader(layer.basedir))
+    env = utils.get_jinja2_env(layer.basedir)
     result = env.get_template(filename).render(params)
     output_path = os.path.join(layer.env_basedir, "ref-j2_template_" +
                                str(uuid.uuid4()) + ext)
@@ -445,9 +734,7 @@ def j2_template(layer, config, path=None, s3_upload=False, params=None):
         f.write(result)
     if s3_upload:
         s3bucket, s3key = _get_s3path(layer, config, output_path)
-        s3 = S3(config)
-        s3.cp(output_path, s3bucket, s3key)
-        layer.logger.info("{} -> {}/{}".format(output_path, s3bucket, s3key))
+        _upload(layer, config, output_path, s3bucket, s3key)
         return os.path.join("s3://", s3bucket, s3key)
 
     return output_path
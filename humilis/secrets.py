@@ -0,0 +1,143 @@
+"""Secrets stored in S3 keyrings, resolved once per humilis run."""
+
+import base64
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+from humilis.config import config
+
+# The S3 key of a secret is {namespace}/{group}/{key}/secret.b64
+SECRET_SUFFIX = '/secret.b64'
+
+
+class _Keyring:
+    """A S3 keyring, and where its secrets are stored.
+
+    The keyring settings are global to the s3keyring package, so they are
+    captured when the keyring is created.
+    """
+    def __init__(self, config_file):
+        from s3keyring.s3 import S3Keyring
+        self.keyring = S3Keyring(config_file=config_file)
+        self.client = self.keyring.s3.client
+        self.bucket = self.keyring.bucket.name
+        self.namespace = self.keyring.namespace
+        self.escape = _s3_escape(self.keyring)
+
+
+def _s3_escape(keyring):
+    """The function s3keyring uses to escape groups and keys in S3 keys.
+
+    :returns: None if s3keyring does not store the secrets where they can be
+        listed by group, and they must be read one by one with get_password.
+    """
+    try:
+        from s3keyring.s3 import _escape_for_s3
+    except ImportError:
+        return None
+    get_s3_key = getattr(keyring, '_get_s3_key', None)
+    expected = "{}/group/key{}".format(keyring.namespace, SECRET_SUFFIX)
+    if get_s3_key is None or get_s3_key('group', 'key') != expected:
+        return None
+    return _escape_for_s3
+
+
+class SecretResolver:
+    """Retrieves secrets from S3 keyrings, memoizing them for the run.
+
+    A single keyring is used for each keyring configuration file. The first
+    time a secret of a group is requested, all the secrets of the group are
+    listed and fetched concurrently. With s3keyring versions that store
+    secrets elsewhere, each secret is read through the keyring instead.
+    Secrets, and their KMS-encrypted versions, are kept in memory and never
+    written to disk.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keyrings = {}
+        self._group_locks = {}
+        self._groups = {}
+        self._encrypted = {}
+
+    def _get_keyring(self, config_file):
+        with self._lock:
+            if config_file not in self._keyrings:
+                self._keyrings[config_file] = _Keyring(config_file)
+            return self._keyrings[config_file]
+
+    def _group_lock(self, key):
+        with self._lock:
+            return self._group_locks.setdefault(key, threading.Lock())
+
+    @staticmethod
+    def _fetch_group(keyring, group):
+        """All the secrets of a group, by escaped key.
+
+        :returns: None if the keyring can't be reached, so that the keyring
+            can fall back to the local OS keyring.
+        """
+        from botocore.exceptions import EndpointConnectionError
+
+        prefix = "{}/{}/".format(keyring.namespace, keyring.escape(group))
+        paginator = keyring.client.get_paginator('list_objects_v2')
+        try:
+            s3keys = [obj['Key'] for page in paginator.paginate(
+                Bucket=keyring.bucket, Prefix=prefix)
+                for obj in page.get('Contents', [])]
+        except EndpointConnectionError:
+            return None
+        s3keys = [s3key for s3key in s3keys if s3key.endswith(SECRET_SUFFIX)
+                  and '/' not in s3key[len(prefix):-len(SECRET_SUFFIX)]]
+
+        def fetch(s3key):
+            body = keyring.client.get_object(
+                Bucket=keyring.bucket, Key=s3key)['Body'].read()
+            return base64.decodebytes(body).decode('utf-8')
+
+        max_workers = int(config.MAX_PARALLEL_SECRET_FETCHES)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            values = list(executor.map(fetch, s3keys))
+        return {s3key[len(prefix):-len(SECRET_SUFFIX)]: value
+                for s3key, value in zip(s3keys, values)}
+
+    def get(self, config_file, group, key):
+        """A secret, or None if it is not in the keyring.
+
+        :param config_file: The keyring configuration file, or None to use
+            the default configuration.
+        :param group: The name of the group of secrets.
+        :param key: The key that identifies the secret within the group.
+        """
+        keyring = self._get_keyring(config_file)
+        if keyring.escape is None:
+            return keyring.keyring.get_password(group, key)
+        with self._group_lock((config_file, group)):
+            if (config_file, group) not in self._groups:
+                self._groups[(config_file, group)] = self._fetch_group(
+                    keyring, group)
+        secrets = self._groups[(config_file, group)]
+        if secrets is None:
+            return keyring.keyring.get_password(group, key)
+        return secrets.get(keyring.escape(key))
+
+    def get_encrypted(self, boto_config, config_file, group, key,
+                      kms_key_id):
+        """A secret encrypted with a KMS key.
+
+        :param boto_config: The configuration of the KMS client.
+        :param kms_key_id: The ID of the KMS key.
+        """
+        from humilis.clients import get_client
+
+        memo_key = (config_file, group, key, kms_key_id)
+        with self._group_lock(memo_key):
+            if memo_key not in self._encrypted:
+                self._encrypted[memo_key] = get_client(
+                    'kms', boto_config).encrypt(
+                        KeyId=kms_key_id,
+                        Plaintext=self.get(config_file, group, key))
+            return self._encrypted[memo_key]
+
+
+# Shared by all the secret references of a run
+resolver = SecretResolver()
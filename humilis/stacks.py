@@ -0,0 +1,118 @@
+"""Index of the CF stacks an environment works with."""
+
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+from humilis.config import config
+import humilis.utils as utils
+
+
+def describe_stack(client, stack_name):
+    """Describes a stack, or returns None if the stack does not exist."""
+    try:
+        return client.describe_stacks(StackName=stack_name)['Stacks'][0]
+    except ClientError as error:
+        msg = error.response.get('Error', {}).get('Message', '')
+        if msg.find('does not exist') > -1:
+            return None
+        raise
+
+
+def _summarize(stack):
+    """The stack metadata kept in the index."""
+    return {
+        'name': stack['StackName'],
+        'status': stack['StackStatus'],
+        'outputs': {o['OutputKey']: o['OutputValue']
+                    for o in stack.get('Outputs') or []},
+        'tags': utils.unroll_tags(stack.get('Tags') or []),
+        'notification_arns': stack.get('NotificationARNs') or [],
+        'updated': str(stack.get('LastUpdatedTime') or
+                       stack.get('CreationTime'))}
+
+
+class StackIndex:
+    """Status, outputs and tags of CF stacks, by name and by environment.
+
+    The index is built in a single sweep over all the stacks in the account
+    and is kept for ``ttl`` seconds. The resources of a stack are listed the
+    first time they are requested and are kept with the stack metadata.
+
+    Stacks that humilis creates, updates or deletes must be invalidated
+    explicitly: they are then described again, one by one, the next time they
+    are accessed.
+    """
+    def __init__(self, cf, ttl=None):
+        self.cf = cf
+        self.ttl = float(ttl or config.STACK_INDEX_TTL)
+        self._stacks = None
+        self._timestamp = 0
+        self._stale = set()
+        self._lock = threading.RLock()
+
+    def _sweep(self):
+        """Indexes all the stacks in the account."""
+        stacks = {}
+        paginator = self.cf.client.get_paginator('describe_stacks')
+        for page in paginator.paginate():
+            for stack in page.get('Stacks', []):
+                stacks[stack['StackName']] = _summarize(stack)
+        self._stacks = stacks
+        self._timestamp = time.time()
+        self._stale = set()
+
+    def _refresh(self, stack_name):
+        """Describes again a single stack."""
+        stack = describe_stack(self.cf.client, stack_name)
+        if stack is None:
+            self._stacks.pop(stack_name, None)
+        else:
+            self._stacks[stack_name] = _summarize(stack)
+        self._stale.discard(stack_name)
+
+    @property
+    def stacks(self):
+        """A dict with the metadata of every stack, by stack name."""
+        with self._lock:
+            if self._stacks is None or \
+                    time.time() - self._timestamp > self.ttl:
+                self._sweep()
+            for stack_name in list(self._stale):
+                self._refresh(stack_name)
+            return self._stacks
+
+    def get(self, stack_name):
+        """The metadata of a stack, or None if the stack is not in CF."""
+        return self.stacks.get(stack_name)
+
+    def resources(self, stack_name):
+        """The physical IDs of the resources of a stack, by logical ID.
+
+        Returns None if the stack is not in CF.
+        """
+        stack = self.get(stack_name)
+        if stack is None:
+            return None
+        if 'resources' not in stack:
+            paginator = self.cf.client.get_paginator('list_stack_resources')
+            stack['resources'] = {
+                res['LogicalResourceId']: res.get('PhysicalResourceId')
+                for page in paginator.paginate(StackName=stack_name)
+                for res in page.get('StackResourceSummaries', [])}
+        return stack['resources']
+
+    def environment_stacks(self, environment_name):
+        """The metadata of every stack of a humilis environment."""
+        return [stack for stack in self.stacks.values()
+                if stack['tags'].get('humilis:environment') ==
+                environment_name]
+
+    def invalidate(self, stack_name=None):
+        """Invalidates a stack, or the whole index if no stack is given."""
+        with self._lock:
+            if stack_name is None:
+                self._stacks = None
+            else:
+                self._stale.add(stack_name)
@@ -0,0 +1,61 @@
+"""Build state of the layers of an environment, kept across runs."""
+
+import json
+import os
+import tempfile
+import threading
+
+from humilis.clients import get_account_id
+from humilis.config import config
+
+
+class BuildState:
+    """What each layer of an environment was last deployed from.
+
+    For each layer the state records a digest of its inputs, a digest of
+    the outputs and resources of the layers it depends on, and the version
+    of the CF stack (its last update time) that was deployed from them.
+
+    :param path: The path of the JSON file where the state is kept.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._layers = {}
+        if os.path.isfile(path):
+            with open(path, 'r') as f:
+                self._layers = json.load(f).get('layers', {})
+
+    @classmethod
+    def for_environment(cls, environment):
+        """The state of an environment stage in the current AWS account."""
+        statedir = os.path.expanduser(config.STATE_DIR)
+        filename = "{}-{}-{}.json".format(
+            get_account_id(config.boto_config), environment.name,
+            environment.stage)
+        return cls(os.path.join(statedir, filename))
+
+    def get(self, layer_name):
+        """The state recorded for a layer, or None."""
+        with self._lock:
+            return self._layers.get(layer_name)
+
+    def set(self, layer_name, layer_state):
+        """Records the state of a layer, or forgets it if None."""
+        with self._lock:
+            if layer_state is None:
+                self._layers.pop(layer_name, None)
+            else:
+                self._layers[layer_name] = layer_state
+
+    def save(self):
+        """Writes the state to disk."""
+        with self._lock:
+            statedir = os.path.dirname(self.path)
+            if not os.path.isdir(statedir):
+                os.makedirs(statedir, exist_ok=True)
+            fd, tmppath = tempfile.mkstemp(dir=statedir)
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'layers': self._layers}, f, indent=2,
+                          sort_keys=True)
+            os.replace(tmppath, self.path)
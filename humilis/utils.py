@@ -1,30 +1,139 @@
 """Utilities."""
 
 import abc
-import contextlib
+import base64
+import copy
+import datetime
 import logging
 import os
 import io
 import glob
 import json
-import shutil
 from sys import exit
-import tempfile
+import threading
 
 import yaml
 import jinja2 as j2
 
+from humilis import cache
 import humilis.config
-from humilis.exceptions import FileFormatError
+from humilis.exceptions import FileFormatError, CyclicDependencyError
 
 
-def zipdir(path, ziph):
-    """Adds all files under a path to a zip file."""
-    for root, dirs, files in os.walk(path):
-        for file in files:
-            relroot = os.path.relpath(root, path)
-            arcname = os.path.join(relroot, file)
-            ziph.write(os.path.join(root, file), arcname=arcname)
+# The libyaml-based loader is much faster, but it is not always available
+YamlLoader = getattr(yaml, 'CFullLoader', yaml.FullLoader)
+
+_yaml_lock = threading.Lock()
+_yaml_parsed = {}
+
+
+def load_yaml(stream):
+    """Parses a YAML document."""
+    return yaml.load(stream, Loader=YamlLoader)
+
+
+class _NotJson(Exception):
+    """Parsed YAML that can't be safely stored as JSON."""
+    pass
+
+
+# The key of the JSON objects that stand for non-JSON YAML values
+_YAML_TAG = '__yaml__'
+
+
+def _to_json(data):
+    """Parsed YAML as JSON-compatible data, tagging non-JSON values."""
+    if data is None or isinstance(data, (bool, int, float, str)):
+        return data
+    if isinstance(data, list):
+        return [_to_json(value) for value in data]
+    if isinstance(data, dict):
+        if _YAML_TAG in data or not all(isinstance(k, str) for k in data):
+            raise _NotJson()
+        return {k: _to_json(v) for k, v in data.items()}
+    if isinstance(data, datetime.datetime):
+        return {_YAML_TAG: 'datetime', 'value': data.isoformat()}
+    if isinstance(data, datetime.date):
+        return {_YAML_TAG: 'date', 'value': data.isoformat()}
+    if isinstance(data, bytes):
+        return {_YAML_TAG: 'binary',
+                'value': base64.b64encode(data).decode('ascii')}
+    if isinstance(data, (tuple, set)):
+        return {_YAML_TAG: type(data).__name__,
+                'value': [_to_json(value) for value in data]}
+    raise _NotJson()
+
+
+def _from_json(obj):
+    """Restores the non-JSON values tagged by _to_json."""
+    if _YAML_TAG not in obj:
+        return obj
+    tag, value = obj[_YAML_TAG], obj['value']
+    if tag == 'datetime':
+        return datetime.datetime.fromisoformat(value)
+    if tag == 'date':
+        return datetime.date.fromisoformat(value)
+    if tag == 'binary':
+        return base64.b64decode(value.encode('ascii'), validate=True)
+    if tag == 'tuple':
+        return tuple(value)
+    if tag == 'set':
+        return set(value)
+    raise ValueError("Unknown YAML tag in cache: {}".format(tag))
+
+
+_NOT_CACHED = object()
+
+
+def _load_cached_yaml(key):
+    """Parsed YAML from the disk cache, or _NOT_CACHED."""
+    cached = cache.get_file('yaml', key)
+    if not cached:
+        return _NOT_CACHED
+    try:
+        with open(cached, 'r') as f:
+            return json.load(f, object_hook=_from_json)
+    except (ValueError, TypeError, KeyError):
+        # Corrupt or tampered with: parse the file again
+        return _NOT_CACHED
+
+
+def load_yaml_file(path):
+    """Parses a YAML file, reusing the result of parsing it before.
+
+    Parsed files are cached in memory and, as JSON, on disk, keyed by their
+    path, size and modification time. Files that use values that JSON can't
+    represent are only cached in memory. Each call returns a new copy of the
+    data.
+    """
+    if not humilis.config.as_bool(humilis.config.config.YAML_PARSE_CACHE):
+        with open(path, 'r') as f:
+            return load_yaml(f)
+
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    hasher = cache.new_hasher()
+    hasher.update("json\0{}\0{}\0{}\0{}\0{}".format(
+        yaml.__version__, YamlLoader.__name__, path, stat.st_size,
+        stat.st_mtime_ns).encode())
+    key = hasher.hexdigest()
+    with _yaml_lock:
+        found = key in _yaml_parsed
+        data = _yaml_parsed.get(key)
+    if not found:
+        data = _load_cached_yaml(key)
+        if data is _NOT_CACHED:
+            with open(path, 'r') as f:
+                data = load_yaml(f)
+            try:
+                encoded = json.dumps(_to_json(data))
+            except _NotJson:
+                pass
+            else:
+                cache.put_data('yaml', key, encoded.encode())
+        with _yaml_lock:
+            _yaml_parsed[key] = data
+    return copy.deepcopy(data)
 
 
 def unroll_tags(tags):
@@ -37,21 +146,6 @@ def roll_tags(tags):
     return [{'Key': k, 'Value': v} for k, v in tags.items()]
 
 
-@contextlib.contextmanager
-def move_aside(path):
-    """Moves a file or directory aside so that it can be processed in place."""
-    tmpdir = tempfile.mktemp()
-    if os.path.isfile(path):
-        os.makedirs(tmpdir)
-        tmpfile = os.path.join(tmpdir, os.path.basename(path))
-        shutil.copy(path, tmpfile)
-        yield tmpfile
-    elif os.path.isdir(path):
-        shutil.copytree(path, tmpdir)
-        yield tmpdir
-    shutil.rmtree(tmpdir)
-
-
 def get_cf_name(env_name, layer_name, stage=None):
     """Produces the CF stack name for layer."""
     cf_name = "{}-{}".format(env_name, layer_name)
@@ -60,6 +154,37 @@ def get_cf_name(env_name, layer_name, stage=None):
     return cf_name
 
 
+def dependency_waves(names, dependencies):
+    """Groups names in waves that only depend on names of earlier waves.
+
+    :param names: The names to group, in fallback order.
+    :param dependencies: A dict mapping each name to the names it depends on.
+        Dependencies that are not in ``names`` are ignored.
+
+    :returns: A list of waves, each wave being a list of names.
+    """
+    known = set(names)
+    done = set()
+    pending = list(names)
+    waves = []
+    while pending:
+        wave = [name for name in pending
+                if all(dep in done for dep in dependencies.get(name, [])
+                       if dep in known and dep != name)]
+        if not wave:
+            msg = "Cyclic dependencies between {}".format(pending)
+            raise CyclicDependencyError(msg)
+        waves.append(wave)
+        done.update(wave)
+        pending = [name for name in pending if name not in done]
+    return waves
+
+
+def chunks(items, size):
+    """Splits a list in consecutive chunks of at most size items."""
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
 class TemplateLoader:
     @abc.abstractmethod
     def load_section(self, *args, **kwargs):
@@ -72,14 +197,62 @@ def update_jinja2_env(env):
         env.filters[name] = func
 
 
+_jinja2_lock = threading.Lock()
+_jinja2_envs = {}
+_jinja2_bytecode_cache = None
+
+
+def _get_jinja2_bytecode_cache():
+    """The cache of compiled Jinja2 templates.
+
+    Compiled templates are loaded as code, so they are only kept in the
+    humilis cache if no other user can write to it. Otherwise the per-user
+    cache directory of Jinja2 is used.
+    """
+    cache_dir = cache.get_cache_dir('jinja2')
+    if cache.is_private(cache_dir):
+        return j2.FileSystemBytecodeCache(cache_dir)
+    logging.getLogger(__name__).warning(
+        "Other users can write to {}: compiled templates are cached in the "
+        "Jinja2 default directory instead".format(cache_dir))
+    return j2.FileSystemBytecodeCache()
+
+
+def get_jinja2_env(basedir, **options):
+    """A Jinja2 environment that loads templates from a directory.
+
+    Environments are shared by all the users of a template directory within
+    a process, so that each template is parsed and compiled only once.
+    Compiled templates are also cached on disk across runs.
+
+    :param basedir: The template directory.
+    :param options: Options of the Jinja2 environment, e.g. trim_blocks.
+    """
+    global _jinja2_bytecode_cache
+    basedir = os.path.abspath(basedir)
+    key = (basedir, tuple(sorted(options.items())))
+    with _jinja2_lock:
+        env = _jinja2_envs.get(key)
+        if env is None:
+            if humilis.config.as_bool(
+                    humilis.config.config.JINJA2_BYTECODE_CACHE):
+                if _jinja2_bytecode_cache is None:
+                    _jinja2_bytecode_cache = _get_jinja2_bytecode_cache()
+                options['bytecode_cache'] = _jinja2_bytecode_cache
+            env = j2.Environment(loader=j2.FileSystemLoader(basedir),
+                                 **options)
+            # Add custom functions and filters
+            update_jinja2_env(env)
+            _jinja2_envs[key] = env
+        return env
+
+
 class DirTreeBackedObject(TemplateLoader):
     """Loads data from a directory tree of files in various formats."""
     def __init__(self, basedir, logger=None):
         self.basedir = basedir
-        self.env = j2.Environment(loader=j2.FileSystemLoader(basedir),
-                                  trim_blocks=True,
+        self.env = get_jinja2_env(basedir, trim_blocks=True,
                                   lstrip_blocks=True)
-        update_jinja2_env(self.env)
         if logger is None:
             self.logger = logging.getLogger(__name__)
             self.logger.addHandler(logging.NullHandler())
@@ -144,7 +317,11 @@ class DirTreeBackedObject(TemplateLoader):
         filename, file_ext = os.path.splitext(filepath)
         try:
             if file_ext in {'.yml', '.yaml'}:
-                data = yaml.load(f, Loader=yaml.FullLoader)
+                if getattr(f, 'name', None) == filepath:
+                    # Not a rendered template: the file can be cached
+                    data = load_yaml_file(filepath)
+                else:
+                    data = load_yaml(f)
             elif file_ext == '.json':
                 data = json.load(f)
             elif file_ext == '.j2':
@@ -0,0 +1,137 @@
+"""Encryption of the secrets stored in the vault of an environment."""
+
+from concurrent.futures import ThreadPoolExecutor
+import os
+import threading
+
+from humilis.config import config
+from humilis.exceptions import MissingDependencyError, VaultError
+
+# The value of the 'encryption' attribute of envelope-encrypted items
+ENVELOPE = 'aes-256-gcm'
+NONCE_SIZE = 12
+
+
+def _aesgcm(key):
+    """An AES-GCM cipher, from the optional cryptography package."""
+    try:
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    except ImportError:
+        raise MissingDependencyError(
+            "Envelope encryption of secrets requires the cryptography "
+            "package: pip install humilis[envelope]")
+    return AESGCM(key)
+
+
+class SecretCipher:
+    """Encrypts secrets into vault items, and decrypts them back.
+
+    Without envelope encryption each secret is encrypted with a KMS call.
+    With envelope encryption a single KMS data key is generated for all the
+    secrets encrypted with the cipher. Secrets are encrypted locally with
+    AES-GCM, using the secret ID as associated data, and each item stores
+    the data key wrapped by KMS. Decrypting many such items takes one KMS
+    call per distinct data key. Directly encrypted items are always readable.
+
+    Unwrapped data keys are only kept in memory.
+
+    :param kms: A KMS client.
+    :param envelope: Use envelope encryption for new secrets.
+    """
+    def __init__(self, kms, envelope=False):
+        self.kms = kms
+        self.envelope = envelope
+        self._data_key = None
+        self._data_keys = {}
+        self._lock = threading.Lock()
+
+    def _generate_data_key(self, key_id):
+        """The data key of the cipher, as a (plaintext, wrapped) tuple."""
+        with self._lock:
+            if self._data_key is None:
+                resp = self.kms.generate_data_key(KeyId=key_id,
+                                                  KeySpec='AES_256')
+                self._data_key = resp['Plaintext'], resp['CiphertextBlob']
+                self._data_keys[resp['CiphertextBlob']] = resp['Plaintext']
+            return self._data_key
+
+    def _unwrap(self, wrapped):
+        """The plaintext of a data key wrapped by KMS."""
+        with self._lock:
+            if wrapped in self._data_keys:
+                return self._data_keys[wrapped]
+        key = self.kms.decrypt(CiphertextBlob=wrapped)['Plaintext']
+        with self._lock:
+            self._data_keys[wrapped] = key
+        return key
+
+    def encrypt(self, secret_id, plaintext, key_id):
+        """The DynamoDB item that stores a secret.
+
+        :param secret_id: The key of the secret.
+        :param plaintext: The secret.
+        :param key_id: The ID of the vault KMS key.
+        """
+        if not isinstance(plaintext, bytes):
+            plaintext = str(plaintext).encode()
+        item = {'id': {'S': secret_id}}
+        if not self.envelope:
+            item['value'] = {'B': self.kms.encrypt(
+                KeyId=key_id, Plaintext=plaintext)['CiphertextBlob']}
+            return item
+        key, wrapped = self._generate_data_key(key_id)
+        nonce = os.urandom(NONCE_SIZE)
+        ciphertext = _aesgcm(key).encrypt(nonce, plaintext,
+                                          secret_id.encode())
+        item['value'] = {'B': nonce + ciphertext}
+        item['key'] = {'B': wrapped}
+        item['encryption'] = {'S': ENVELOPE}
+        return item
+
+    def decrypt(self, item):
+        """The plaintext secret stored in a DynamoDB item."""
+        encryption = item.get('encryption', {}).get('S')
+        value = item['value']['B']
+        if encryption is None:
+            return self.kms.decrypt(CiphertextBlob=value)['Plaintext'].decode()
+        if encryption != ENVELOPE:
+            raise VaultError("Secret '{}' uses an unsupported encryption: "
+                             "{}".format(item['id']['S'], encryption))
+        cipher = _aesgcm(self._unwrap(item['key']['B']))
+        from cryptography.exceptions import InvalidTag
+        try:
+            plaintext = cipher.decrypt(
+                value[:NONCE_SIZE], value[NONCE_SIZE:],
+                item['id']['S'].encode())
+        except InvalidTag:
+            raise VaultError("Secret '{}' cannot be decrypted: it has been "
+                             "modified or moved".format(item['id']['S']))
+        return plaintext.decode()
+
+    def encrypt_all(self, secrets, key_id, max_parallel=None):
+        """The DynamoDB items that store many secrets.
+
+        :param secrets: A dict with the plaintext of each secret, by key.
+        :param key_id: The ID of the vault KMS key.
+        :param max_parallel: The max number of concurrent KMS calls.
+        """
+        keys = sorted(secrets)
+        if self.envelope:
+            # A single KMS call: no need for threads
+            return [self.encrypt(key, secrets[key], key_id) for key in keys]
+        max_parallel = int(max_parallel or config.MAX_PARALLEL_KMS)
+        with ThreadPoolExecutor(max_workers=max_parallel) as executor:
+            return list(executor.map(
+                lambda key: self.encrypt(key, secrets[key], key_id), keys))
+
+    def decrypt_all(self, items, max_parallel=None):
+        """The plaintext secrets stored in many DynamoDB items, in order.
+
+        :param max_parallel: The max number of concurrent KMS calls.
+        """
+        max_parallel = int(max_parallel or config.MAX_PARALLEL_KMS)
+        wrapped = {item['key']['B'] for item in items if 'encryption' in item}
+        with ThreadPoolExecutor(max_workers=max_parallel) as executor:
+            # Unwrap each data key once, before the items that use it
+            list(executor.map(self._unwrap, wrapped))
+            return list(executor.map(self.decrypt, items))
@@ -0,0 +1,170 @@
+"""Shared watcher of in-flight CF stacks and changesets."""
+
+import logging
+import threading
+import time
+from concurrent.futures import Future
+
+from humilis.config import config
+from humilis.stacks import describe_stack
+
+
+class _Watch:
+    """An item tracked by the watcher."""
+    def __init__(self, name, poll, is_done, on_poll, delay):
+        self.name = name
+        self.poll = poll
+        self.is_done = is_done
+        self.on_poll = on_poll
+        self.delay = delay
+        self.next_poll = time.time()
+        self.future = Future()
+
+
+class Watcher:
+    """Tracks all in-flight stacks and changesets in one polling loop.
+
+    Each watched item is first polled after ``min_delay`` seconds. The delay
+    between polls grows by a factor ``backoff`` up to ``max_delay`` seconds,
+    so that short operations finish fast and long ones don't flood AWS with
+    API calls.
+    """
+    def __init__(self, min_delay=None, max_delay=None, backoff=None,
+                 logger=None):
+        self.min_delay = float(min_delay or config.WATCHER_MIN_DELAY)
+        self.max_delay = float(max_delay or config.WATCHER_MAX_DELAY)
+        self.backoff = float(backoff or config.WATCHER_BACKOFF)
+        if logger is None:
+            self.logger = logging.getLogger(__name__)
+            self.logger.addHandler(logging.NullHandler())
+        else:
+            self.logger = logger
+        self._watches = []
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def watch(self, name, poll, is_done, on_poll=None):
+        """Polls until an item reaches a terminal state.
+
+        :param name: A name for the watched item, used for logging.
+        :param poll: A callable that produces the current item state.
+        :param is_done: A callable that is True for terminal states.
+        :param on_poll: An optional callable that receives every state.
+
+        :returns: A future that resolves to the terminal state.
+        """
+        watch = _Watch(name, poll, is_done, on_poll, self.min_delay)
+        watch.next_poll += self.min_delay
+        with self._cond:
+            self._watches.append(watch)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="humilis-watcher", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        return watch.future
+
+    def watch_stack(self, cf, stack_name, progress_status, on_poll=None,
+                    missing_ok=False, initial_status=None):
+        """Watches a stack until its status is not a progress status.
+
+        :param cf: The Cloudformation facade to use.
+        :param stack_name: The name of the CF stack.
+        :param progress_status: The set of non-terminal stack statuses.
+        :param on_poll: An optional callable that receives every status.
+        :param missing_ok: If True a missing stack is a terminal state.
+        :param initial_status: The status of the stack before the watched
+            operation started. CF may still report it in the first polls, so
+            it is a progress status until the stack leaves it.
+
+        :returns: A future that resolves to the terminal stack status.
+        """
+        pending = [initial_status]
+
+        def poll():
+            stack = describe_stack(cf.client, stack_name)
+            return stack and stack['StackStatus']
+
+        def is_done(status):
+            if status is None:
+                return missing_ok
+            if status in pending:
+                return False
+            pending.clear()
+            return status not in progress_status
+
+        return self.watch(stack_name, poll, is_done, on_poll)
+
+    def watch_changeset(self, cf, stack_name, changeset_name,
+                        progress_status={"CREATE_PENDING",
+                                         "CREATE_IN_PROGRESS"}):
+        """Watches a changeset until its status is not a progress status.
+
+        :returns: A future that resolves to the changeset description.
+        """
+        def poll():
+            return cf.client.describe_change_set(
+                ChangeSetName=changeset_name, StackName=stack_name)
+
+        def is_done(changeset):
+            return changeset.get('Status') not in progress_status
+
+        return self.watch(changeset_name, poll, is_done)
+
+    def _run(self):
+        """The polling loop."""
+        while True:
+            with self._cond:
+                if not self._watches:
+                    self._thread = None
+                    return
+                now = time.time()
+                due = [w for w in self._watches if w.next_poll <= now]
+                if not due:
+                    self._cond.wait(
+                        min(w.next_poll for w in self._watches) - now)
+                    continue
+            for watch in due:
+                self._poll(watch)
+
+    def _poll(self, watch):
+        """Polls a watched item once."""
+        try:
+            state = watch.poll()
+            done = watch.is_done(state)
+        except Exception as exc:
+            self._finish(watch)
+            watch.future.set_exception(exc)
+            return
+
+        if watch.on_poll is not None:
+            try:
+                watch.on_poll(state)
+            except Exception as exc:
+                self.logger.warning("Error watching {}: {}".format(
+                    watch.name, exc))
+
+        if done:
+            self._finish(watch)
+            watch.future.set_result(state)
+        else:
+            watch.delay = min(watch.delay * self.backoff, self.max_delay)
+            watch.next_poll = time.time() + watch.delay
+
+    def _finish(self, watch):
+        """Stops tracking an item."""
+        with self._cond:
+            self._watches.remove(watch)
+
+
+_watcher = None
+_watcher_lock = threading.Lock()
+
+
+def get_watcher():
+    """The watcher shared by all the layers."""
+    global _watcher
+    with _watcher_lock:
+        if _watcher is None:
+            _watcher = Watcher(logger=logging.getLogger(config.LOGGER_NAME))
+        return _watcher
@@ -28,6 +28,7 @@ setup(
     description="AWS cloudformation-based deployment framework",
     long_description=long_description,
     packages=find_packages(),
+    python_requires=">=3.9",
     install_requires=[
         "PyYAML<=5.2",
         "six",
@@ -35,9 +36,11 @@ setup(
         "s3keyring>=0.2.3",
         "boto3facade>=0.5.9",
         "jinja2"],
+    extras_require={
+        "envelope": ["cryptography"]},
     classifiers=[
-        "Programming Language :: Python :: 2",
-        "Programming Language :: Python :: 3"],
+        "Programming Language :: Python :: 3",
+        "Programming Language :: Python :: 3 :: Only"],
     zip_safe=False,
     entry_points={
         "console_scripts": [
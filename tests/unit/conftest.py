@@ -2,15 +2,98 @@
 
 import os
 
+import boto3
+import boto3facade.aws
 import pytest
 import uuid
 from boto3facade.cloudformation import Cloudformation
 from boto3facade.ec2 import Ec2
+from botocore.exceptions import ClientError
 
+import humilis.clients
 from humilis.config import config
 from humilis.environment import Environment
 
 
+class StubSts:
+    """STS client of a stub AWS account, that counts identity calls."""
+    def __init__(self):
+        self.calls = 0
+
+    def get_caller_identity(self):
+        self.calls += 1
+        return {'Account': '123456789012'}
+
+
+class StubCloudformation:
+    """CloudFormation client of an AWS account, with the stacks, and their
+    templates, that a test adds to it."""
+    def __init__(self):
+        self.stacks = []
+        self.templates = {}
+
+    def describe_stacks(self, StackName=None):
+        return {'Stacks': [stack for stack in self.stacks
+                           if StackName in (None, stack['StackName'])]}
+
+    def get_template(self, StackName, TemplateStage):
+        return {'TemplateBody': self.templates[StackName]}
+
+    def get_paginator(self, operation):
+        return StubPaginator(getattr(self, operation))
+
+
+class StubPaginator:
+    """Paginator that produces the response of a call as a single page."""
+    def __init__(self, call):
+        self.call = call
+
+    def paginate(self, **kwargs):
+        return [self.call(**kwargs)]
+
+
+class StubS3:
+    """S3 client that stores the objects put into it."""
+    def __init__(self):
+        self.objects = {}
+
+    def head_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+        return {}
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[Key] = Body
+
+    def upload_file(self, Filename, Bucket, Key):
+        with open(Filename, 'rb') as f:
+            self.objects[Key] = f.read()
+
+
+class StubSession:
+    """A boto3 session that hands out stub clients."""
+    def __init__(self, clients):
+        self.clients = clients
+
+    def client(self, service, **kwargs):
+        return self.clients[service]
+
+
+@pytest.fixture
+def aws(monkeypatch):
+    """Stub AWS clients, by service name, used by all boto3 sessions."""
+    clients = {'sts': StubSts(), 'cloudformation': StubCloudformation(),
+               's3': StubS3()}
+    session = StubSession(clients)
+    monkeypatch.setattr(boto3, 'DEFAULT_SESSION', session)
+    monkeypatch.setattr(boto3facade.aws, 'Session',
+                        lambda **kwargs: session)
+    # Clients shared by earlier tests are not the stubs of this one
+    humilis.clients.reset()
+    yield clients
+    humilis.clients.reset()
+
+
 @pytest.fixture(scope="session")
 def test_config():
     config.boto_config.activate_profile("test")
@@ -56,6 +139,18 @@ def environment_definition_j2_path():
     yield os.path.join('examples', 'humilis-microservice.yaml.j2')
 
 
+@pytest.fixture(scope="session")
+def layered_environment_path():
+    """Path to a sample environment whose layers depend on each other."""
+    return os.path.join('examples', 'humilis-layers.yaml')
+
+
+@pytest.fixture
+def layered_environment(layered_environment_path, aws):
+    """A humilis environment with layers that depend on each other."""
+    return Environment(layered_environment_path, stage="dummy")
+
+
 @pytest.fixture(scope="module")
 def test_environment(environment_definition_path, test_config):
     """A humilis environment based on the sample environment definition."""
@@ -0,0 +1,88 @@
+"""Tests the lambda package archive writer."""
+
+import os
+import zipfile
+
+import pytest
+
+import humilis.archive
+from humilis.archive import ArchiveWriter
+
+
+@pytest.fixture
+def source(tmpdir):
+    tmpdir.join('text.py').write('x = 1\n' * 1000)
+    tmpdir.join('random.bin').write_binary(os.urandom(1000))
+    return tmpdir
+
+
+@pytest.fixture(params=[True, False], ids=['raw', 'writestr'])
+def raw_writes(request, monkeypatch):
+    """Write entries compressed beforehand, or with ZipFile.writestr."""
+    monkeypatch.setattr(humilis.archive, '_raw_writes', request.param)
+    return request.param
+
+
+@pytest.mark.parametrize('compression', ['deflated', 'stored'])
+def test_archive(source, compression, raw_writes):
+    """Entries are written in order and can be read back."""
+    path = str(source.join('package.zip'))
+    with ArchiveWriter(path, compression=compression, compresslevel=9,
+                       max_workers=2, deterministic=False) as archive:
+        archive.add(str(source.join('text.py')), 'text.py')
+        archive.add(str(source.join('random.bin')), 'pkg/random.bin')
+        archive.add(str(source.join('text.py')), 'rendered.py',
+                    data='rendered')
+
+    with zipfile.ZipFile(path) as zf:
+        assert zf.testzip() is None
+        assert zf.namelist() == ['text.py', 'pkg/random.bin', 'rendered.py']
+        assert zf.read('text.py') == source.join('text.py').read_binary()
+        assert zf.read('rendered.py') == b'rendered'
+        text = zf.getinfo('text.py')
+        expected = (zipfile.ZIP_DEFLATED if compression == 'deflated'
+                    else zipfile.ZIP_STORED)
+        assert text.compress_type == expected
+        # Incompressible entries are always stored
+        assert zf.getinfo('pkg/random.bin').compress_type == \
+            zipfile.ZIP_STORED
+
+
+def test_unsupported_compression(tmpdir):
+    with pytest.raises(ValueError):
+        ArchiveWriter(str(tmpdir.join('package.zip')), compression='lzma')
+
+
+def test_deterministic_archive(source, raw_writes):
+    """Identical contents produce identical archives."""
+    paths = []
+    for i, order in enumerate([('text.py', 'random.bin'),
+                               ('random.bin', 'text.py')]):
+        for name in order:
+            os.utime(str(source.join(name)), (i * 1e6, i * 1e6))
+        path = str(source.join('package{}.zip'.format(i)))
+        with ArchiveWriter(path, deterministic=True) as archive:
+            for name in order:
+                archive.add(str(source.join(name)), name)
+        paths.append(path)
+
+    contents = [open(path, 'rb').read() for path in paths]
+    assert contents[0] == contents[1]
+    with zipfile.ZipFile(paths[0]) as zf:
+        assert zf.namelist() == ['random.bin', 'text.py']
+        assert zf.getinfo('text.py').date_time == (1980, 1, 1, 0, 0, 0)
+
+
+def test_raw_writes(source, monkeypatch):
+    """Entries compressed beforehand are written as writestr would."""
+    assert humilis.archive._raw_writes_supported()
+    contents = []
+    for raw in (True, False):
+        monkeypatch.setattr(humilis.archive, '_raw_writes', raw)
+        path = str(source.join('package-{}.zip'.format(raw)))
+        with ArchiveWriter(path, compresslevel=9,
+                           deterministic=True) as writer:
+            writer.add(str(source.join('text.py')), 'text.py')
+            writer.add(str(source.join('random.bin')), 'random.bin')
+        contents.append(open(path, 'rb').read())
+    assert contents[0] == contents[1]
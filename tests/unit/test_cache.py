@@ -0,0 +1,70 @@
+"""Tests the local build cache."""
+
+import os
+
+import pytest
+
+from humilis import cache
+from humilis.config import config
+
+
+@pytest.fixture
+def cache_dir(tmpdir, monkeypatch):
+    monkeypatch.setattr(config, 'CACHE_DIR', str(tmpdir.join('cache')))
+    return tmpdir
+
+
+def test_put_and_copy_tree(cache_dir):
+    """A cached tree is copied without replacing existing files."""
+    with cache.put_tree('deps', 'key') as path:
+        os.makedirs(os.path.join(path, 'pkg'))
+        for name in ('pkg/__init__.py', 'mod.py'):
+            with open(os.path.join(path, name), 'w') as f:
+                f.write('cached')
+    cached = cache.get_tree('deps', 'key')
+    assert cached is not None
+
+    dst = cache_dir.mkdir('dst')
+    dst.join('mod.py').write('source')
+    cache.copy_tree(cached, str(dst))
+    assert dst.join('mod.py').read() == 'source'
+    assert dst.join('pkg', '__init__.py').read() == 'cached'
+
+    cache.copy_tree(cached, str(dst), replace=True)
+    assert dst.join('mod.py').read() == 'cached'
+
+    # Writing to the copies leaves the cache untouched
+    dst.join('mod.py').write('modified')
+    with open(os.path.join(cached, 'mod.py')) as f:
+        assert f.read() == 'cached'
+
+
+def test_failed_put_tree_is_not_cached(cache_dir):
+    with pytest.raises(RuntimeError):
+        with cache.put_tree('deps', 'key'):
+            raise RuntimeError
+    assert cache.get_tree('deps', 'key') is None
+    assert cache.list_entries() == []
+
+
+def test_prune(cache_dir):
+    src = cache_dir.join('file.zip')
+    src.write('zip')
+    cache.put_file('lambda', 'file.zip', str(src))
+    assert [e['name'] for e in cache.list_entries()] == ['file.zip']
+    assert cache.prune(older_than=3600) == []
+    assert len(cache.prune('lambda')) == 1
+    assert cache.list_entries() == []
+
+
+def test_private_cache_dirs(cache_dir):
+    """Compiled templates are only cached in directories of the user."""
+    from humilis import utils
+    path = cache.get_cache_dir('jinja2')
+    assert os.stat(path).st_mode & 0o777 == 0o700
+    assert cache.is_private(path)
+    assert utils._get_jinja2_bytecode_cache().directory == path
+
+    os.chmod(path, 0o777)
+    assert not cache.is_private(path)
+    assert utils._get_jinja2_bytecode_cache().directory != path
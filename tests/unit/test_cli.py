@@ -5,6 +5,7 @@
 from click.testing import CliRunner
 import humilis
 import humilis.cli
+import humilis.exceptions
 import pytest
 
 
@@ -41,6 +42,50 @@ def test_get_secret(runner, environment_definition_path):
     assert result.exit_code == 0
 
 
+def test_set_secrets(runner, environment_definition_path, tmpdir):
+    secrets_file = tmpdir.join("secrets.yaml")
+    secrets_file.write("key1: value1\nkey2: value2\n")
+    result = runner.invoke(humilis.cli.main, ["set-secrets", "--pretend",
+                                              "--stage", "production",
+                                              environment_definition_path,
+                                              str(secrets_file)])
+    assert result.exit_code == 0
+
+    secrets_file.write("- not a mapping\n")
+    result = runner.invoke(humilis.cli.main, ["set-secrets", "--pretend",
+                                              "--stage", "production",
+                                              environment_definition_path,
+                                              str(secrets_file)])
+    assert result.exit_code > 0
+
+
+def test_get_secrets(runner, environment_definition_path):
+    result = runner.invoke(humilis.cli.main, ["get-secrets", "--pretend",
+                                              "--stage", "production",
+                                              environment_definition_path,
+                                              "key1", "key2"])
+    assert result.exit_code == 0
+
+
+def test_get_secrets_output_permissions(runner, monkeypatch, tmpdir):
+    """Secrets are only readable by their owner, even in existing files."""
+    class StubEnvironment:
+        def get_secrets(self, keys, max_parallel=None):
+            return {'key': 'secret'}
+
+    monkeypatch.setattr(humilis.cli, '_get_environment',
+                        lambda *args, **kwargs: StubEnvironment())
+    output = tmpdir.join("secrets.yaml")
+    output.write("old contents")
+    output.chmod(0o644)
+    result = runner.invoke(humilis.cli.main, ["get-secrets", "--stage",
+                                              "production", "env.yaml",
+                                              "--output", str(output)])
+    assert result.exit_code == 0
+    assert output.stat().mode & 0o777 == 0o600
+    assert output.read() == "key: secret\n"
+
+
 def test_configure_action(runner):
     result = runner.invoke(humilis.cli.main, ["configure", "--no-ask"])
     assert result.exit_code == 0
@@ -89,3 +134,50 @@ def test_stage(runner, environment_definition_path):
                                                 "--stage", "production",
                                                 "--pretend"])
     assert result.exit_code == 0
+
+
+@pytest.mark.parametrize("action", ENV_ACTIONS)
+def test_unknown_layer(action, runner, environment_definition_path):
+    result = runner.invoke(humilis.cli.main, [action, "--pretend",
+                                              "--stage", "production",
+                                              "--layer", "not-a-layer",
+                                              environment_definition_path])
+    assert result.exit_code > 0
+    assert isinstance(result.exception, humilis.exceptions.UnknownLayerError)
+
+
+@pytest.mark.parametrize("action,selection", [
+    ("create", {"with_dependencies": True}),
+    ("update", {"with_dependencies": True}),
+    ("delete", {"with_dependents": True})])
+def test_layer_selection(action, selection, runner, monkeypatch):
+    """--with-deps selects dependencies to deploy, and dependents to delete.
+    """
+    calls = []
+
+    class StubEnvironment:
+        def select_layers(self, layer_names, **kwargs):
+            calls.append(('select', layer_names, kwargs))
+            return ['selected']
+
+        def create(self, **kwargs):
+            calls.append(('create', kwargs['layers']))
+
+        def delete(self, **kwargs):
+            calls.append(('delete', kwargs['layers']))
+
+    monkeypatch.setattr(humilis.cli, '_get_environment',
+                        lambda *args, **kwargs: StubEnvironment())
+    result = runner.invoke(humilis.cli.main, [action, "--stage", "production",
+                                              "env.yaml", "--layer", "api",
+                                              "--with-deps"])
+    assert result.exit_code == 0
+    assert calls == [('select', ("api",), selection),
+                     ('delete' if action == 'delete' else 'create',
+                      ['selected'])]
+
+    calls.clear()
+    result = runner.invoke(humilis.cli.main, [action, "--stage", "production",
+                                              "env.yaml"])
+    assert result.exit_code == 0
+    assert calls == [('delete' if action == 'delete' else 'create', None)]
@@ -0,0 +1,32 @@
+"""Tests the AWS clients shared across a run."""
+
+import boto3facade.aws
+from boto3facade.cloudformation import Cloudformation
+from boto3facade.s3 import S3
+
+from humilis import clients
+from humilis.config import config
+
+
+def test_one_session_per_profile(aws, monkeypatch):
+    """Facades and clients of the same AWS profile share a boto3 session."""
+    sessions = []
+    session = boto3facade.aws.Session
+
+    def new_session(**kwargs):
+        sessions.append(kwargs)
+        return session(**kwargs)
+
+    monkeypatch.setattr(boto3facade.aws, 'Session', new_session)
+    cf = clients.get_facade(Cloudformation, config.boto_config)
+    assert isinstance(cf, Cloudformation)
+    assert clients.get_facade(Cloudformation, config.boto_config) is cf
+    assert cf.client == aws['cloudformation']
+    assert clients.get_facade(S3, config.boto_config).client == aws['s3']
+    assert clients.get_client('sts', config.boto_config) == aws['sts']
+    assert clients.get_account_id(config.boto_config) == '123456789012'
+    assert len(sessions) == 1
+
+    clients.reset()
+    clients.get_client('sts', config.boto_config)
+    assert len(sessions) == 2
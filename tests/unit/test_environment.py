@@ -1,12 +1,15 @@
 """Test Environment class."""
 
+import threading
 import uuid
 import yaml
 
 import pytest
 
+from humilis.config import config
 from humilis.environment import Environment
-from humilis.exceptions import RequiresVaultError
+from humilis.exceptions import RequiresVaultError, UnknownLayerError
+from humilis.layer import Layer
 
 
 def test_set_get_delete_secret(test_environment):
@@ -21,3 +24,185 @@ def test_set_get_delete_secret(test_environment):
 
     with pytest.raises(RequiresVaultError):
         test_environment.delete_secret(key)
+
+
+def test_create_in_waves(layered_environment, monkeypatch):
+    """Layers are deployed after their dependencies, in parallel waves."""
+    deployed = []
+    barrier = threading.Barrier(2)
+
+    def create(layer, update=False, debug=False):
+        if layer.name != 'api':
+            # Fails unless storage and logging are deployed concurrently
+            barrier.wait(timeout=5)
+        deployed.append(layer.name)
+
+    monkeypatch.setattr(Layer, 'create', create)
+    assert [[layer.name for layer in wave] for wave in
+            layered_environment.deployment_waves()] == [
+                ['storage', 'logging'], ['api']]
+    layered_environment.create(max_parallel=2)
+    assert sorted(deployed[:2]) == ['logging', 'storage']
+    assert deployed[2:] == ['api']
+
+
+def test_delete_in_reverse_waves(layered_environment, monkeypatch):
+    """Layers are deleted after their dependents, waiting for each wave."""
+    deleted = []
+    barrier = threading.Barrier(2)
+
+    def delete(layer, wait=False):
+        assert wait
+        if layer.name != 'api':
+            barrier.wait(timeout=5)
+        deleted.append(layer.name)
+
+    monkeypatch.setattr(Layer, 'delete', delete)
+    layered_environment.delete(max_parallel=2)
+    assert deleted[0] == 'api'
+    assert sorted(deleted[1:]) == ['logging', 'storage']
+
+
+def test_select_layers(layered_environment, monkeypatch):
+    """Only the selected layers, and what they need, are loaded."""
+    loaded = []
+    init = Layer.__init__
+
+    def load_layer(layer, environment, name, **kwargs):
+        loaded.append(name)
+        init(layer, environment, name, **kwargs)
+
+    monkeypatch.setattr(Layer, '__init__', load_layer)
+    env = layered_environment
+    assert [layer.name for layer in env.select_layers(['storage'])] == \
+        ['storage']
+    assert loaded == ['storage']
+    assert [layer.name for layer in env.select_layers(
+        ['api'], with_dependencies=True)] == ['storage', 'logging', 'api']
+    assert sorted(loaded) == ['api', 'logging', 'storage']
+    assert [layer.name for layer in env.select_layers(
+        ['logging'], with_dependents=True)] == ['logging', 'api']
+    with pytest.raises(UnknownLayerError):
+        env.select_layers(['storage', 'unknown'])
+
+
+def test_write_selected_outputs(layered_environment, aws, tmpdir,
+                                monkeypatch):
+    """Only the outputs of the deployed layers are loaded and written."""
+    loaded = []
+    init = Layer.__init__
+
+    def load_layer(layer, environment, name, **kwargs):
+        loaded.append(name)
+        init(layer, environment, name, **kwargs)
+
+    monkeypatch.setattr(Layer, '__init__', load_layer)
+    monkeypatch.setattr(Layer, 'create',
+                        lambda layer, update=False, debug=False: None)
+    env = layered_environment
+    layers = env.select_layers(['storage'])
+    aws['cloudformation'].stacks.append({
+        'StackName': layers[0].cf_name,
+        'StackStatus': 'CREATE_COMPLETE',
+        'Outputs': [{'OutputKey': 'Bucket', 'OutputValue': 'bucket'}]})
+    output_file = tmpdir.join('outputs.yaml')
+    env.create(output_file=str(output_file), layers=layers)
+    assert yaml.safe_load(output_file.read()) == {
+        'storage': {'Bucket': 'bucket'}}
+    assert loaded == ['storage']
+
+
+class StubKms:
+    """Reversible stand-in for the KMS client."""
+    def encrypt(self, KeyId, Plaintext):
+        return {'CiphertextBlob': b'kms:' + Plaintext}
+
+    def decrypt(self, CiphertextBlob):
+        return {'Plaintext': CiphertextBlob[len(b'kms:'):]}
+
+
+class StubDynamodb:
+    """DynamoDB client that leaves the first batch partly unprocessed."""
+    def __init__(self):
+        self.items = {}
+        self.calls = 0
+
+    def batch_write_item(self, RequestItems):
+        self.calls += 1
+        (table, requests), = RequestItems.items()
+        unprocessed = requests[-2:] if self.calls == 1 else []
+        for request in requests[:len(requests) - len(unprocessed)]:
+            item = request['PutRequest']['Item']
+            self.items[item['id']['S']] = item
+        return {'UnprocessedItems': {table: unprocessed} if unprocessed
+                else {}}
+
+    def batch_get_item(self, RequestItems):
+        self.calls += 1
+        (table, request), = RequestItems.items()
+        keys = [key['id']['S'] for key in request['Keys']]
+        unprocessed = keys[-2:] if self.calls == 1 else []
+        return {
+            'Responses': {table: [self.items[key] for key in keys
+                                  if key not in unprocessed]},
+            'UnprocessedKeys': {table: {'Keys': [
+                {'id': {'S': key}} for key in unprocessed]}}
+            if unprocessed else {}}
+
+
+@pytest.fixture
+def vault_environment(tmpdir, aws):
+    """An environment whose secrets vault is deployed."""
+    tmpdir.join('layers', 'secrets-vault', 'meta.yaml').write(
+        "meta:\n  description: Secrets vault\n", ensure=True)
+    path = tmpdir.join('vault.yaml')
+    path.write("vault:\n  layers:\n    - layer: secrets-vault\n")
+    env = Environment(str(path), stage='dummy')
+    aws['cloudformation'].stacks.append({
+        'StackName': env.vault_layer.cf_name,
+        'StackStatus': 'CREATE_COMPLETE',
+        'Outputs': [{'OutputKey': 'KmsKeyId', 'OutputValue': 'vault'}]})
+    aws['kms'] = StubKms()
+    return env
+
+
+def test_undeployed_vault(vault_environment, aws):
+    """Secrets require the vault layer to be deployed."""
+    aws['cloudformation'].stacks.clear()
+    with pytest.raises(RequiresVaultError):
+        vault_environment.kms_key_id
+
+
+def test_secrets_batches_are_retried(vault_environment, aws, monkeypatch):
+    """Unprocessed items and keys are retried until all are processed."""
+    # As set in .humilis.ini
+    monkeypatch.setattr(config, 'VAULT_RETRY_MIN_DELAY', '0')
+    monkeypatch.setattr(config, 'VAULT_RETRY_MAX_DELAY', '0')
+    dynamodb = aws['dynamodb'] = StubDynamodb()
+    env = vault_environment
+    secrets = {'key{}'.format(i): 'secret{}'.format(i) for i in range(30)}
+    env.set_secrets(secrets)
+    assert sorted(dynamodb.items) == sorted(secrets)
+    # Two batches of 25 and 5, and the two unprocessed items of the first
+    assert dynamodb.calls == 3
+
+    dynamodb.calls = 0
+    assert env.get_secrets(list(secrets)) == secrets
+    assert dynamodb.calls == 2
+
+
+def test_create_without_changed_only(layered_environment, monkeypatch):
+    """Build state is neither computed nor recorded without changed_only."""
+    deployed = []
+
+    def create(layer, update=False, debug=False):
+        deployed.append(layer.name)
+
+    def digest(layer):
+        raise AssertionError("Build state computed without changed_only")
+
+    monkeypatch.setattr(Layer, 'create', create)
+    monkeypatch.setattr(Layer, 'input_digest', digest)
+    monkeypatch.setattr(Layer, 'upstream_digest', digest)
+    layered_environment.create()
+    assert sorted(deployed) == ['api', 'logging', 'storage']
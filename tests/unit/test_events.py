@@ -0,0 +1,45 @@
+"""Test the incremental reading of stack events."""
+
+from humilis.events import EventStream
+
+
+class FakeClient:
+    """Pages stack events newest first, two events per page."""
+    def __init__(self):
+        self.events = []
+        self.calls = 0
+
+    def describe_stack_events(self, StackName, NextToken=None):
+        self.calls += 1
+        start = int(NextToken or 0)
+        newest_first = list(reversed(self.events))
+        resp = {'StackEvents': newest_first[start:start + 2]}
+        if start + 2 < len(newest_first):
+            resp['NextToken'] = str(start + 2)
+        return resp
+
+    def add_events(self, nb_events):
+        first = len(self.events)
+        self.events += [{'EventId': str(i)}
+                        for i in range(first, first + nb_events)]
+
+
+def test_event_stream():
+    client = FakeClient()
+    client.add_events(5)
+    events = EventStream(client, "stack")
+    events.skip_history()
+    assert list(events) == []
+    client.add_events(3)
+    client.calls = 0
+    assert [ev['EventId'] for ev in events] == ['5', '6', '7']
+    # Paging stops at the page containing the last seen event
+    assert client.calls == 2
+    assert list(events) == []
+
+
+def test_event_stream_history():
+    client = FakeClient()
+    client.add_events(5)
+    events = EventStream(client, "stack")
+    assert [ev['EventId'] for ev in events] == ['0', '1', '2', '3', '4']
@@ -0,0 +1,33 @@
+"""Tests that importing humilis does not import what it may not need."""
+
+import subprocess
+import sys
+
+
+def _imported(module, *names):
+    """Imports a module in a fresh interpreter.
+
+    :returns: Which of the names ended up imported.
+    """
+    code = ("import sys\n"
+            "import {}\n"
+            "print(' '.join(n for n in {!r} if n in sys.modules))").format(
+                module, names)
+    output = subprocess.check_output([sys.executable, '-c', code],
+                                     universal_newlines=True)
+    return output.split()
+
+
+def test_cli_lazy_imports():
+    """The CLI imports AWS, keyring and templating modules only when needed.
+    """
+    assert _imported('humilis.cli', 'boto3', 'botocore', 'keyring',
+                     's3keyring', 'pkg_resources', 'packaging', 'jinja2',
+                     'humilis.environment') == []
+
+
+def test_reference_lazy_imports():
+    """Reference parsers import what they use only when they are used."""
+    assert _imported('humilis.reference', 'boto3', 'botocore', 'keyring',
+                     's3keyring', 'pkg_resources', 'packaging',
+                     'humilis.archive', 'humilis.clients') == []
@@ -0,0 +1,169 @@
+"""Tests the Layer class."""
+
+import threading
+
+import pytest
+
+from humilis.config import config
+from humilis.environment import Environment
+from humilis.layer import TEMPLATE_BODY_MAX_SIZE
+
+
+def test_layers_share_clients(layered_environment_path, aws):
+    """Layers share the AWS clients, and the account ID, of the run."""
+    envs = [Environment(layered_environment_path, stage=stage)
+            for stage in ('dev', 'prod')]
+    assert envs[0].cf is envs[1].cf
+    for env in envs:
+        for layer in env.layers:
+            assert layer.cf is env.cf
+            assert layer.loader_params['__context']['aws']['account_id'] \
+                == '123456789012'
+    assert aws['sts'].calls == 1
+
+
+def test_populate_params_concurrently(tmpdir, aws, monkeypatch):
+    """References with the same priority are resolved concurrently."""
+    barrier = threading.Barrier(2)
+
+    def parser(layer, boto_config, name=None):
+        if name == 'd':
+            # References of a later priority see those of earlier ones
+            return layer.params['b']['value'] + layer.params['c']['value']
+        # Fails unless b and c are resolved concurrently
+        barrier.wait(timeout=5)
+        return name.upper()
+
+    monkeypatch.setattr(config, 'reference_parsers', {'stub': parser})
+    monkeypatch.setattr(config, 'MAX_PARALLEL_REFERENCES', 2)
+    tmpdir.join('layers', 'params', 'meta.yaml').write(
+        "meta:\n"
+        "  parameters:\n"
+        "    a: {value: literal}\n"
+        "    b: {value: {$stub: {name: b}}}\n"
+        "    c: {value: {$stub: {name: c}}}\n"
+        "    d: {value: {$stub: {name: d}}, priority: 2}\n", ensure=True)
+    path = tmpdir.join('params.yaml')
+    path.write("params:\n  layers:\n    - layer: params\n")
+    layer = Environment(str(path), stage='dummy').get_layer('params')
+    layer.populate_params()
+    assert {pname: param['value'] for pname, param in layer.params.items()} \
+        == {'a': 'literal', 'b': 'B', 'c': 'C', 'd': 'BC'}
+
+
+def test_template_source(layered_environment_path, aws, monkeypatch):
+    """Small templates are passed inline, larger ones are uploaded once to
+    a key that is a hash of their contents."""
+    monkeypatch.setattr(config.boto_config, 'profile',
+                        {'bucket': 'bucket', 'aws_region': 'eu-west-1',
+                         's3prefix': 'prefix/'})
+    env = Environment(layered_environment_path, stage='dummy')
+    layer = env.get_layer('storage')
+    s3 = aws['s3']
+    small = {'Resources': {'Topic': {'Type': 'AWS::SNS::Topic'}}}
+    assert layer._template_source(small) == {
+        'TemplateBody': '{"Resources":{"Topic":{"Type":"AWS::SNS::Topic"}}}'}
+    assert s3.objects == {}
+
+    large = {'Description': 'x' * TEMPLATE_BODY_MAX_SIZE}
+    source = layer._template_source(large)
+    (key, body), = s3.objects.items()
+    assert key.startswith(layer.s3_prefix)
+    assert source == {'TemplateURL': 'https://s3-eu-west-1.amazonaws.com/'
+                                     'bucket/{}'.format(key)}
+    s3.objects[key] = None
+    assert layer._template_source(large) == source
+    assert s3.objects == {key: None}
+
+
+def _deploy(aws, layer, template, **stack):
+    """Adds the stack of a layer, deployed from a template, to stub CF."""
+    tags = dict(layer.tags, **{'humilis:created': '2016-01-01'})
+    stack = dict({
+        'StackName': layer.cf_name,
+        'StackStatus': 'UPDATE_COMPLETE',
+        'Tags': [{'Key': k, 'Value': v} for k, v in tags.items()],
+        'NotificationARNs': []}, **stack)
+    aws['cloudformation'].stacks.append(stack)
+    aws['cloudformation'].templates[layer.cf_name] = template
+
+
+@pytest.mark.parametrize("template,stack,deployed", [
+    ('{"Resources": {"Topic": {"Type": "AWS::SNS::Topic"}}}', {}, True),
+    ({'Resources': {'Topic': {'Type': 'AWS::SNS::Topic'}}}, {}, True),
+    ('{"Resources": {"Queue": {"Type": "AWS::SQS::Queue"}}}', {}, False),
+    ('Resources:\n  Topic:\n    Type: AWS::SNS::Topic\n', {}, False),
+    ('{"Resources": {"Topic": {"Type": "AWS::SNS::Topic"}}}',
+     {'StackStatus': 'UPDATE_ROLLBACK_FAILED'}, False),
+    ('{"Resources": {"Topic": {"Type": "AWS::SNS::Topic"}}}',
+     {'Tags': [{'Key': 'team', 'Value': 'web'}]}, False),
+    ('{"Resources": {"Topic": {"Type": "AWS::SNS::Topic"}}}',
+     {'NotificationARNs': ['arn:aws:sns:eu-west-1:1234:topic']}, False)])
+def test_is_deployed(layered_environment, aws, template, stack, deployed):
+    """Only stacks deployed from the same template, tags and topics are."""
+    layer = layered_environment.get_layer('storage')
+    _deploy(aws, layer, template, **stack)
+    cf_template = {'Resources': {'Topic': {'Type': 'AWS::SNS::Topic'}}}
+    assert layer.is_deployed(cf_template) == deployed
+
+
+def test_update_deployed_layer(layered_environment, aws, monkeypatch):
+    """No changeset is created to update layers that are deployed."""
+    layer = layered_environment.get_layer('storage')
+    _deploy(aws, layer, layer.compile())
+
+    def create_change_set(**kwargs):
+        raise AssertionError("Changeset created")
+
+    monkeypatch.setattr(aws['cloudformation'], 'create_change_set',
+                        create_change_set, raising=False)
+    layer.create(update=True)
+
+
+@pytest.fixture
+def env_file(tmpdir, aws, monkeypatch):
+    """A one-layer environment whose template reads an env var."""
+    monkeypatch.delenv('HUMILIS_TEST_RETENTION', raising=False)
+    layerdir = tmpdir.mkdir('layers').mkdir('logs')
+    layerdir.join('meta.yaml').write(
+        "meta:\n  description: Log group\n")
+    layerdir.join('resources.yaml.j2').write(
+        "resources:\n"
+        "  LogGroup:\n"
+        "    Type: AWS::Logs::LogGroup\n"
+        "    Properties:\n"
+        "      RetentionInDays: {{ env.get('HUMILIS_TEST_RETENTION', 7) }}\n")
+    path = tmpdir.join('myenv.yaml')
+    path.write("myenv:\n  description: test\n  layers:\n    - layer: logs\n")
+    return path
+
+
+def _input_digest(env_file, stage='dev'):
+    env = Environment(str(env_file), stage=stage)
+    return env.get_layer('logs').input_digest()
+
+
+def test_input_digest_env_vars(env_file, monkeypatch):
+    """The env vars read by templates, and the stage, are layer inputs."""
+    digest = _input_digest(env_file)
+    assert digest is not None
+    assert _input_digest(env_file) == digest
+    assert _input_digest(env_file, stage='prod') != digest
+
+    monkeypatch.setenv('HUMILIS_TEST_RETENTION', '30')
+    assert _input_digest(env_file) != digest
+
+    # Unrelated env vars are not inputs
+    monkeypatch.setenv('HUMILIS_TEST_UNRELATED', 'x')
+    monkeypatch.setenv('HUMILIS_TEST_RETENTION', '7')
+    changed = _input_digest(env_file)
+    monkeypatch.setenv('HUMILIS_TEST_UNRELATED', 'y')
+    assert _input_digest(env_file) == changed
+
+
+def test_input_digest_dynamic_env_var(env_file):
+    """Env vars read with names that are not literals make layers volatile.
+    """
+    env_file.dirpath('layers', 'logs', 'outputs.yaml.j2').write(
+        "outputs:\n  Name: {Value: {{ env[__vars.name] }}}\n")
+    assert _input_digest(env_file) is None
@@ -0,0 +1,47 @@
+"""Tests the discovery of humilis plugins."""
+
+import sys
+
+import pytest
+
+from humilis.plugins import EntryPointMap
+
+
+@pytest.fixture
+def plugin(tmpdir, monkeypatch):
+    """Installs a fake plugin distribution."""
+    tmpdir.join('fakeplugin.py').write(
+        "LOADED = []\n"
+        "def parser():\n"
+        "    return 'parsed'\n"
+        "def layer_path():\n"
+        "    LOADED.append('layer')\n"
+        "    return '/path/to/layer'\n")
+    dist_info = tmpdir.mkdir('fakeplugin-1.0.dist-info')
+    dist_info.join('METADATA').write(
+        "Metadata-Version: 2.1\nName: fakeplugin\nVersion: 1.0\n")
+    dist_info.join('entry_points.txt').write(
+        "[humilis.reference_parsers]\n"
+        "fake = fakeplugin:parser\n\n"
+        "[humilis.layers]\n"
+        "fake = fakeplugin:layer_path\n")
+    monkeypatch.syspath_prepend(str(tmpdir))
+    yield tmpdir
+    sys.modules.pop('fakeplugin', None)
+
+
+def test_entry_point_map(plugin):
+    groups = ('humilis.reference_parsers', 'humilis.layers')
+    cache_dir = str(plugin.join('cache'))
+    parsers = EntryPointMap('humilis.reference_parsers', groups=groups,
+                            cache_dir=cache_dir)
+    layers = EntryPointMap('humilis.layers', groups=groups,
+                           cache_dir=cache_dir, call=True)
+    assert 'fake' in parsers
+    assert 'fakeplugin' not in sys.modules
+    assert parsers['fake']() == 'parsed'
+    assert sys.modules['fakeplugin'].LOADED == []
+    assert layers.get('fake') == '/path/to/layer'
+    assert layers.get('missing') is None
+    # The index has been persisted
+    assert plugin.join('cache').listdir()
@@ -0,0 +1,198 @@
+"""Tests the built-in reference parsers."""
+
+import logging
+import os
+import zipfile
+
+import pytest
+
+from humilis import reference
+from humilis.config import config
+from humilis.environment import Environment
+
+
+@pytest.fixture
+def cache_dir(tmpdir, monkeypatch):
+    monkeypatch.setattr(config, 'CACHE_DIR', str(tmpdir.join('cache')))
+    return tmpdir
+
+
+@pytest.mark.parametrize("requirements,cacheable", [
+    ("requests==2.25.1\nsix==1.15.0  # comment\n", True),
+    ("requests==2.25.1 \\\n    --hash=sha256:abc\n", True),
+    ("requests==2.25.1\ngit+https://github.com/humilis/humilis#egg=h\n",
+     False),
+    ("-e ./local/path\n", False),
+    ("./local/path\n", False),
+    ("humilis @ https://example.com/humilis.zip\n", False),
+    ("-r other.txt\n", False),
+    ("requests\n", False),
+    ("requests>=2.0\n", False)])
+def test_requirements_key(tmpdir, requirements, cacheable):
+    """Only requirements files that always install the same code are cached.
+    """
+    path = tmpdir.join('requirements.txt')
+    path.write(requirements)
+    assert (reference._requirements_key(str(path)) is not None) == cacheable
+
+
+def test_uncacheable_requirements_are_installed(cache_dir, monkeypatch):
+    """Requirements files with git entries are installed on every build."""
+    installs = []
+    monkeypatch.setattr(reference, '_run_pip',
+                        lambda args, path: installs.append(args))
+    requirements = cache_dir.join('requirements.txt')
+    requirements.write("git+https://github.com/humilis/humilis#egg=h\n")
+    target = cache_dir.mkdir('target')
+    for _ in range(2):
+        reference._pip_install(
+            ['-r', str(requirements)], str(target),
+            key=reference._requirements_key(str(requirements)))
+    assert len(installs) == 2
+    assert not cache_dir.join('cache', 'deps').check()
+
+
+def test_is_jinja2_template(tmpdir):
+    """Only text files marked within their header are templates."""
+    template = tmpdir.join('handler.py')
+    template.write("# preprocessor:jinja2\nVALUE = '{{ value }}'\n")
+    assert reference._is_jinja2_template(str(template))
+
+    plain = tmpdir.join('plain.py')
+    plain.write("VALUE = 1\n")
+    assert not reference._is_jinja2_template(str(plain))
+
+    binary = tmpdir.join('data.bin')
+    binary.write_binary(b'\0\x01# preprocessor:jinja2\n')
+    assert not reference._is_jinja2_template(str(binary))
+
+    late = tmpdir.join('late.py')
+    late.write("# padding\n" * (reference.TEMPLATE_HEADER_SIZE // 10) +
+               "# preprocessor:jinja2\n")
+    assert not reference._is_jinja2_template(str(late))
+
+    installed = tmpdir.mkdir('site-packages').join('module.py')
+    installed.write("# preprocessor:jinja2\n")
+    assert not reference._is_jinja2_template(str(installed))
+
+
+def test_deploy_package(tmpdir, monkeypatch):
+    """Packages hold the source tree, with templates rendered, and the
+    dependencies, with source files taking precedence."""
+    def pip_install(args, path, key=None):
+        os.makedirs(os.path.join(path, 'dep'))
+        os.makedirs(os.path.join(path, 'dep-1.0.dist-info'))
+        files = {'handler.py': 'installed',
+                 'dep/__init__.py': 'installed',
+                 'dep-1.0.dist-info/direct_url.json': '{}',
+                 'dep-1.0.dist-info/RECORD': 'dep/__init__.py,,\n'
+                 'dep-1.0.dist-info/direct_url.json,,\n'}
+        for arcname, text in files.items():
+            with open(os.path.join(path, arcname), 'w') as f:
+                f.write(text)
+
+    monkeypatch.setattr(reference, '_pip_install', pip_install)
+    source = tmpdir.mkdir('mylambda')
+    source.join('handler.py').write(
+        "# preprocessor:jinja2\nVALUE = '{{ value }}'\n")
+    source.join('requirements.txt').write("dep\n")
+    source.join('__pycache__', 'handler.pyc').write('', ensure=True)
+    logger = logging.getLogger(__name__)
+    rendered = reference._render_sources(str(source), {'value': 'x'})
+    with reference._deploy_package(str(source), None, logger, None,
+                                   rendered, {}) as path:
+        with zipfile.ZipFile(path) as zf:
+            assert sorted(zf.namelist()) == [
+                'dep-1.0.dist-info/RECORD', 'dep/__init__.py', 'handler.py',
+                'requirements.txt']
+            assert zf.read('handler.py') == \
+                b"# preprocessor:jinja2\nVALUE = 'x'"
+            # Where local dependencies were installed from is left out
+            assert zf.read('dep-1.0.dist-info/RECORD') == \
+                b'dep/__init__.py,,\n'
+
+
+@pytest.fixture
+def lambda_layer(cache_dir, aws, monkeypatch):
+    """A layer with a lambda whose handler is a template."""
+    monkeypatch.setattr(config.boto_config, 'profile',
+                        {'bucket': 'bucket', 'aws_region': 'eu-west-1'})
+    layerdir = cache_dir.join('layers', 'fn')
+    layerdir.join('meta.yaml').write(
+        "meta:\n  description: A lambda\n", ensure=True)
+    layerdir.join('mylambda', 'handler.py').write(
+        "# preprocessor:jinja2\nVALUE = '{{ value }}'\n", ensure=True)
+    path = cache_dir.join('fns.yaml')
+    path.write("fns:\n  layers:\n    - layer: fn\n")
+    return Environment(str(path), stage='dummy').get_layer('fn')
+
+
+def _spy(monkeypatch, obj, name):
+    """Records the arguments of every call to a function."""
+    calls = []
+    func = getattr(obj, name)
+
+    def spy(*args, **kwargs):
+        calls.append(args)
+        return func(*args, **kwargs)
+
+    monkeypatch.setattr(obj, name, spy)
+    return calls
+
+
+@pytest.mark.parametrize("key_from_archive", [True, False])
+def test_package_cache_hit(lambda_layer, aws, monkeypatch, key_from_archive):
+    """Packages whose inputs have not changed are not built nor uploaded
+    again."""
+    monkeypatch.setattr(config, 'LAMBDA_KEY_FROM_ARCHIVE', key_from_archive)
+    built = _spy(monkeypatch, reference, '_deploy_package')
+    published = _spy(monkeypatch, reference, '_publish_package')
+    uploads = _spy(monkeypatch, aws['s3'], 'upload_file')
+    ref = reference.lambda_ref(lambda_layer, config.boto_config,
+                               path='mylambda', value='x')
+    (key, _), = aws['s3'].objects.items()
+    assert ref == {'s3bucket': 'bucket', 's3key': key}
+    assert (len(built), len(published), len(uploads)) == (1, 1, 1)
+
+    assert reference.lambda_ref(lambda_layer, config.boto_config,
+                                path='mylambda', value='x') == ref
+    assert len(built) == 1
+    assert len(uploads) == 1
+    # Packages keyed by their inputs are found in S3 without publishing them
+    assert len(published) == (2 if key_from_archive else 1)
+
+
+@pytest.mark.parametrize("change", [
+    lambda layerdir: {'value': 'y'},
+    lambda layerdir: layerdir.join('mylambda', 'handler.py').write(
+        "# preprocessor:jinja2\nVALUE = '{{ value }}!'\n") or {},
+    lambda layerdir: layerdir.join('mylambda', 'util.py').write('') or {}])
+def test_package_cache_miss(cache_dir, lambda_layer, aws, monkeypatch,
+                            change):
+    """Packages are built and uploaded again when any input changes."""
+    built = _spy(monkeypatch, reference, '_deploy_package')
+    uploads = _spy(monkeypatch, aws['s3'], 'upload_file')
+    ref = reference.lambda_ref(lambda_layer, config.boto_config,
+                               path='mylambda', value='x')
+    params = dict({'value': 'x'}, **change(cache_dir.join('layers', 'fn')))
+    assert reference.lambda_ref(lambda_layer, config.boto_config,
+                                path='mylambda', **params) != ref
+    assert len(built) == 2
+    assert len(uploads) == 2
+
+
+def test_local_packages_are_installed(cache_dir, lambda_layer, monkeypatch):
+    """Local packages, and lambdas with a setup.py, are installed on every
+    build, since their requirements may not be pinned."""
+    monkeypatch.setattr(config, 'LAMBDA_PACKAGE_CACHE', False)
+    installs = []
+    monkeypatch.setattr(reference, '_run_pip',
+                        lambda args, path: installs.append(args))
+    cache_dir.join('mypkg', 'setup.py').write('', ensure=True)
+    cache_dir.join('layers', 'fn', 'mylambda', 'setup.py').write('')
+    for _ in range(2):
+        reference.lambda_ref(lambda_layer, config.boto_config,
+                             path='mylambda', dependencies=['mypkg'],
+                             value='x')
+    assert len(installs) == 4
+    assert not cache_dir.join('cache', 'deps').check()
@@ -0,0 +1,84 @@
+"""Tests the resolution of secrets stored in S3 keyrings."""
+
+import base64
+import io
+
+from s3keyring.s3 import _escape_for_s3
+
+from humilis.secrets import SecretResolver, _s3_escape
+
+
+class FakeS3:
+    """Stand-in for the S3 client of a keyring, that counts calls."""
+    def __init__(self, objects):
+        self.objects = objects
+        self.lists = 0
+        self.gets = 0
+
+    def get_paginator(self, operation):
+        return self
+
+    def paginate(self, Bucket, Prefix):
+        self.lists += 1
+        return [{'Contents': [{'Key': key} for key in sorted(self.objects)
+                              if key.startswith(Prefix)]}]
+
+    def get_object(self, Bucket, Key):
+        self.gets += 1
+        return {'Body': io.BytesIO(base64.encodebytes(self.objects[Key]))}
+
+
+class FakeKeyring:
+    def __init__(self, client, escape=str):
+        self.client = client
+        self.bucket = 'bucket'
+        self.namespace = 'ns'
+        self.escape = escape
+        self.keyring = self
+
+    def get_password(self, group, key):
+        s3key = '{}/{}/{}/secret.b64'.format(self.namespace, group, key)
+        if s3key in self.client.objects:
+            body = self.client.get_object(Bucket=self.bucket, Key=s3key)
+            return base64.decodebytes(body['Body'].read()).decode('utf-8')
+
+
+def test_secret_resolver():
+    """The secrets of a group are fetched once, in a single listing."""
+    client = FakeS3({'ns/db/user/secret.b64': b'pwd',
+                     'ns/db/admin/secret.b64': b'root',
+                     'ns/db/nested/key/secret.b64': b'ignored',
+                     'ns/other/user/secret.b64': b'other'})
+    resolver = SecretResolver()
+    resolver._keyrings[None] = FakeKeyring(client)
+    assert resolver.get(None, 'db', 'user') == 'pwd'
+    assert resolver.get(None, 'db', 'admin') == 'root'
+    assert resolver.get(None, 'db', 'missing') is None
+    assert client.lists == 1
+    assert client.gets == 2
+
+
+def test_secret_resolver_without_s3_layout():
+    """Secrets are read one by one if s3keyring stores them elsewhere."""
+    client = FakeS3({'ns/db/user/secret.b64': b'pwd',
+                     'ns/db/admin/secret.b64': b'root'})
+    resolver = SecretResolver()
+    resolver._keyrings[None] = FakeKeyring(client, escape=None)
+    assert resolver.get(None, 'db', 'user') == 'pwd'
+    assert resolver.get(None, 'db', 'missing') is None
+    assert client.lists == 0
+    assert client.gets == 1
+
+
+def test_s3_escape():
+    """The escaping of s3keyring is only used with the expected layout."""
+    class Keyring:
+        namespace = 'ns'
+
+    assert _s3_escape(Keyring()) is None
+    Keyring._get_s3_key = lambda self, group, key: '{}/{}/{}'.format(
+        self.namespace, group, key)
+    assert _s3_escape(Keyring()) is None
+    Keyring._get_s3_key = lambda self, group, key: (
+        '{}/{}/{}/secret.b64'.format(self.namespace, group, key))
+    assert _s3_escape(Keyring()) is _escape_for_s3
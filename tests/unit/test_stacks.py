@@ -0,0 +1,81 @@
+"""Test the index of CF stacks."""
+
+from humilis.stacks import StackIndex
+
+
+class FakePaginator:
+    def __init__(self, client):
+        self.client = client
+
+    def paginate(self):
+        self.client.sweeps += 1
+        stacks = list(self.client.stacks.values())
+        return [{'Stacks': stacks[:1]}, {'Stacks': stacks[1:]}]
+
+
+class FakeClient:
+    def __init__(self, stacks):
+        self.stacks = {stack['StackName']: stack for stack in stacks}
+        self.sweeps = 0
+        self.describes = 0
+
+    def get_paginator(self, name):
+        return FakePaginator(self)
+
+    def describe_stacks(self, StackName):
+        self.describes += 1
+        return {'Stacks': [self.stacks[StackName]]}
+
+
+class FakeCf:
+    def __init__(self, stacks):
+        self.client = FakeClient(stacks)
+
+
+def _stack(name, environment, status='CREATE_COMPLETE'):
+    return {'StackName': name, 'StackStatus': status,
+            'Outputs': [{'OutputKey': 'Out', 'OutputValue': name}],
+            'Tags': [{'Key': 'humilis:environment', 'Value': environment}]}
+
+
+def test_stack_index():
+    cf = FakeCf([_stack('env-vpc-DEV', 'env'), _stack('other-vpc-DEV', 'o')])
+    index = StackIndex(cf, ttl=60)
+    assert index.get('env-vpc-DEV')['outputs'] == {'Out': 'env-vpc-DEV'}
+    assert index.get('missing') is None
+    assert [s['name'] for s in index.environment_stacks('env')] == \
+        ['env-vpc-DEV']
+    assert cf.client.sweeps == 1
+
+    cf.client.stacks['env-vpc-DEV']['StackStatus'] = 'UPDATE_COMPLETE'
+    assert index.get('env-vpc-DEV')['status'] == 'CREATE_COMPLETE'
+    index.invalidate('env-vpc-DEV')
+    assert index.get('env-vpc-DEV')['status'] == 'UPDATE_COMPLETE'
+    assert (cf.client.sweeps, cf.client.describes) == (1, 1)
+
+    index.invalidate()
+    index.get('env-vpc-DEV')
+    assert cf.client.sweeps == 2
+
+
+def test_stack_resources():
+    cf = FakeCf([_stack('env-vpc-DEV', 'env')])
+    calls = []
+
+    class ResourcesPaginator:
+        def paginate(self, StackName):
+            calls.append(StackName)
+            return [{'StackResourceSummaries': [
+                {'LogicalResourceId': 'VPC', 'PhysicalResourceId': 'vpc-1'}]}]
+
+    cf.client.get_paginator = lambda name: (
+        ResourcesPaginator() if name == 'list_stack_resources'
+        else FakePaginator(cf.client))
+    index = StackIndex(cf, ttl=60)
+    assert index.resources('env-vpc-DEV') == {'VPC': 'vpc-1'}
+    assert index.resources('env-vpc-DEV') == {'VPC': 'vpc-1'}
+    assert index.resources('missing') is None
+    assert calls == ['env-vpc-DEV']
+    index.invalidate('env-vpc-DEV')
+    index.resources('env-vpc-DEV')
+    assert calls == ['env-vpc-DEV'] * 2
@@ -0,0 +1,19 @@
+"""Tests the build state of environment layers."""
+
+from humilis.state import BuildState
+
+
+def test_build_state(tmpdir):
+    """The state survives a save and reload."""
+    path = str(tmpdir.join('state', 'env.json'))
+    state = BuildState(path)
+    assert state.get('layer') is None
+    state.set('layer', {'inputs': 'a', 'upstream': 'b', 'stack': 'c'})
+    state.set('other', {'inputs': 'd', 'upstream': 'e', 'stack': 'f'})
+    state.set('other', None)
+    state.save()
+
+    state = BuildState(path)
+    assert state.get('layer') == {'inputs': 'a', 'upstream': 'b',
+                                  'stack': 'c'}
+    assert state.get('other') is None
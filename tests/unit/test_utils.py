@@ -0,0 +1,88 @@
+"""Test utilities."""
+
+import datetime
+import os
+
+import pytest
+
+from humilis.config import config
+from humilis.exceptions import CyclicDependencyError
+from humilis import utils
+from humilis.utils import dependency_waves, load_yaml_file
+
+
+def test_dependency_waves():
+    """Independent names are grouped together, in fallback order."""
+    deps = {"nat": ["vpc"], "api": ["nat", "storage"], "vpc": []}
+    waves = dependency_waves(["api", "vpc", "storage", "nat"], deps)
+    assert waves == [["vpc", "storage"], ["nat"], ["api"]]
+
+
+def test_dependency_waves_unknown_dependency():
+    """Dependencies outside the list of names are ignored."""
+    waves = dependency_waves(["nat"], {"nat": ["vpc", "nat"]})
+    assert waves == [["nat"]]
+
+
+def test_dependency_waves_cycle():
+    with pytest.raises(CyclicDependencyError):
+        dependency_waves(["a", "b"], {"a": ["b"], "b": ["a"]})
+
+
+def test_get_jinja2_env(tmpdir, monkeypatch):
+    """Jinja2 environments are shared per template directory and options,
+    and their compiled templates are cached on disk."""
+    monkeypatch.setattr(config, 'CACHE_DIR', str(tmpdir.join('cache')))
+    monkeypatch.setattr(utils, '_jinja2_envs', {})
+    monkeypatch.setattr(utils, '_jinja2_bytecode_cache', None)
+    templates = tmpdir.mkdir('templates')
+    templates.join('meta.yaml.j2').write('name: {{ name }}\n')
+    env = utils.get_jinja2_env(str(templates), trim_blocks=True)
+    assert utils.get_jinja2_env(str(templates), trim_blocks=True) is env
+    assert utils.get_jinja2_env(str(templates)) is not env
+    loader = utils.DirTreeBackedObject(str(templates))
+    assert loader.env is utils.get_jinja2_env(
+        str(templates), trim_blocks=True, lstrip_blocks=True)
+
+    template = env.get_template('meta.yaml.j2')
+    assert env.get_template('meta.yaml.j2') is template
+    assert template.render(name='x') == 'name: x'
+    assert tmpdir.join('cache', 'jinja2').listdir()
+
+
+def test_load_yaml_file(tmpdir, monkeypatch):
+    """Parsed files are cached, but each call gets its own copy."""
+    monkeypatch.setattr(config, 'CACHE_DIR', str(tmpdir.join('cache')))
+    path = tmpdir.join('meta.yaml')
+    path.write('meta:\n  parameters:\n    a: 1\n')
+    data = load_yaml_file(str(path))
+    assert data == {'meta': {'parameters': {'a': 1}}}
+    data['meta']['parameters']['a'] = 2
+    assert load_yaml_file(str(path)) == {'meta': {'parameters': {'a': 1}}}
+
+    # A modified file is parsed again
+    path.write('meta:\n  parameters:\n    a: 10\n')
+    os.utime(str(path), (0, 0))
+    assert load_yaml_file(str(path)) == {'meta': {'parameters': {'a': 10}}}
+
+
+def test_load_yaml_file_disk_cache(tmpdir, monkeypatch):
+    """The disk cache round-trips YAML values and ignores invalid entries."""
+    monkeypatch.setattr(config, 'CACHE_DIR', str(tmpdir.join('cache')))
+    path = tmpdir.join('meta.yaml')
+    path.write('a: 2020-01-02\nb: 2020-01-02 03:04:05\nc: !!binary aGk=\n'
+               'd: [1, 2.5, null, true]\n')
+    expected = {'a': datetime.date(2020, 1, 2),
+                'b': datetime.datetime(2020, 1, 2, 3, 4, 5),
+                'c': b'hi', 'd': [1, 2.5, None, True]}
+    assert load_yaml_file(str(path)) == expected
+    cached, = tmpdir.join('cache', 'yaml').listdir()
+
+    # Parsed again from the disk cache, not from memory
+    utils._yaml_parsed.clear()
+    assert load_yaml_file(str(path)) == expected
+
+    # An invalid cache entry is never trusted
+    cached.write('{"a": {"__yaml__": "unknown", "value": 1}}')
+    utils._yaml_parsed.clear()
+    assert load_yaml_file(str(path)) == expected
@@ -0,0 +1,50 @@
+"""Tests the encryption of vault secrets."""
+
+import os
+
+import pytest
+
+from humilis.exceptions import VaultError
+from humilis.vault import SecretCipher
+
+
+class FakeKms:
+    """Reversible stand-in for the KMS client, that counts calls."""
+    def __init__(self):
+        self.calls = 0
+
+    def encrypt(self, KeyId, Plaintext):
+        self.calls += 1
+        return {'CiphertextBlob': KeyId.encode() + b':' + Plaintext}
+
+    def decrypt(self, CiphertextBlob):
+        self.calls += 1
+        return {'Plaintext': CiphertextBlob.split(b':', 1)[1]}
+
+    def generate_data_key(self, KeyId, KeySpec):
+        self.calls += 1
+        key = os.urandom(32)
+        return {'Plaintext': key,
+                'CiphertextBlob': KeyId.encode() + b':' + key}
+
+
+def test_envelope_encryption():
+    """Envelope-encrypted secrets take one KMS call per data key."""
+    kms = FakeKms()
+    secrets = {'key{}'.format(i): 'secret{}'.format(i) for i in range(10)}
+    items = SecretCipher(kms, envelope=True).encrypt_all(secrets, 'vault')
+    assert kms.calls == 1
+    assert all(item['encryption']['S'] == 'aes-256-gcm' for item in items)
+    assert b'secret1' not in items[1]['value']['B']
+
+    # Directly encrypted secrets are still readable
+    items += SecretCipher(kms).encrypt_all({'direct': 'plain'}, 'vault')
+    kms.calls = 0
+    plaintexts = SecretCipher(kms).decrypt_all(items)
+    assert kms.calls == 2
+    assert plaintexts == [secrets[key] for key in sorted(secrets)] + ['plain']
+
+    # The secret ID is authenticated: items can't be swapped
+    items[0]['id']['S'] = 'key1'
+    with pytest.raises(VaultError):
+        SecretCipher(kms).decrypt(items[0])
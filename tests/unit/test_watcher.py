@@ -0,0 +1,68 @@
+"""Test the stack watcher."""
+
+from botocore.exceptions import ClientError
+import pytest
+
+from humilis.watcher import Watcher
+
+
+class FakeClient:
+    """Reports a stack in progress for a number of polls."""
+    def __init__(self, nb_polls):
+        self.nb_polls = nb_polls
+        self.calls = 0
+
+    def describe_stacks(self, StackName):
+        self.calls += 1
+        status = ('CREATE_IN_PROGRESS', 'CREATE_COMPLETE')[
+            self.calls >= self.nb_polls]
+        return {'Stacks': [{'StackName': StackName, 'StackStatus': status}]}
+
+
+class FakeCf:
+    def __init__(self, nb_polls):
+        self.client = FakeClient(nb_polls)
+
+
+def test_watch_stacks():
+    """Several stacks are watched until they reach a terminal status."""
+    watcher = Watcher(min_delay=0.01, max_delay=0.05, backoff=2)
+    cfs = [FakeCf(nb_polls) for nb_polls in range(1, 5)]
+    seen = []
+    futures = [watcher.watch_stack(cf, "stack", {'CREATE_IN_PROGRESS'},
+                                   on_poll=seen.append)
+               for cf in cfs]
+    assert [f.result(timeout=5) for f in futures] == ['CREATE_COMPLETE'] * 4
+    assert [cf.client.calls for cf in cfs] == [1, 2, 3, 4]
+    assert len(seen) == 10
+
+
+class DeletedClient:
+    """Reports a sequence of statuses of a stack that is being deleted."""
+    def __init__(self, statuses):
+        self.statuses = list(statuses)
+
+    def describe_stacks(self, StackName):
+        status = self.statuses.pop(0)
+        if status is None:
+            raise ClientError({'Error': {
+                'Message': 'Stack {} does not exist'.format(StackName)}},
+                'DescribeStacks')
+        return {'Stacks': [{'StackName': StackName, 'StackStatus': status}]}
+
+
+@pytest.mark.parametrize("statuses,result", [
+    (['UPDATE_COMPLETE', 'DELETE_IN_PROGRESS', None], None),
+    (['UPDATE_COMPLETE', 'UPDATE_COMPLETE', 'DELETE_COMPLETE'],
+     'DELETE_COMPLETE'),
+    (['UPDATE_COMPLETE', 'DELETE_FAILED'], 'DELETE_FAILED'),
+    (['UPDATE_COMPLETE', None], None)])
+def test_watch_stack_initial_status(statuses, result):
+    """The status a stack had before an operation is not a terminal one."""
+    watcher = Watcher(min_delay=0.01, max_delay=0.05, backoff=2)
+    cf = type('Cf', (), {'client': DeletedClient(statuses)})
+    future = watcher.watch_stack(cf, "stack", {'DELETE_IN_PROGRESS'},
+                                 missing_ok=True,
+                                 initial_status='UPDATE_COMPLETE')
+    assert future.result(timeout=5) == result
+    assert cf.client.statuses == []